@@ -0,0 +1,287 @@
+"""
+Convert the libraries of many users in one process.
+
+Each user has a folder in the users folder (config.BATCH_USERS_PATH) holding their Library.xml and their Spotify
+token cache (config.BATCH_TOKEN_CACHE), written by spotipy when the user authorized the app:
+
+    .data/users/alice/Library.xml
+    .data/users/alice/.cache
+
+The libraries are extracted and cleaned in parallel on a process pool. Their rows are then linked as one frame
+by one DataLinker, so a song in several libraries is searched once and the request history is read once a
+stage. Each user's library is loaded into their Spotify account on a pool of threads sharing one rate
+controller. The cleaned tracks and playlists of each user are written to checkpoints in their folder.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import logging
+from pathlib import Path
+import time
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+import config
+from credentials import spotify_get, spotify_post
+from data_cleaning import DataCleaner
+from data_extraction import DataExtractor
+from data_linking import DataLinker
+from data_loading import DataLoader
+from rate_control import RateController
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Column naming the user of each row while their libraries are linked as one frame
+USER_COLUMN = "batch_user"
+
+
+@dataclass
+class UserStats:
+    """Tracks and seconds of a user's conversion"""
+
+    user: str
+    tracks: int = 0
+    playlist_rows: int = 0
+    linked: int = 0
+    prepare_seconds: float = 0.0
+    load_seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def tracks_per_second(self) -> float:
+        seconds = self.prepare_seconds + self.load_seconds
+        return self.tracks / seconds if seconds else 0.0
+
+
+def find_users(path: Path = config.BATCH_USERS_PATH) -> Dict[str, Path]:
+    """The folders of path holding a Library.xml, by user (the folder name)"""
+    return {folder.name: folder for folder in sorted(Path(path).iterdir()) if (folder / "Library.xml").is_file()}
+
+
+def prepare_user(folder: Path, compact: bool) -> Tuple[pd.DataFrame, pd.DataFrame, float]:
+    """Extract the tracks and playlists of a user's Library.xml and clean the tracks (round 1). Runs in a worker"""
+    start = time.perf_counter()
+    df, df_playlist = DataExtractor(mode="PROD").read_apple_library(path=folder / "Library.xml")
+    df = DataCleaner(compact=compact).clean_itunes_data_round_1(df)
+    return df, df_playlist, time.perf_counter() - start
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        users: Dict[str, Path],
+        linker: DataLinker,
+        cleaner: DataCleaner,
+        workers: int = config.EXTRACT_WORKERS,
+        load_workers: int = config.BATCH_LOAD_WORKERS,
+    ):
+        self.users = users  # User: folder
+        self.linker = linker  # One linker, and request history, for all users
+        self.cleaner = cleaner
+        self.workers = workers
+        self.load_workers = load_workers
+        self.stats = {user: UserStats(user) for user in users}
+        self.stage_seconds: Dict[str, float] = {}
+
+    def prepare(self) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]:
+        """Extract and clean (round 1) the users' libraries in parallel. Returns the tracks and playlists by user"""
+        logger.info(f"Extract and clean the libraries of {len(self.users)} users with {self.workers} workers")
+        tracks, playlists = {}, {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                user: executor.submit(prepare_user, folder, self.cleaner.compact) for user, folder in self.users.items()
+            }
+            for user, future in futures.items():
+                tracks[user], playlists[user], self.stats[user].prepare_seconds = future.result()
+                self.stats[user].tracks = len(tracks[user])
+                self.stats[user].playlist_rows = len(playlists[user])
+
+        return tracks, playlists
+
+    def link(self, tracks: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+        """
+        Link the tracks of all users as one frame, each distinct search once, then clean (round 2) and link the
+        albums of each user. Album searches shared by users are found in the request history after the first
+        """
+        df = (
+            pd.concat(tracks.values(), keys=list(tracks), names=[USER_COLUMN, None])
+            .reset_index(level=USER_COLUMN)
+            .reset_index(drop=True)
+        )
+        logger.info(f"Link the {len(df)} tracks of {len(tracks)} users")
+
+        df = self.linker.extract_spotify_track_uri_by_isrc(df)
+        df = self.linker.extract_tracks_by_artist(df)
+        df = self.linker.extract_tracks_by_album(df)
+        df = self.linker.extract_all_isrc_with_na(df)
+
+        linked = {}
+        rows = df.groupby(USER_COLUMN, sort=False).indices
+        for user in tracks:
+            df_user = df.iloc[rows.get(user, [])].drop(columns=USER_COLUMN).reset_index(drop=True)
+            df_user = self.cleaner.clean_itunes_data_round_2(df_user)
+            df_user = self.linker.extract_spotify_album_uri(df_user)
+            self.stats[user].linked = int(df_user["spotify_track_uri"].notna().sum())
+            linked[user] = df_user
+
+        return linked
+
+    def clean_playlists(
+        self, tracks: Dict[str, pd.DataFrame], playlists: Dict[str, pd.DataFrame]
+    ) -> Dict[str, pd.DataFrame]:
+        return {user: self.cleaner.clean_itunes_playlist(playlists[user], df) for user, df in tracks.items()}
+
+    def write_checkpoints(self, tracks: Dict[str, pd.DataFrame], playlists: Dict[str, pd.DataFrame]):
+        """Pickle each user's cleaned tracks (2_cleaned) and playlists (playlist_cleaned) to their folder"""
+        for user, folder in self.users.items():
+            path = folder / "checkpoints"
+            path.mkdir(exist_ok=True)
+            for df, filename in ((tracks[user], "2_cleaned"), (playlists[user], "playlist_cleaned")):
+                with utils.atomic_path(path / filename) as tmp_path:
+                    df.to_pickle(tmp_path)
+
+    def _load_user(self, user: str, loader: DataLoader, df: pd.DataFrame, df_playlist: pd.DataFrame):
+        start = time.perf_counter()
+        try:
+            loader.add_albums_to_spotify(df)
+            loader.add_playlists(df_playlist)
+            loader.add_tracks_to_spotify(df)
+        except Exception as e:
+            # One user failing does not stop the others, the user is reported with the error
+            logger.exception(f"Loading {user} failed")
+            self.stats[user].error = str(e)
+        self.stats[user].load_seconds = time.perf_counter() - start
+
+    def load(
+        self, loaders: Dict[str, DataLoader], tracks: Dict[str, pd.DataFrame], playlists: Dict[str, pd.DataFrame]
+    ):
+        """Load each user's albums, playlists and tracks into their Spotify account, users concurrently"""
+        logger.info(f"Load the libraries of {len(loaders)} users into Spotify with {self.load_workers} workers")
+        with ThreadPoolExecutor(max_workers=self.load_workers) as executor:
+            for user, loader in loaders.items():
+                executor.submit(self._load_user, user, loader, tracks[user], playlists[user])
+
+    def run(self, loaders: Optional[Dict[str, DataLoader]] = None) -> Dict[str, pd.DataFrame]:
+        """Convert the users' libraries, loading those with a loader. Returns the cleaned tracks by user"""
+        start = time.perf_counter()
+        tracks, playlists = self.prepare()
+        self.stage_seconds["prepare"] = time.perf_counter() - start
+
+        tracks = self.link(tracks)
+        playlists = self.clean_playlists(tracks, playlists)
+        self.write_checkpoints(tracks, playlists)
+        self.stage_seconds["link"] = time.perf_counter() - start - self.stage_seconds["prepare"]
+
+        if loaders:
+            self.load(loaders, tracks, playlists)
+        self.stage_seconds["total"] = time.perf_counter() - start
+        self.stage_seconds["load"] = self.stage_seconds["total"] - self.stage_seconds["prepare"] - (
+            self.stage_seconds["link"]
+        )
+
+        return tracks
+
+    def report(self) -> pd.DataFrame:
+        """Log the tracks per second of each user and in total, written to batch_report.csv in the history folder"""
+        df = pd.DataFrame([{**asdict(stats), "tracks_per_second": stats.tracks_per_second} for stats in
+                           self.stats.values()])
+        for stats in self.stats.values():
+            logger.info(
+                f"{stats.user}: {stats.tracks} tracks, {stats.linked} linked, prepared in "
+                f"{stats.prepare_seconds:.1f}s, loaded in {stats.load_seconds:.1f}s, "
+                f"{stats.tracks_per_second:.0f} tracks/s" + (f", failed: {stats.error}" if stats.error else "")
+            )
+
+        search_stats = self.linker.search_stats
+        total = self.stage_seconds.get("total", 0.0)
+        logger.info(
+            f"Total: {len(self.stats)} users, {df['tracks'].sum()} tracks, {df['linked'].sum()} linked in "
+            f"{total:.1f}s (prepare {self.stage_seconds.get('prepare', 0.0):.1f}s, link "
+            f"{self.stage_seconds.get('link', 0.0):.1f}s, load {self.stage_seconds.get('load', 0.0):.1f}s), "
+            f"{df['tracks'].sum() / total if total else 0.0:.0f} tracks/s. "
+            f"{sum(stats.rows for stats in search_stats)} rows searched as "
+            f"{sum(stats.keys for stats in search_stats)} keys, {sum(stats.requested for stats in search_stats)} "
+            f"requested"
+        )
+
+        path = config.HISTORY_PATH / "batch_report.csv"
+        df.to_csv(path, index=False)
+        logger.info(f"Batch report written to {path}")
+        return df
+
+
+def get_loaders(users: Dict[str, Path], rate_control: RateController) -> Dict[str, DataLoader]:
+    """A loader for each user with a token cache, authorized with it. Users without one are skipped"""
+    loaders = {}
+    for user, folder in users.items():
+        cache_path = folder / config.BATCH_TOKEN_CACHE
+        if not cache_path.is_file():
+            logger.warning(f"Skip loading {user}, no token cache {cache_path}")
+            continue
+        loaders[user] = DataLoader(spotify=spotify_post(cache_path=cache_path), rate_control=rate_control)
+
+    return loaders
+
+
+def verify_users(loaders: Dict[str, DataLoader], skip_verification: bool) -> bool:
+    """Display the Spotify user of each folder and wait for confirmation before continuing"""
+    if skip_verification:
+        return True
+
+    for user, loader in loaders.items():
+        print(f"{user}: loading for user_name {loader.user_name} user_id: {loader.user_id}")
+    proceed = input(f"Enter 'Y' or 'y' to continue ...\n")
+    return True if proceed in ("Y", "y") else False
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Convert the iTunes libraries of many users to Spotify")
+    parser.add_argument(
+        "--users",
+        help="Folder with a folder for each user holding their Library.xml and token cache",
+        type=Path,
+        default=config.BATCH_USERS_PATH,
+    )
+    parser.add_argument("--no-load", help="Extract, clean and link only", action="store_true")
+    parser.add_argument("--workers", help="Processes extracting and cleaning", type=int, default=config.EXTRACT_WORKERS)
+    parser.add_argument(
+        "--load-workers", help="Users loaded concurrently", type=int, default=config.BATCH_LOAD_WORKERS
+    )
+    parser.add_argument("--skip-verify", help="Skip user verification", action="store_true")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    users = find_users(args.users)
+    if not users:
+        logger.info(f"No user folders with a Library.xml in {args.users}")
+        return
+
+    # Spotify rate limits apply to the app, searching and the loading of all users share one rate controller
+    rate_controller = RateController()
+    loaders = {} if args.no_load else get_loaders(users, rate_controller)
+    if loaders and not verify_users(loaders, args.skip_verify):
+        print("Processing aborted")
+        return
+
+    runner = BatchRunner(
+        users,
+        linker=DataLinker(spotify=spotify_get(), rate_control=rate_controller),
+        cleaner=DataCleaner(),
+        workers=args.workers,
+        load_workers=args.load_workers,
+    )
+    try:
+        runner.run(loaders)
+        runner.report()
+    finally:
+        rate_controller.write_decisions()
+
+
+if __name__ == "__main__":
+    import log  # Do not remove, configures logging to spotify.log and the console
+
+    main()
@@ -0,0 +1,265 @@
+"""
+Extraction and cleaning benchmarks against synthetic libraries (see synthetic_library.py).
+
+Times reading tracks and playlists from Library.xml, reading tags from the media folders, cleaning round 1
+and linking round 1 from a full request history (searches answered by FakeSpotify), then linking and loading
+end to end through the local stand-in for the Spotify API (spotify_stub.py), reporting rows per second and peak
+memory (tracemalloc, main process only) so regressions are visible.
+
+    python benchmark.py --sizes 1000 10000 100000 --files 10000
+"""
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import logging
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Optional
+
+import config
+from credentials import spotify_stub
+from data_cleaning import DataCleaner
+from data_extraction import DataExtractor
+from data_linking import DataLinker
+from data_loading import DataLoader
+from rate_control import RateController
+from request_history import RequestHistory
+from spotify_stub import Catalog, Faults, SpotifyStub
+from synthetic_library import generate_library
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    size: int
+    rows: int
+    seconds: float
+    peak_mb: Optional[float]
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float("inf")
+
+
+class FakeSpotify:
+    """Answers every search with a track or album made from the query, without the network"""
+
+    def search(self, q: str, type: str, **kwargs):
+        if type == "album":
+            return {"albums": {"items": [{"uri": f"spotify:album:{q}"}]}}
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": q[-12:]},
+                    "uri": f"spotify:track:{q}",
+                    "artists": [{"uri": f"spotify:artist:{q}"}],
+                    "album": {"total_tracks": 10},
+                }]
+            }
+        }
+
+
+def measure(name: str, size: int, fn: Callable, memory: bool = True) -> BenchmarkResult:
+    """
+    Time fn, then run it again under tracemalloc for the peak memory (tracemalloc slows the run down
+    so is not timed). fn returns the number of rows processed
+    """
+    start = time.perf_counter()
+    rows = fn()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mb = peak / 1024 / 1024
+
+    return BenchmarkResult(name=name, size=size, rows=rows, seconds=seconds, peak_mb=peak_mb)
+
+
+def run_benchmarks(
+    root: Path, size: int, files: Optional[int], workers: int, memory: bool, faults: Optional[Faults] = None
+) -> List[BenchmarkResult]:
+    library_xml = generate_library(root, tracks=size, files=files)
+    config.PLAYLIST_PATH = library_xml.parent
+    results = []
+
+    for parser in ("stream", "itunesLibrary"):
+        results.append(
+            measure(
+                f"read_tracks_from_apple_library[{parser}]",
+                size,
+                lambda: len(DataExtractor(workers=workers).read_apple_library(parser=parser)[0]),
+                memory,
+            )
+        )
+
+    results.append(
+        measure(
+            "read_playlists_from_apple_library",
+            size,
+            lambda: len(DataExtractor(workers=workers).read_playlists_from_apple_library()),
+            memory,
+        )
+    )
+
+    def get_tags(extractor: DataExtractor) -> int:
+        return sum(
+            len(extractor._get_tags_from_music(root / folder)) for folder in ("Apple Music", "Music")
+        )
+
+    results.append(measure("_get_tags_from_music[serial]", size, lambda: get_tags(DataExtractor(workers=1)), memory))
+    if workers > 1:
+        # Memory of the pool workers is not traced
+        results.append(
+            measure(
+                f"_get_tags_from_music[{workers} workers]",
+                size,
+                lambda: get_tags(DataExtractor(workers=workers)),
+                memory=False,
+            )
+        )
+
+    def get_tags_pprint() -> int:
+        music_files = [
+            Path(file)
+            for folder in ("Apple Music", "Music")
+            for file in DataExtractor._scan_music_files(root / folder)
+        ]
+        for music_file in music_files:
+            DataExtractor._get_music_metadata_pprint(music_file)
+        return len(music_files)
+
+    results.append(measure("_get_music_metadata_pprint[serial]", size, get_tags_pprint, memory))
+
+    df_tracks, _ = DataExtractor(workers=workers).read_apple_library()
+    for compact in (False, True):
+        cleaner = DataCleaner(compact=compact)
+        results.append(
+            measure(
+                f"clean_itunes_data_round_1{'[compact]' if compact else ''}",
+                size,
+                lambda: len(cleaner.clean_itunes_data_round_1(df_tracks.copy())),
+                memory,
+            )
+        )
+
+    # Link once to fill the request history, then time linking with every search in the history
+    config.HISTORY_PATH = root
+    df_cleaned = DataCleaner().clean_itunes_data_round_1(df_tracks.copy())
+    linker = DataLinker(
+        FakeSpotify(),
+        rate_control=RateController(rate=1e9, max_rate=1e9, burst=1e9),
+        request_history=RequestHistory(root / "request_history.sqlite3"),
+    )
+    linker.extract_all_isrc_with_na(df_cleaned.copy())
+    results.append(
+        measure(
+            "extract_all_isrc_with_na[cached]",
+            size,
+            lambda: len(linker.extract_all_isrc_with_na(df_cleaned.copy())),
+            memory,
+        )
+    )
+    linker.request_history.close()
+
+    # Link (rounds 1 and 2) then load end to end through the local stand-in for the Spotify API, from an empty
+    # request history each run
+    with SpotifyStub(Catalog.from_synthetic(size), faults=faults) as stub:
+        linked = []
+
+        def link() -> int:
+            history = RequestHistory(root / f"stub_history_{len(linked)}.sqlite3")
+            linker = DataLinker(spotify_stub(stub.url), rate_control=RateController(rate=1e9, max_rate=1e9, burst=1e9),
+                                request_history=history)
+            cleaner = DataCleaner()
+            df = cleaner.clean_itunes_data_round_1(df_tracks.copy())
+            df = linker.extract_spotify_track_uri_by_isrc(df)
+            df = linker.extract_all_isrc_with_na(df)
+            df = linker.extract_spotify_album_uri(cleaner.clean_itunes_data_round_2(df))
+            history.close()
+            linked.append(df)
+            return len(df)
+
+        def load() -> int:
+            loader = DataLoader(spotify_stub(stub.url), rate_control=RateController(rate=1e9, max_rate=1e9, burst=1e9))
+            loader.add_albums_to_spotify(linked[-1])
+            loader.add_tracks_to_spotify(linked[-1])
+            return len(linked[-1])
+
+        results.append(measure("link[stub]", size, link, memory=False))
+        results.append(measure("load[stub]", size, load, memory=False))
+        logger.warning(f"Spotify stand-in requests {dict(stub.requests)}")
+
+    return results
+
+
+def report(results: List[BenchmarkResult]):
+    print(f"{'benchmark':<45} {'size':>8} {'rows':>8} {'seconds':>9} {'rows/s':>11} {'peak MB':>8}")
+    for result in results:
+        peak_mb = f"{result.peak_mb:8.1f}" if result.peak_mb is not None else f"{'-':>8}"
+        print(
+            f"{result.name:<45} {result.size:>8} {result.rows:>8} {result.seconds:>9.3f} "
+            f"{result.rows_per_second:>11.0f} {peak_mb}"
+        )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark extraction and cleaning")
+    parser.add_argument(
+        "--sizes", help="Library sizes in tracks", type=int, nargs="+", default=[1000, 10000]
+    )
+    parser.add_argument(
+        "--files",
+        help="Number of tagged media files per library (default all tracks)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--workers", help="Process pool size for tag reading", type=int, default=config.EXTRACT_WORKERS
+    )
+    parser.add_argument("--path", help="Folder for the synthetic libraries (default a temp folder)", type=Path)
+    parser.add_argument("--no-memory", help="Skip the peak memory runs", action="store_true")
+    parser.add_argument("--output", help="Write the results as json", type=Path)
+    parser.add_argument("--stub-latency", help="Seconds added to each Spotify stand-in response", type=float, default=0)
+    parser.add_argument("--stub-429", help="Share of Spotify stand-in requests answered 429", type=float, default=0)
+    parser.add_argument("--stub-5xx", help="Share of Spotify stand-in requests answered 503", type=float, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = get_parser().parse_args()
+    all_results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path = args.path or Path(tmp)
+        for library_size in args.sizes:
+            all_results.extend(
+                run_benchmarks(
+                    base_path / str(library_size),
+                    library_size,
+                    args.files,
+                    args.workers,
+                    memory=not args.no_memory,
+                    faults=Faults(
+                        latency=args.stub_latency, rate_429=args.stub_429, retry_after=0, rate_5xx=args.stub_5xx
+                    ),
+                )
+            )
+
+    report(all_results)
+
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                [{**asdict(result), "rows_per_second": result.rows_per_second} for result in all_results],
+                indent=2,
+            )
+        )
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import json
 import os
 from pathlib import Path
 
@@ -7,11 +8,103 @@ CHECKPOINTS_PATH = DATA_PATH / 'checkpoints'
 HISTORY_PATH = DATA_PATH / 'history'
 PLAYLIST_PATH = DATA_PATH / 'playlist'
 
+# Corrections applied to the spotify search columns during cleaning, see the dataclasses below
+CORRECTIONS_PATH = Path(__file__).parent / 'corrections.json'
+
 if os.name == 'nt':
     ITUNES_PATH = Path('Music/iTunes/iTunes Media')
 else:
     ITUNES_PATH = Path('Music/Music/Media.localized')
 
+# Tag extraction from the media folders is spread over a process pool, files are sent in batches
+EXTRACT_WORKERS = os.cpu_count() or 1
+EXTRACT_BATCH_SIZE = 64
+
+# Pickle the tracks and playlists parsed from Library.xml, keyed by the hash of the file
+CACHE_LIBRARY_XML = False
+
+# Library.xml parser, "stream" (iterparse, constant memory) or "itunesLibrary"
+LIBRARY_XML_PARSER = "stream"
+
+# Spotify searches run on a pool of threads, all sharing one rate controller (see rate_control.py)
+SPOTIFY_SEARCH_WORKERS = 8
+
+# Rate control for all Spotify calls. The rate starts at SPOTIFY_REQUESTS_PER_SECOND, increases by RATE_INCREASE
+# per second without a 429 and is multiplied by RATE_DECREASE on a 429, within RATE_MIN and RATE_MAX
+SPOTIFY_REQUESTS_PER_SECOND = 20
+RATE_MIN = 1
+RATE_MAX = 50
+RATE_INCREASE = 1
+RATE_DECREASE = 0.5
+RATE_BURST = 5
+# Transient errors are retried after a random wait of up to RATE_BACKOFF * 2 ** consecutive errors (capped)
+RATE_MAX_RETRIES = 5
+RATE_BACKOFF = 0.5
+RATE_MAX_BACKOFF = 30
+# After RATE_BREAKER_ERRORS consecutive errors all callers pause for RATE_BREAKER_PAUSE seconds
+RATE_BREAKER_ERRORS = 5
+RATE_BREAKER_PAUSE = 30
+
+# Failed searches in the request history are retried once their TTL expires, the TTL doubling with each attempt
+# up to HISTORY_MAX_TTL. Searches with no result start at HISTORY_FAILURE_TTL and are not retried after
+# HISTORY_MAX_ATTEMPTS, errors (429, 5xx, no connection) start at HISTORY_TRANSIENT_TTL. Seconds
+HISTORY_FAILURE_TTL = 30 * 24 * 60 * 60
+HISTORY_TRANSIENT_TTL = 60 * 60
+HISTORY_MAX_TTL = 365 * 24 * 60 * 60
+HISTORY_MAX_ATTEMPTS = 5
+# Failures kept, the least recently failed are evicted beyond this
+HISTORY_MAX_FAILURES = 100000
+# Searches are committed to the request history every HISTORY_FLUSH_REQUESTS results or HISTORY_FLUSH_SECONDS,
+# an interrupted run resumes from there (main.py --resume)
+HISTORY_FLUSH_REQUESTS = 500
+HISTORY_FLUSH_SECONDS = 30
+
+# Share the request history between users and machines through Redis, e.g. redis://localhost:6379/0. Set
+# REDIS_URL in the environment or .env. Entries expire after REDIS_TTL seconds, searches with no result after
+# HISTORY_FAILURE_TTL
+REDIS_URL = None
+REDIS_TTL = 90 * 24 * 60 * 60
+REDIS_PREFIX = "itunes-spotify:"
+REDIS_BATCH_SIZE = 1000
+REDIS_TIMEOUT = 2
+
+# Send all Spotify calls to the local stand-in for the API (spotify_stub.py), e.g. http://127.0.0.1:8787/v1/. Set
+# SPOTIFY_STUB_URL in the environment or .env
+SPOTIFY_STUB_URL = None
+
+# Album first linking, rows of an album with at least ALBUM_FIRST_MIN_TRACKS rows to link are matched to the
+# album's tracklist, about 3 calls an album instead of a search per track. The rest are searched per track
+LINK_ALBUMS_FIRST = False
+ALBUM_FIRST_MIN_TRACKS = 4
+# Artist catalog linking, rows of an artist with at least ARTIST_CATALOG_MIN_TRACKS rows to link are matched to
+# the artist's albums, fetched once and kept in the request history. Runs before album first linking
+LINK_ARTIST_CATALOGS = False
+ARTIST_CATALOG_MIN_TRACKS = 50
+
+# Batch mode (batch.py), a folder for each user in BATCH_USERS_PATH with their Library.xml and Spotify token cache
+# (BATCH_TOKEN_CACHE). Users' libraries are loaded into Spotify on BATCH_LOAD_WORKERS threads
+BATCH_USERS_PATH = DATA_PATH / 'users'
+BATCH_TOKEN_CACHE = '.cache'
+BATCH_LOAD_WORKERS = 4
+
+# Scored matching, search for SCORED_CANDIDATES candidates and keep the best scoring, weighing title similarity,
+# artist overlap, year and album track count (SCORED_WEIGHTS), instead of the first hit. Below SCORED_THRESHOLD the
+# search is relaxed, without the year, then brackets, then secondary artists. Results are kept in the request
+# history apart from first hit results, so turning it on searches again once
+LINK_SCORED = False
+SCORED_CANDIDATES = 10
+SCORED_THRESHOLD = 0.75
+SCORED_WEIGHTS = {"title": 0.5, "artist": 0.3, "year": 0.1, "track_count": 0.1}
+
+# Compact mode, keep the text columns as categoricals sharing one dictionary of values through cleaning,
+# linking and the checkpoints. Groupbys and merges on them work on integer codes
+COMPACT_MODE = False
+COMPACT_COLUMNS = (
+    "track_name", "artist", "album", "album_artist", "playlist_name", "spotify_search_track_name",
+    "spotify_search_artist", "spotify_search_album", "spotify_track_uri", "spotify_artist_uri",
+    "spotify_album_uri", "isrc",
+)
+
 playlists_exclude = (
     "Library", "Downloaded", "Music", "All Music", "90’s Music", "Classical Music", "Music Videos",
     "Playlist", "Recently Played", "Top 25 Most Played", "Album Artwork Screen Saver", "Repeats"
@@ -50,20 +143,6 @@ class SpotifyTrackName:
     to_spotify_search_track_name: str
 
 
-track_updates = [
-    SpotifyTrackName(
-        artist="Faithless",
-        from_spotify_search_track_name="Miss You Less, See You More",
-        to_spotify_search_track_name="Miss U Less, See U More",
-    ),
-    SpotifyTrackName(
-        artist="Faithless",
-        from_spotify_search_track_name="Muhammed Ali",
-        to_spotify_search_track_name="Muhammad Ali",
-    ),
-]
-
-
 @dataclass
 class SpotifyTrackNameByContentId:
     """
@@ -74,60 +153,12 @@ class SpotifyTrackNameByContentId:
     to_spotify_search_track_name: str
 
 
-track_updates_by_content_id = [
-    SpotifyTrackNameByContentId(
-        content_id='1485137457',
-        to_spotify_search_track_name="The Last Time",
-    ),
-]
-
-
 @dataclass
 class SpotifyAlbum:
     from_spotify_search_album: str
     to_spotify_search_album: str
 
 
-album_updates = [
-    SpotifyAlbum(
-        from_spotify_search_album='Coco Part 1',
-        to_spotify_search_album='Coco, Pt. 1'
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album='Coco Part 2',
-        to_spotify_search_album='Coco, Pt. 2'
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album='The Princess: The Vinyl Collection 2010 - 2012',
-        to_spotify_search_album='The Princess, Pt. Two'
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album="Live At St. Annes Warehouse",
-        to_spotify_search_album="Live At St. Anns Warehouse"
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album="Paint The Sky With Stars: The Best Of Enya",
-        to_spotify_search_album="Paint The Sky With Stars"
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album="Superior You Are Inferior",
-        to_spotify_search_album="Superioryouareinferior"
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album=" Morning Glory?",
-        to_spotify_search_album="(Whats The Story) Morning Glory?"
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album="Keren Ann 2007",
-        to_spotify_search_album="Keren Ann"
-    ),
-    SpotifyAlbum(
-        from_spotify_search_album="Songs in the Key of Life - Disc 2",
-        to_spotify_search_album="Songs in the Key of Life"
-    ),
-]
-
-
 # A set of albums to ignore (as they're being incorrectly requested, many soundtracks)
 albums_ignore = {'Folk Tunes, Vol. 2', 'Virus', 'Woman II', 'Chilled Euphoria',
                  'Pump Up The Volume', 'In The Name Of The Father', 'Reality Bites',
@@ -146,8 +177,23 @@ class SpotifyArtist:
     to_spotify_search_artist: str
 
 
-artist_updates = [
-    SpotifyArtist(
-        from_spotify_search_artist="The London Suede", to_spotify_search_artist="Suede",
-    ),
-]
+def load_corrections(path: Path = CORRECTIONS_PATH) -> dict:
+    """Load the correction tables from the json data file into their dataclasses"""
+    with open(path, encoding='utf-8') as fh:
+        corrections = json.load(fh)
+
+    return {
+        'artist_updates': [SpotifyArtist(**rule) for rule in corrections.get('artist_updates', [])],
+        'track_updates': [SpotifyTrackName(**rule) for rule in corrections.get('track_updates', [])],
+        'track_updates_by_content_id': [
+            SpotifyTrackNameByContentId(**rule) for rule in corrections.get('track_updates_by_content_id', [])
+        ],
+        'album_updates': [SpotifyAlbum(**rule) for rule in corrections.get('album_updates', [])],
+    }
+
+
+_corrections = load_corrections()
+artist_updates = _corrections['artist_updates']
+track_updates = _corrections['track_updates']
+track_updates_by_content_id = _corrections['track_updates_by_content_id']
+album_updates = _corrections['album_updates']
@@ -1,14 +1,46 @@
 import logging
+import os
+from pathlib import Path
+from typing import Optional
 
 from dotenv import load_dotenv
+import requests
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 
+import config
+
 logger = logging.getLogger(__name__)
 # Load the Spotify env variables from .env
 load_dotenv()
 
 
+def _requests_session() -> requests.Session:
+    """
+    A session without spotipy's urllib3 retries, so 429 responses and their Retry-After header reach the rate
+    controller (rate_control.py) which retries them. Pooled connections for each search worker
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.SPOTIFY_SEARCH_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _stub_url() -> Optional[str]:
+    return os.environ.get("SPOTIFY_STUB_URL", config.SPOTIFY_STUB_URL)
+
+
+def spotify_stub(url: str, token: str = "stub") -> spotipy.Spotify:
+    """
+    A client of the local stand-in for the Spotify API (spotify_stub.py) at url, no authorization flow. The token
+    names the user
+    """
+    sp = spotipy.Spotify(auth=token, requests_session=_requests_session())
+    sp.prefix = url
+    return sp
+
+
 def spotify_get() -> spotipy.Spotify:
     """
     Spotify's Client Credentials Flow - used when we search.
@@ -17,17 +49,24 @@ def spotify_get() -> spotipy.Spotify:
     The advantage here in comparison with requests to the Web API made without an access token,
     is that a higher rate limit is applied
     """
+    if _stub_url():
+        return spotify_stub(_stub_url())
+
     auth_manager = SpotifyClientCredentials()
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=_requests_session())
     return sp
 
 
-def spotify_post() -> spotipy.Spotify:
+def spotify_post(cache_path: Optional[Path] = None) -> spotipy.Spotify:
     """
     Function with spotify authentication for changing a users details, e.g. adding tracks,
-    creating playlists etc
+    creating playlists etc. cache_path, the user's token cache (default .cache), see batch.py
     """
+    if _stub_url():
+        return spotify_stub(_stub_url(), token="stub" if cache_path is None else Path(cache_path).parent.name)
+
     scope = ["user-library-read", "user-library-modify", "playlist-modify-public"]
 
-    sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope))
+    auth_manager = SpotifyOAuth(scope=scope, cache_path=None if cache_path is None else str(cache_path))
+    sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=_requests_session())
     return sp
@@ -1,5 +1,6 @@
 import logging
-from typing import List
+import re
+from typing import Callable, Dict, Hashable, Iterable, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -11,14 +12,19 @@ from config import (
     SpotifyAlbum,
 )
 import config
+import utils
 
 logger = logging.getLogger(__name__)
 
+# Contents of square and round brackets, with the preceding whitespace
+BRACKETS = re.compile(r"\s?\[.+\]|\s?\(.+\)")
+
 
 class DataCleaner:
-    def __init__(self):
+    def __init__(self, compact: bool = config.COMPACT_MODE):
         self.CHARACTERS_REMOVE = "'`´’"
         self.ARTIST_DELIMITERS = [" Feat.", " &", " With"]
+        self.compact = compact  # Return frames with categorical text columns, see utils.to_compact
 
     @staticmethod
     def _combine_extracted_dataframes(df_apple, df_external) -> pd.DataFrame:
@@ -49,19 +55,21 @@ class DataCleaner:
         df = df.drop(columns=["xid"])
         return df
 
-    @staticmethod
-    def _create_spotify_columns(df: pd.DataFrame) -> pd.DataFrame:
+    def _create_spotify_columns(self, df: pd.DataFrame) -> pd.DataFrame:
         """Create new columns for searching spotify"""
         logger.info("Create new columns for searching spotify")
-        df.loc[:, "spotify_search_track_name"] = df.loc[:, "track_name"]
-        df.loc[:, "spotify_search_artist"] = df.loc[:, "artist"]
-        df.loc[:, "spotify_search_album"] = df.loc[:, "album"]
+        # Extraction types names as category and string, the search columns are edited so are kept as object
+        df.loc[:, "spotify_search_track_name"] = utils.as_object(df.loc[:, "track_name"])
+        df.loc[:, "spotify_search_artist"] = utils.as_object(df.loc[:, "artist"])
+        df.loc[:, "spotify_search_album"] = utils.as_object(df.loc[:, "album"])
         df.loc[:, "spotify_track_uri"] = np.nan
         df.loc[:, "spotify_artist_uri"] = np.nan
         df.loc[:, "spotify_album_uri"] = np.nan
         df.loc[:, "spotify_release_year"] = df.loc[:, "release_date"]
         df.loc[:, "spotify_total_tracks"] = 0
-        df.loc[:, "isrc"] = np.nan
+        if "isrc" not in df.columns:
+            # Kept when set from xid by _set_isrc, these rows are linked by ISRC
+            df.loc[:, "isrc"] = np.nan
         df.loc[:, "album_artist"] = np.nan
         df.loc[:, "content_id"] = np.nan
         return df
@@ -75,39 +83,73 @@ class DataCleaner:
         logger.info(
             f"Spotify handling - Remove {self.CHARACTERS_REMOVE} from artists & track names"
         )
-        track_name_exists = ~df["spotify_search_track_name"].isna()
-        artist_exists = ~df["spotify_search_artist"].isna()
-        album_exists = ~df["spotify_search_album"].isna()
+        remove = str.maketrans("", "", self.CHARACTERS_REMOVE)
 
-        for char in self.CHARACTERS_REMOVE:
-            df.loc[track_name_exists, "spotify_search_track_name"] = df.loc[
-                track_name_exists, "spotify_search_track_name"
-            ].apply(lambda x: x.replace(char, ""))
+        for column in ("spotify_search_track_name", "spotify_search_artist", "spotify_search_album"):
+            df.loc[:, column] = [
+                value.translate(remove) if isinstance(value, str) else value
+                for value in df[column]
+            ]
 
-            df.loc[artist_exists, "spotify_search_artist"] = df.loc[
-                artist_exists, "spotify_search_artist"
-            ].apply(lambda x: x.replace(char, ""))
+        return df
 
-            df.loc[album_exists, "spotify_search_album"] = df.loc[
-                album_exists, "spotify_search_album"
-            ].apply(lambda x: x.replace(char, ""))
+    def _normalize_spotify_search_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Normalize the spotify search columns in a single pass over the rows of each column, see _clean_values.
+        Same result as _set_spotify_release_year, _clean_brackets_from_spotify_search_fields,
+        _clean_brackets_from_spotify_search_album, _remove_characters and _split_artists_keep_first_only
+        applied in that order:
+         - track name: brackets cleaned, characters removed
+         - album: brackets cleaned, characters removed
+         - artist: characters removed, split keeping the first artist
+         - release year: YYYY where release_date is longer than 4 characters
+        """
+        logger.info("Normalize spotify search columns")
+        remove = str.maketrans("", "", self.CHARACTERS_REMOVE)
+
+        df["spotify_search_track_name"] = self._clean_values(
+            df["spotify_search_track_name"], lambda s: self._clean_brackets(s).str.translate(remove)
+        )
+        df["spotify_search_album"] = self._clean_values(
+            df["spotify_search_album"], lambda s: self._clean_brackets(s).str.translate(remove)
+        )
+        df["spotify_search_artist"] = self._clean_values(
+            df["spotify_search_artist"], lambda s: self._first_artist(s.str.translate(remove))
+        )
+        df["spotify_release_year"] = self._clean_values(
+            df["release_date"], lambda s: s.where(~(s.str.len() > 4), s.str.split("-", n=1).str[0])
+        )
 
         return df
 
+    @staticmethod
+    def _clean_values(s: pd.Series, clean: Callable[[pd.Series], pd.Series]) -> pd.Series:
+        """
+        Clean the values of a column in one pass over its rows. The rows are factorized, the vectorized string
+        operations of clean run once on the distinct values and the cleaned values are taken back to the rows
+        """
+        codes, distinct = pd.factorize(s)
+        cleaned = clean(pd.Series(distinct, dtype=object)).to_numpy(dtype=object)
+        # Missing values have the code -1, the NaN appended
+        return pd.Series(np.append(cleaned, np.nan)[codes], index=s.index, dtype=object)
+
+    @staticmethod
+    def _clean_brackets(s: pd.Series) -> pd.Series:
+        return s.str.replace(BRACKETS, "", regex=True)
+
+    def _first_artist(self, s: pd.Series) -> pd.Series:
+        delimiters = "|".join(re.escape(delimiter) for delimiter in self.ARTIST_DELIMITERS)
+        return s.str.split(delimiters, n=1, regex=True).str[0]
+
     @staticmethod
     def _remove_duplicates(df: pd.DataFrame) -> pd.DataFrame:
         logger.info("Remove duplicates")
-        df = df.drop_duplicates(
-            subset=[
-                "track_name",
-                "artist",
-                "release_date",
-                "album",
-            ],
-            keep="first",
-        )
-        df = df.set_index(["track_name", "artist", "release_date", "album"])
-        df = df.reset_index()
+        keys = ["track_name", "artist", "release_date", "album"]
+        df = df.drop_duplicates(subset=keys, keep="first")
+
+        # Key columns first with a new index, as set_index(keys).reset_index() without building the MultiIndex
+        columns = keys + [column for column in df.columns if column not in keys]
+        df = df.reindex(columns=columns).reset_index(drop=True)
         return df
 
     @staticmethod
@@ -140,33 +182,66 @@ class DataCleaner:
         Split on a list of delimiters, keep only the first artist
         """
         logger.info("Spotify handling, split artists keeping only the first")
-        df_isrc_na = df[
-            ((df.loc[:, "isrc"].isna()) & (~df.loc[:, "spotify_search_artist"].isna()))
-        ]
+        df_artists = df[~df.loc[:, "spotify_search_artist"].isna()]
 
         for delimiter in self.ARTIST_DELIMITERS:
-            df_isrc_na.loc[:, "spotify_search_artist"] = df_isrc_na.loc[
+            df_artists.loc[:, "spotify_search_artist"] = df_artists.loc[
                 :, "spotify_search_artist"
             ].apply(lambda x: x.split(delimiter)[0])
 
-            df.update(df_isrc_na)
+            df.update(df_artists)
 
         return df
 
+    @staticmethod
+    def _compile_updates(updates: Iterable[Tuple[Hashable, Hashable]]) -> Dict:
+        """
+        Compile (from, to) rules applied one after another into a single from: final value lookup.
+        Walking the rules backwards, a rule's target is itself looked up in the rules after it, so chained
+        rules (a -> b, b -> c) resolve to the final value and a repeated from keeps its first rule, as when
+        each rule was applied to the frame in turn.
+        """
+        lookup = {}
+        for from_value, to_value in reversed(list(updates)):
+            lookup[from_value] = lookup.get(to_value, to_value)
+
+        return lookup
+
+    @staticmethod
+    def _set_values(df: pd.DataFrame, mask: pd.Series, column: str, values) -> pd.DataFrame:
+        """Set column to values where mask, the column becomes object if it can not hold text (e.g. all na)"""
+        if df[column].dtype != object:
+            df[column] = df[column].astype(object)
+
+        df.loc[mask, column] = values
+        return df
+
+    @staticmethod
+    def _apply_lookup(df: pd.DataFrame, column: str, lookup: Dict) -> pd.DataFrame:
+        """
+        Replace the values of column found in lookup, in one vectorized pass. A categorical column
+        (compact mode) has its categories mapped instead
+        """
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = utils.map_categories(df[column], lookup)
+            return df
+
+        mask = df[column].isin(list(lookup))
+        if not mask.any():
+            return df
+
+        return DataCleaner._set_values(df, mask, column, df.loc[mask, column].map(lookup))
+
     @staticmethod
     def _update_spotify_albums(
         df: pd.DataFrame, album_updates: List[SpotifyAlbum]
     ) -> pd.DataFrame:
         """Update value in to_spotify_search_album"""
-        for column_map in album_updates:
-            df_album = df[
-                df.loc[:, "spotify_search_album"]
-                == column_map.from_spotify_search_album
-            ]
-            df_album.loc[:, "spotify_search_album"] = column_map.to_spotify_search_album
-            df.update(df_album)
-
-        return df
+        lookup = DataCleaner._compile_updates(
+            (column_map.from_spotify_search_album, column_map.to_spotify_search_album)
+            for column_map in album_updates
+        )
+        return DataCleaner._apply_lookup(df, "spotify_search_album", lookup)
 
     @staticmethod
     def _should_add_album(df: pd.DataFrame) -> pd.DataFrame:
@@ -175,7 +250,7 @@ class DataCleaner:
         Set to True if the number of tracks in the library equals the number of tracks
         on the album.
         """
-        s_track_count = df.groupby(by="spotify_search_album")["track_name"].count()
+        s_track_count = df.groupby(by="spotify_search_album", observed=True)["track_name"].count()
         df_track_count = pd.DataFrame(s_track_count)
         df_track_count = df_track_count.rename(
             columns={"track_name": "library_total_tracks"}
@@ -214,39 +289,41 @@ class DataCleaner:
         df: pd.DataFrame, artist_updates: List[SpotifyArtist]
     ) -> pd.DataFrame:
         """Update value in to_spotify_search_artist"""
-        for column_map in artist_updates:
-            df_artist = df[
-                df.loc[:, "spotify_search_artist"]
-                == column_map.from_spotify_search_artist
-            ]
-            df_artist.loc[
-                :, "spotify_search_artist"
-            ] = column_map.to_spotify_search_artist
-            df.update(df_artist)
-
-        return df
+        lookup = DataCleaner._compile_updates(
+            (column_map.from_spotify_search_artist, column_map.to_spotify_search_artist)
+            for column_map in artist_updates
+        )
+        return DataCleaner._apply_lookup(df, "spotify_search_artist", lookup)
 
     @staticmethod
     def _update_spotify_tracks(
         df: pd.DataFrame, track_updates: List[SpotifyTrackName]
     ) -> pd.DataFrame:
-        """Update value in spotify_search_artist. As song names can be shared we also match on artist"""
-        for column_map in track_updates:
-            df_track = df[
-                (
-                    (
-                        df.loc[:, "spotify_search_track_name"]
-                        == column_map.from_spotify_search_track_name
-                    )
-                    & (df.loc[:, "artist"] == column_map.artist)
-                )
-            ]
-            df_track.loc[
-                :, "spotify_search_track_name"
-            ] = column_map.to_spotify_search_track_name
-            df.update(df_track)
+        """
+        Update value in spotify_search_track_name. As song names can be shared we also match on artist,
+        the rules are compiled to a lookup keyed on (artist, spotify_search_track_name)
+        """
+        lookup = DataCleaner._compile_updates(
+            (
+                (column_map.artist, column_map.from_spotify_search_track_name),
+                (column_map.artist, column_map.to_spotify_search_track_name),
+            )
+            for column_map in track_updates
+        )
+        if not lookup:
+            return df
 
-        return df
+        artist_mask = df["artist"].isin({artist for artist, _ in lookup})
+        if not artist_mask.any():
+            return df
+
+        track_names = [
+            lookup.get(key, key)[1]
+            for key in zip(
+                df.loc[artist_mask, "artist"], df.loc[artist_mask, "spotify_search_track_name"]
+            )
+        ]
+        return DataCleaner._set_values(df, artist_mask, "spotify_search_track_name", track_names)
 
     @staticmethod
     def _update_spotify_tracks_by_content_id(
@@ -254,35 +331,31 @@ class DataCleaner:
     ) -> pd.DataFrame:
         """
         Update value in spotify_search_track_name by content_id. Handles case where metadata is missing the
-        track_name
+        track_name. When a content_id has several rules the last one is applied
         """
-        for column_map in track_updates:
-            df_track = df[df.loc[:, "content_id"] == column_map.content_id]
-            df_track.loc[
-                :, "spotify_search_track_name"
-            ] = column_map.to_spotify_search_track_name
-            df.update(df_track)
+        lookup = {
+            column_map.content_id: column_map.to_spotify_search_track_name
+            for column_map in track_updates
+        }
+        mask = df["content_id"].isin(list(lookup))
+        if not mask.any():
+            return df
 
-        return df
+        return DataCleaner._set_values(
+            df, mask, "spotify_search_track_name", df.loc[mask, "content_id"].map(lookup)
+        )
 
     @staticmethod
     def _clean_brackets_from_spotify_search_fields(df: pd.DataFrame) -> pd.DataFrame:
         """
         Meta data for track names which are missing isrc's appear to have a pattern, where
         spotify does not match the contents inside [] and (). Workaround is to remove the contents.
-        Only apply to spotify_search_track_name with missing ISRC
+        Rows with an ISRC are cleaned too, they are searched with isrc: and the search columns only used
+        when it is not found, by round 2 and by the corrections
         """
-        df_isrc_na = df[df.loc[:, "isrc"].isna()]
-        if len(df_isrc_na) == 0:
-            return df
-
-        columns = ("spotify_search_track_name",)
-        for column in columns:
-            df_isrc_na.loc[:, column] = df_isrc_na.loc[:, column].replace(
-                r"\s?\[.+\]|\s?\(.+\)", "", regex=True
-            )
-
-        df.update(df_isrc_na)
+        df.loc[:, "spotify_search_track_name"] = df.loc[:, "spotify_search_track_name"].replace(
+            BRACKETS, "", regex=True
+        )
 
         return df
 
@@ -292,7 +365,7 @@ class DataCleaner:
         Clean brackets contents, square and round from spotify_search_album
         """
         df.loc[:, "spotify_search_album"] = df.loc[:, "spotify_search_album"].replace(
-            r"\s?\[.+\]|\s?\(.+\)", "", regex=True
+            BRACKETS, "", regex=True
         )
         return df
 
@@ -300,10 +373,15 @@ class DataCleaner:
     def _add_spotify_track_uri_to_playlist(
         df_playlist: pd.DataFrame, df_tracks: pd.DataFrame
     ) -> pd.DataFrame:
-        """Combine the playlist dataframe with spotify_track_uri"""
+        """
+        Combine the playlist dataframe with spotify_track_uri. Compact frames are first given the same
+        dictionary so the merge keys stay categorical
+        """
         df_tracks = df_tracks.loc[
             :, ["album", "artist", "track_name", "spotify_track_uri"]
         ]
+        if any(isinstance(dtype, pd.CategoricalDtype) for dtype in df_tracks.dtypes):
+            df_playlist, df_tracks = utils.to_compact([df_playlist, df_tracks])
 
         df_playlist = df_playlist.merge(
             df_tracks,
@@ -327,12 +405,8 @@ class DataCleaner:
         df = self._set_isrc(df)
         df = self._create_spotify_columns(df)
         df = self._set_artist_where_na(df)
-        df = self._set_spotify_release_year(df)
-        df = self._clean_brackets_from_spotify_search_fields(df)
-        df = self._clean_brackets_from_spotify_search_album(df)
-        df = self._remove_characters(df)
         df = self._remove_duplicates(df)
-        df = self._split_artists_keep_first_only(df)
+        df = self._normalize_spotify_search_columns(df)
 
         # updates artists and tracks according to the values specified in config.
         df = self._update_spotify_artists(df, config.artist_updates)
@@ -340,22 +414,31 @@ class DataCleaner:
         df = self._update_spotify_tracks_by_content_id(
             df, config.track_updates_by_content_id
         )
+        # Albums too, album first linking searches them before round 2
+        df = self._update_spotify_albums(df, config.album_updates)
 
-        return df
+        return self._compact(df)
 
     def clean_itunes_data_round_2(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         This round of cleaning occurs after spotify extraction. This is to allow the number of spotify tracks
-        on an album to be used to figure out if a number of tracks is an album. Update album also kept here
-        for shorter re-runs
+        on an album to be used to figure out if a number of tracks is an album. Update album, also applied in
+        round 1, kept here for shorter re-runs from the linking checkpoint
         """
         df = self._update_spotify_albums(df, config.album_updates)
         df = self._should_add_album(df)
 
-        return df
+        return self._compact(df)
 
     def clean_itunes_playlist(
         self, df_playlist: pd.DataFrame, df_tracks: pd.DataFrame
     ) -> pd.DataFrame:
         df_playlist = self._add_spotify_track_uri_to_playlist(df_playlist, df_tracks)
-        return df_playlist
+        return self._compact(df_playlist)
+
+    def _compact(self, df: pd.DataFrame) -> pd.DataFrame:
+        """In compact mode convert the text columns to categoricals sharing one dictionary"""
+        if not self.compact:
+            return df
+
+        return utils.to_compact([df])[0]
@@ -1,33 +1,32 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import getpass
+import hashlib
 import logging
 import os
 from pathlib import Path
-from typing import Dict, List
+import re
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import xml.etree.ElementTree as ET
 
 
-from dotenv import load_dotenv
 from itunesLibrary import library
 import mutagen
+from mutagen import id3, mp4
+import numpy as np
 import pandas as pd
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 
 import config
+import utils
+from utils import chunked
 
 logger = logging.getLogger(__name__)
-load_dotenv()
-client_id = os.getenv("CLIENT_ID")
-client_secret = os.getenv("CLIENT_SECRET")
-
-auth_manager = SpotifyClientCredentials(
-    client_id=client_id, client_secret=client_secret
-)
-sp = spotipy.Spotify(auth_manager=auth_manager)
 
 
 class DataExtractor:
-    # This mapping consolidates the 3 formats
-    meta_tag_map = {
+    # These mappings consolidate the 3 formats
+    mp4_tag_map = {
         # m4p Mappings
         "cnID": "content_id",
         "soal": "album",
@@ -43,6 +42,8 @@ class DataExtractor:
         "©alb": "album",
         "©nam": "track_name",
         "©wrt": "composer",
+    }
+    id3_tag_map = {
         # mp3 Mappings
         "TALB": "album",
         "TDRC": "release_date",
@@ -51,9 +52,18 @@ class DataExtractor:
         "TPE2": "composer",
         "TPOS": "track_number",
     }
+    meta_tag_map = {**mp4_tag_map, **id3_tag_map}
+    mp4_atoms = frozenset(tag.encode("latin-1") for tag in mp4_tag_map)
+
+    music_suffixes = (".m4p", ".m4a", ".mp3", ".MP3")
 
-    def __init__(self, mode="PROD"):
+    def __init__(
+        self, mode="PROD", workers: int = config.EXTRACT_WORKERS, incremental: bool = True
+    ):
         self.mode = mode
+        self.workers = workers
+        self.incremental = incremental
+        self._apple_library = {}  # (path, size, mtime): (tracks, playlists)
         if self.mode == "TEST":
             self.MUSIC_PATH_APPLE = "src/spotify/.data/apple"
             self.MUSIC_PATH_LOCAL = "src/spotify/.data/external"
@@ -74,18 +84,90 @@ class DataExtractor:
             f" Non Apple path: {self.MUSIC_PATH_LOCAL}"
         )
 
+        manifest = ExtractionManifest.load() if self.incremental else ExtractionManifest()
+
         path_apple = Path(f"/Users/{self.user}") / self.MUSIC_PATH_APPLE
-        apple_music_tracks = self._get_tags_from_music(path_apple)
-        df_apple = pd.DataFrame(apple_music_tracks)
+        apple_music_tracks = self._get_tags_from_music(path_apple, manifest)
+        df_apple = ColumnarFrameBuilder.from_records(apple_music_tracks)
 
         path_local = Path(f"/Users/{self.user}") / self.MUSIC_PATH_LOCAL
-        local_tracks = self._get_tags_from_music(path_local)
-        df_loaded = pd.DataFrame(local_tracks)
+        local_tracks = self._get_tags_from_music(path_local, manifest)
+        df_loaded = ColumnarFrameBuilder.from_records(local_tracks)
+
+        logger.info(
+            f"Extraction manifest: {manifest.reused} files unchanged, {manifest.read} files read, "
+            f"{manifest.removed} files removed"
+        )
+        manifest.save()
 
         return df_apple, df_loaded
 
     @staticmethod
     def _get_music_metadata(track: Path) -> Dict:
+        """Read the mapped tags from the mp4 (m4a, m4p) or id3 (mp3) tags, the audio stream is not read"""
+        if track.suffix.lower() == ".mp3":
+            return DataExtractor._get_id3_metadata(track)
+
+        return DataExtractor._get_mp4_metadata(track)
+
+    @staticmethod
+    def _get_mp4_metadata(track: Path) -> Dict:
+        """
+        Only the atoms in mp4_tag_map are read from the ilst atom, artwork and lyrics are skipped.
+        Values are rendered as pprint did, the last value of a tag and repr for non text values.
+        Where several tags map to the same key the last tag in sorted order wins.
+        """
+        track_details = {}
+
+        with open(track, "rb") as fileobj:
+            try:
+                atoms = mp4.Atoms(fileobj)
+                ilst = atoms.path(b"moov", b"udta", b"meta", b"ilst")[-1]
+            except (mp4.error, KeyError):
+                return track_details
+
+            ilst.children = [atom for atom in ilst.children if atom.name in DataExtractor.mp4_atoms]
+            tags = mp4.MP4Tags(atoms, fileobj)
+
+        for tag in sorted(tags.keys()):
+            if tag not in DataExtractor.mp4_tag_map:
+                continue
+
+            value = tags[tag]
+            if isinstance(value, list):
+                value = value[-1]
+
+            key = DataExtractor.mp4_tag_map[tag]
+            track_details[key] = value if isinstance(value, str) else repr(value)
+
+        return track_details
+
+    @staticmethod
+    def _get_id3_metadata(track: Path) -> Dict:
+        """Only the frames in id3_tag_map are rendered, multiple values are joined with " / " as pprint did"""
+        track_details = {}
+
+        try:
+            tags = id3.ID3(track)
+        except id3.ID3NoHeaderError:
+            return track_details
+
+        for tag in sorted(DataExtractor.id3_tag_map):
+            frame = tags.get(tag)
+            if frame is None:
+                continue
+
+            key = DataExtractor.id3_tag_map[tag]
+            track_details[key] = " / ".join(str(text) for text in frame.text)
+
+        return track_details
+
+    @staticmethod
+    def _get_music_metadata_pprint(track: Path) -> Dict:
+        """
+        Previous reader rendering every tag with pprint and parsing the text.
+        Kept as the reference for tests and the benchmark
+        """
         track_details = {}
         audio = mutagen.File(track)
         text = audio.pprint()
@@ -99,25 +181,141 @@ class DataExtractor:
 
         return track_details
 
-    def _get_tags_from_music(self, path: Path) -> List[Dict]:
-        """Apple music has more tags (with the xid) than copied music"""
+    @staticmethod
+    def _scan_music_files(path: Path) -> Iterator[str]:
+        """
+        Walk the media folder with os.scandir filtering on suffix as we go. Files in a folder are
+        yielded before descending into its sub folders (same order as path.rglob)
+        """
+        sub_folders = []
+
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_folders.append(entry.path)
+            elif entry.name.endswith(DataExtractor.music_suffixes):
+                yield entry.path
+
+        for folder in sub_folders:
+            yield from DataExtractor._scan_music_files(Path(folder))
+
+    def _get_tags_from_music(
+        self, path: Path, manifest: Optional["ExtractionManifest"] = None
+    ) -> List[Dict]:
+        """
+        Apple music has more tags (with the xid) than copied music.
+        Files with the same size and mtime as in the manifest reuse the recorded tags, the
+        remaining files are read and recorded. Records are returned in the walk order.
+        """
+        if manifest is None:
+            manifest = ExtractionManifest()
+
+        files = list(self._scan_music_files(path))
+        records = {}
+        files_to_read = []
+
+        for file in files:
+            stat = os.stat(file)
+            record = manifest.get(file, stat.st_size, stat.st_mtime_ns)
+
+            if record is None:
+                files_to_read.append((file, stat.st_size, stat.st_mtime_ns))
+            else:
+                records[file] = record
+
+        logger.info(
+            f"Reading tags from {len(files_to_read)} of {len(files)} files in {path}"
+        )
+        tracks_read = self._read_tags([file for file, _, _ in files_to_read])
+
+        for (file, size, mtime), record in zip(files_to_read, tracks_read):
+            manifest.add(file, size, mtime, record)
+            records[file] = record
+
+        return [records[file] for file in files]
+
+    def _read_tags(self, files: List[str]) -> List[Dict]:
+        """
+        Read the tags of each file. Tags are read in batches by a process pool when more
+        than one worker is configured, records are returned in the same order as the files.
+        """
+        if self.workers <= 1 or len(files) <= config.EXTRACT_BATCH_SIZE:
+            return _get_tags_from_files(files)
+
+        batches = chunked(files, config.EXTRACT_BATCH_SIZE)
         tracks = []
 
-        for item in path.rglob("*.*"):
-            if item.suffix in [".m4p", ".m4a", ".mp3", ".MP3"]:
-                track_tags = self._get_music_metadata(item)
-                logger.debug(item.name)
-                tracks.append(track_tags)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for batch_tracks in executor.map(_get_tags_from_files, batches):
+                tracks.extend(batch_tracks)
 
         return tracks
 
-    @staticmethod
-    def read_playlists_from_apple_library(
+    def read_apple_library(
+        self,
         filename: str = "Library.xml",
-    ) -> pd.DataFrame:
-        """Read apple xml file, extract playlists and return as a dataframe"""
-        lib = library.parse(config.PLAYLIST_PATH / filename, ignoreRemoteSongs=False)
-        playlists = []
+        cache: bool = config.CACHE_LIBRARY_XML,
+        parser: str = config.LIBRARY_XML_PARSER,
+        path: Optional[Path] = None,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Read apple xml file once and return the tracks and playlists dataframes.
+        The result is kept for the life of the extractor, so extracting tracks then playlists
+        only parses the file once. With cache set the result is also pickled to the checkpoints
+        folder keyed by the hash of the file.
+        parser is "stream" (iterparse, constant memory) or "itunesLibrary" (full object graph).
+        path, the Library.xml to read instead of filename in the playlist folder, e.g. a user's in batch mode
+        """
+        path = config.PLAYLIST_PATH / filename if path is None else Path(path)
+        stat = os.stat(path)
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+
+        if key in self._apple_library:
+            return self._apple_library[key]
+
+        frames = None
+        if cache:
+            checkpoint = f"library_{self._hash_file(path)}"
+            try:
+                frames = utils.read_checkpoint(filename=checkpoint)
+                logger.info(f"Using {filename} parsed previously from checkpoint {checkpoint}")
+            except FileNotFoundError:
+                pass
+
+        if frames is None:
+            logger.info(f"Parse {path} with {parser}")
+            if parser == "stream":
+                frames = self._stream_apple_library(path)
+            elif parser == "itunesLibrary":
+                lib = library.parse(path, ignoreRemoteSongs=False)
+                frames = self._tracks_from_library(lib), self._playlists_from_library(lib)
+            else:
+                raise NotImplementedError
+
+            if cache:
+                utils.to_checkpoint(frames, filename=checkpoint)
+
+        self._apple_library = {key: frames}
+        return frames
+
+    @staticmethod
+    def _hash_file(path: Path) -> str:
+        digest = hashlib.sha1()
+
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b""):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _playlists_from_library(lib) -> pd.DataFrame:
+        """Extract playlists from a parsed apple library and return as a dataframe"""
+        playlists = ColumnarFrameBuilder()
 
         for playlist in lib.playlists:
             if playlist.title in config.playlists_exclude:
@@ -132,34 +330,271 @@ class DataExtractor:
                 }
                 playlists.append(data)
 
-        return pd.json_normalize(playlists)
+        return playlists.build()
 
     @staticmethod
-    def read_tracks_from_apple_library(filename: str = "Library.xml") -> pd.DataFrame:
+    def _track_record(attributes: Dict) -> Dict:
+        """Build a track from the attributes of a track in Library.xml"""
+        try:
+            release_date = attributes["Year"]
+        except KeyError:
+            release_date = None
+
+        try:
+            track_number = attributes["Track Number"]
+        except KeyError:
+            # Default track number to a valid number as we later remove entries w/out a track number
+            track_number = 1
+
+        return {
+            "album": attributes.get("Album"),
+            "artist": attributes.get("Artist"),
+            "track_name": attributes.get("Name"),
+            "release_date": release_date,
+            "track_number": track_number,
+        }
+
+    @staticmethod
+    def _tracks_from_library(lib) -> pd.DataFrame:
+        """Extract tracks from a parsed apple library and return as a dataframe"""
+        tracks = (DataExtractor._track_record(track.itunesAttributes) for track in lib.items)
+        return ColumnarFrameBuilder.from_records(tracks)
+
+    @staticmethod
+    def _iter_apple_library(path: Path) -> Iterator[Tuple[str, Dict]]:
+        """
+        Stream Library.xml with iterparse, yielding ("track", track) for every track followed by
+        ("playlist", playlist item) for every item of the playlists not excluded.
+        Playlist items are resolved by Track ID through an index of (album, artist, name), elements are
+        cleared as soon as they are read so memory does not grow with the size of the file.
+        """
+        index = {}  # Track ID: (album, artist, name)
+        stack = []
+        section = None
+        playlist_track_ids = array("q")
+
+        for event, elem in ET.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            depth = len(stack) + 1
+
+            if depth == 3 and elem.tag == "key":
+                section = elem.text
+            elif depth == 4 and elem.tag == "dict" and section == "Tracks":
+                attributes = _plist_dict(elem)
+                index[attributes.get("Track ID")] = tuple(
+                    None if value is None else sys.intern(value)
+                    for value in (attributes.get("Album"), attributes.get("Artist"), attributes.get("Name"))
+                )
+                stack[-1].clear()
+                yield "track", DataExtractor._track_record(attributes)
+            elif depth == 6 and elem.tag == "dict" and section == "Playlists":
+                track_id = _plist_dict(elem).get("Track ID")
+                if track_id is not None:
+                    playlist_track_ids.append(int(track_id))
+                stack[-1].clear()
+            elif depth == 4 and elem.tag == "dict" and section == "Playlists":
+                playlist_name = _plist_dict(elem).get("Name")
+                stack[-1].clear()
+
+                if playlist_name not in config.playlists_exclude:
+                    for track_id in playlist_track_ids:
+                        try:
+                            album, artist, track_name = index[str(track_id)]
+                        except KeyError:
+                            continue
+
+                        yield "playlist", {
+                            "playlist_name": playlist_name,
+                            "album": album,
+                            "artist": artist,
+                            "track_name": track_name,
+                        }
+
+                playlist_track_ids = array("q")
+
+    @staticmethod
+    def _stream_apple_library(path: Path) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Stream the tracks and playlists from Library.xml into dataframes"""
+        tracks, playlists = ColumnarFrameBuilder(), ColumnarFrameBuilder()
+
+        for record_type, record in DataExtractor._iter_apple_library(path):
+            if record_type == "track":
+                tracks.append(record)
+            else:
+                playlists.append(record)
+
+        return tracks.build(), playlists.build()
+
+    def read_playlists_from_apple_library(
+        self, filename: str = "Library.xml"
+    ) -> pd.DataFrame:
         """Read apple xml file, extract playlists and return as a dataframe"""
-        lib = library.parse(config.PLAYLIST_PATH / filename, ignoreRemoteSongs=False)
-        tracks = []
+        _, df_playlists = self.read_apple_library(filename)
+        return df_playlists
+
+    def read_tracks_from_apple_library(self, filename: str = "Library.xml") -> pd.DataFrame:
+        """Read apple xml file, extract tracks and return as a dataframe"""
+        df_tracks, _ = self.read_apple_library(filename)
+        return df_tracks
 
-        for track in lib.items:
-            try:
-                release_date = track.itunesAttributes["Year"]
-            except KeyError:
-                release_date = None
 
+class ColumnarFrameBuilder:
+    """
+    Append records into per column lists and build the dataframe with its final dtypes in one step,
+    instead of building an object dtype frame from a list of dicts. Columns are ordered by first
+    appearance and missing values are NaN, as with pd.DataFrame(records).
+    """
+
+    dtypes = {
+        "track_number": "Int64",
+        "disk": "Int64",
+        "artist": "category",
+        "album": "category",
+        "genre": "category",
+        "playlist_name": "category",
+        "track_name": "string",
+        "album_artist": "string",
+        "composer": "string",
+    }
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict]) -> pd.DataFrame:
+        builder = cls()
+        for record in records:
+            builder.append(record)
+
+        return builder.build()
+
+    def append(self, record: Dict):
+        for key, value in record.items():
             try:
-                track_number = track.itunesAttributes["Track Number"]
+                self.columns[key].append(value)
             except KeyError:
-                # Default track number to a valid number as we later remove entries w/out a track number
-                track_number = 1
+                self.columns[key] = [np.nan] * self.rows + [value]
+
+        self.rows += 1
+
+        if len(record) < len(self.columns):
+            for column in self.columns.values():
+                if len(column) < self.rows:
+                    column.append(np.nan)
+
+    def build(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {key: self._to_array(key, values) for key, values in self.columns.items()},
+            index=pd.RangeIndex(self.rows),
+        )
+
+    def _to_array(self, key: str, values: List):
+        dtype = self.dtypes.get(key)
+
+        if dtype == "Int64":
+            return pd.array([_to_int(value) for value in values], dtype="Int64")
+        if dtype == "category":
+            return pd.Categorical(values)
+        if dtype == "string":
+            return pd.Series(values, dtype=object).astype("string").array
+
+        return pd.Series(values, dtype=object).array
+
+
+def _to_int(value):
+    """
+    Track and disc numbers are integers in Library.xml and text in the tags, e.g. "3", "1/2" or "(3, 12)".
+    Keep the first number
+    """
+    if isinstance(value, int):
+        return value
+
+    match = re.search(r"\d+", value) if isinstance(value, str) else None
+    return int(match.group()) if match else pd.NA
+
+
+class ExtractionManifest:
+    """
+    Records the path, size, mtime and extracted tags of each music file so later extractions
+    only re-read new or changed files. Files not seen during an extraction are dropped on save.
+    """
+
+    filename = "extraction_manifest"
+
+    def __init__(self, entries: Optional[Dict] = None):
+        self.previous_entries = entries or {}  # path: (size, mtime, record)
+        self.entries = {}
+        self.reused = 0
+        self.read = 0
+
+    @classmethod
+    def load(cls) -> "ExtractionManifest":
+        try:
+            entries = utils.read_checkpoint(filename=cls.filename)
+        except FileNotFoundError:
+            return cls()
+
+        return cls(entries)
+
+    def save(self):
+        utils.to_checkpoint(self.entries, filename=self.filename)
+
+    @property
+    def removed(self) -> int:
+        return len(self.previous_entries.keys() - self.entries.keys())
+
+    def get(self, file: str, size: int, mtime: int) -> Optional[Dict]:
+        """Return the recorded tags if the file is unchanged, else None"""
+        try:
+            previous_size, previous_mtime, record = self.previous_entries[file]
+        except KeyError:
+            return None
+
+        if (previous_size, previous_mtime) != (size, mtime):
+            return None
+
+        self.entries[file] = (size, mtime, record)
+        self.reused += 1
+        return record
+
+    def add(self, file: str, size: int, mtime: int, record: Dict):
+        self.entries[file] = (size, mtime, record)
+        self.read += 1
+
+
+def _plist_dict(elem: ET.Element) -> Dict:
+    """
+    Return the scalar key, value pairs of a plist dict element. Values are kept as text, the same
+    as itunesLibrary, true and false become booleans
+    """
+    attributes = {}
+    key = None
+
+    for child in elem:
+        if child.tag == "key":
+            key = child.text or ""
+        elif child.tag in ("integer", "string", "date", "data"):
+            attributes[key] = child.text or ""
+        elif child.tag == "true":
+            attributes[key] = True
+        elif child.tag == "false":
+            attributes[key] = False
+
+    return attributes
+
 
-            data = {
-                "album": track.album,
-                "artist": track.artist,
-                "track_name": track.title,
-                "release_date": release_date,
-                "track_number": track_number,
-            }
+def _get_tags_from_files(files: List[str]) -> List[Dict]:
+    """Read the tags for a batch of files. Module level so it can be sent to a process pool"""
+    tracks = []
 
-            tracks.append(data)
+    for file in files:
+        track = Path(file)
+        logger.debug(track.name)
+        tracks.append(DataExtractor._get_music_metadata(track))
 
-        return pd.json_normalize(tracks)
+    return tracks
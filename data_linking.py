@@ -1,17 +1,129 @@
-from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from difflib import SequenceMatcher
 import logging
-from time import sleep
-from typing import Set, Dict
+from math import ceil
+import re
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import requests
 from spotipy.exceptions import SpotifyException
 
+import config
+from rate_control import RateController, error_reason, is_transient
+from request_history import NO_RESULT, RequestHistory, open_request_history, search_type_of
 import utils
 
 
 logger = logging.getLogger(__name__)
 
+# Searches submitted to the pool at a time, per worker
+WINDOW_PER_WORKER = 4
+
+# Spotify's page size for album_tracks and artist_albums and the ids per tracks call
+SPOTIFY_PAGE_SIZE = 50
+# Album ids per albums call
+SPOTIFY_ALBUMS_PAGE_SIZE = 20
+# Albums of an artist's catalog, without the albums of other artists they appear on
+ARTIST_ALBUM_TYPES = "album,single,compilation"
+
+# Removed from track titles before they are compared: bracketed text, a " - Remastered 2011" style suffix and
+# anything not a letter or a digit
+TITLE_NOISE = re.compile(r"\s?\[.+\]|\s?\(.+\)|\s-\s.*$|[\W_]+")
+
+# Fields of a search string, artist:<artist> track:<track> year:<year> or album:<album> artist:<artist>
+SEARCH_FIELD = re.compile(r"(artist|track|album|year|isrc):(.*?)(?=\s+(?:artist|track|album|year|isrc):|$)")
+# Bracketed text and a " - Remastered 2011" style suffix, dropped when a scored search is relaxed
+TITLE_BRACKETS = re.compile(r"\s?\[.+\]|\s?\(.+\)|\s-\s.*$")
+# Between the artists of a track or album, the first kept when a scored search is relaxed
+ARTIST_SEPARATOR = re.compile(r"\s+(?:feat\.?|ft\.?|featuring|&|and|with|x)\s+|\s*[,;/]\s*", re.IGNORECASE)
+# Appended to the key of a scored search, so first hit results in the request history are not taken as scored
+SCORED_KEY_SUFFIX = " |scored"
+
+
+class SearchExecutor:
+    """
+    Run spotify searches on a bounded pool of threads, all behind one rate controller. Results are returned
+    in the order of the search strings, a search failing (after the rate controller's retries) returns the
+    exception
+    """
+
+    def __init__(
+        self, spotify, workers: int = config.SPOTIFY_SEARCH_WORKERS, rate_control: RateController = None
+    ):
+        self.spotify = spotify  # spotify.Spotify
+        self.workers = workers
+        self.rate_control = rate_control or RateController()
+
+    def _search(self, search_str: str, search_type: str) -> Union[Dict, Exception]:
+        """
+        https://github.com/spotipy-dev/spotipy/issues/522
+        Fixed the issue where half of my requests were failing when set to ES!! Changed to GB!
+        """
+        return self.call(self.spotify.search, search_str, type=search_type, market="GB", offset=0, limit=1)
+
+    def map(self, fn: Callable, items: List) -> Iterator:
+        """
+        Yield fn of each item as they complete, in order. Calls are submitted a window at a time so an
+        interrupted caller waits only for the calls in flight
+        """
+        if self.workers <= 1 or len(items) <= 1:
+            for item in items:
+                yield fn(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="spotify-search") as pool:
+            for window in utils.chunked(items, self.workers * WINDOW_PER_WORKER):
+                yield from pool.map(fn, window)
+
+    def search(self, search_strs: List[str], search_type: str) -> Iterator[Union[Dict, Exception]]:
+        return self.map(lambda search_str: self._search(search_str, search_type), search_strs)
+
+    def call(self, fn: Callable, *args, **kwargs) -> Union[Dict, Exception]:
+        """A rate controlled call to the spotify API returning the exception if it fails"""
+        try:
+            return self.rate_control.call(fn, *args, **kwargs)
+        except (SpotifyException, requests.ConnectionError, requests.Timeout) as e:
+            return e
+
+
+@dataclass
+class SearchStats:
+    """The searches of a stage, from rows down to the requests sent to spotify"""
+    search_type: str
+    rows: int = 0  # Rows searched for
+    distinct: int = 0  # Distinct search strings
+    keys: int = 0  # Canonical search keys, after folding case and whitespace
+    history: int = 0  # Keys found in the request history
+    requested: int = 0  # Keys requested from spotify
+
+    @property
+    def saved(self) -> int:
+        """API calls saved against one request per row"""
+        return self.rows - self.requested
+
+
+@dataclass
+class AlbumLinkStats:
+    """Album first linking, the rows linked from album tracklists and the calls it took"""
+    albums: int = 0  # Albums linked album first
+    rows: int = 0  # Rows to link on these albums
+    linked: int = 0  # Rows matched to their album's tracklist
+    calls: int = 0  # Album searches, tracklist pages and track batches requested from spotify
+
+    @property
+    def saved(self) -> int:
+        """API calls saved against a search per linked row"""
+        return self.linked - self.calls
+
+
+@dataclass
+class ArtistCatalogStats(AlbumLinkStats):
+    """Artist catalog linking, albums counts the albums in the artists' catalogs"""
+    artists: int = 0  # Artists linked from their catalog
+
 
 class DataLinker:
     """
@@ -21,61 +133,101 @@ class DataLinker:
     We currently retrieve this from Spotify
     """
 
-    def __init__(self, spotify):
+    # Columns written from the search results, expanded to object in compact mode before they are updated
+    linked_columns = ("isrc", "spotify_track_uri", "spotify_artist_uri")
+    result_columns = {
+        'track': ["isrc", "spotify_track_uri", "spotify_artist_uri", "spotify_total_tracks"],
+        'album': ["spotify_album_uri"],
+        'artist': ["spotify_artist_uri"],
+    }
+
+    def __init__(
+        self,
+        spotify,
+        compact: bool = config.COMPACT_MODE,
+        album_first: bool = config.LINK_ALBUMS_FIRST,
+        artist_catalog: bool = config.LINK_ARTIST_CATALOGS,
+        scored: bool = config.LINK_SCORED,
+        workers: int = config.SPOTIFY_SEARCH_WORKERS,
+        rate_control: RateController = None,
+        request_history: RequestHistory = None,
+    ):
         self.spotify = spotify  # spotify.Spotify
-        self.request_history_failures = self._get_request_history_failures()  # Set
-        self.request_history_success = self._get_request_history_success()  # Dict
-        self.api_request_count = count()
+        self.rate_control = rate_control or RateController()  # Shared with the DataLoader
+        self.executor = SearchExecutor(spotify, workers=workers, rate_control=self.rate_control)
+        self.compact = compact  # Return frames with categorical text columns, see utils.to_compact
+        self.album_first = album_first  # Link tracks from their album's tracklist, see extract_tracks_by_album
+        self.artist_catalog = artist_catalog  # Link tracks from their artist's catalog, see extract_tracks_by_artist
+        self.scored = scored  # Keep the best scoring of several candidates, see _search_scored
+        self.request_history = open_request_history() if request_history is None else request_history
+        self._migrate_request_history()
+        self.search_stats: List[SearchStats] = []
+        self.album_stats: List[AlbumLinkStats] = []
+        self.catalog_stats: List[ArtistCatalogStats] = []
 
     @staticmethod
-    def _get_request_history_failures() -> Set:
+    def _search_key(search_str: str) -> str:
         """
-        Return the ISRC request history file
+        The canonical key of a search string, case folded with runs of whitespace as a single space. Spotify
+        search ignores both so strings differing only in these share one request and one history entry
         """
-        try:
-            failures = utils.read_pickle(filename="request_history_failures")
-        except FileNotFoundError:
-            return set()
-        except EOFError:
-            # handling for tests
-            return set()
+        return " ".join(search_str.casefold().split())
 
-        return failures
+    @classmethod
+    def _scored_search_key(cls, search_str: str) -> str:
+        """The key of a scored search. ISRC lookups are exact, not scored, and keep their key"""
+        key = cls._search_key(search_str)
+        return key if key.startswith("isrc:") else f"{key}{SCORED_KEY_SUFFIX}"
 
-    @staticmethod
-    def _get_request_history_success() -> Dict:
+    def _migrate_request_history(self):
         """
-        Return the ISRC request history file
+        Copy the pickled request history (a dict of search results and a set of failed search strings) into
+        the request history store, once. The pickles are left in place
         """
+        if self.request_history.migrated:
+            return
+
         try:
             success = utils.read_pickle(filename="request_history_success")
-        except FileNotFoundError:
-            return {}
-        except EOFError:
-            # handling for tests
-            return {}
-
-        return success
+        except (FileNotFoundError, EOFError):
+            success = {}
+        try:
+            failures = utils.read_pickle(filename="request_history_failures")
+        except (FileNotFoundError, EOFError):
+            failures = set()
+
+        for search_str, result in success.items():
+            key = self._search_key(search_str)
+            search_type = search_type_of(key)
+            try:
+                self.request_history.add_success(
+                    key, search_type, self._populate_row_for_spotify_request({}, result, search_type)
+                )
+            except (IndexError, KeyError, TypeError):
+                self.request_history.add_failure(key, search_type)
+
+        for search_str in failures:
+            key = self._search_key(search_str)
+            self.request_history.add_failure(key, search_type_of(key))
+
+        self.request_history.set_migrated()
+        if success or failures:
+            logger.info(f"Migrated {len(success)} successful and {len(failures)} failed requests to the history store")
 
     @staticmethod
-    def _has_release_year(search_release_year) -> bool:
-        """Return True if the search_release_year field is not nan"""
-        if pd.isnull(search_release_year):
-            return False
-
-        return True
-
-    def _build_search_string_for_isrc_request(self, row: pd.Series) -> str:
-        artist = row["spotify_search_artist"]
-        track = row["spotify_search_track_name"]
-        release_year = row["spotify_release_year"]
-
-        if self._has_release_year(release_year):
-            search_str = f"artist:{artist} track:{track} year:{release_year}"
-        else:
-            search_str = f"artist:{artist} track:{track}"
-
-        return search_str
+    def _as_str(s: pd.Series) -> pd.Series:
+        """The values of s as text, formatted as in an f-string (NaN as nan)"""
+        return s.astype(object).astype(str)
+
+    def _build_search_strings_for_isrc_requests(self, df: pd.DataFrame) -> List[str]:
+        """artist:<artist> track:<track> with year:<release year> where known, built column wise"""
+        search_strs = (
+            "artist:" + self._as_str(df["spotify_search_artist"])
+            + " track:" + self._as_str(df["spotify_search_track_name"])
+        )
+        release_year = df["spotify_release_year"]
+        year = (" year:" + self._as_str(release_year)).where(release_year.notna(), "")
+        return (search_strs + year).tolist()
 
     @staticmethod
     def _populate_row_for_spotify_request(row, result, search_type):
@@ -91,144 +243,349 @@ class DataLinker:
             )
         elif search_type == 'album':
             row["spotify_album_uri"] = result["albums"]["items"][0]["uri"]
+        elif search_type == 'artist':
+            row["spotify_artist_uri"] = result["artists"]["items"][0]["uri"]
         else:
             raise NotImplementedError
         return row
 
-    def _is_historical_request(self, search_str, row, search_type):
-        if search_str in self.request_history_failures:
-            logger.debug(
-                f"Skip re-request of failed request with search_str: {search_str}"
-            )
-            return row
+    @classmethod
+    def _search_keys(
+        cls, search_strs: Iterable[str], scored: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return the canonical key of each search string, with the distinct search strings and their keys. Keys are
+        made once per distinct search string
+        """
+        codes, distinct = pd.factorize(np.asarray(list(search_strs), dtype=object))
+        search_key = cls._scored_search_key if scored else cls._search_key
+        distinct_keys = np.array([search_key(search_str) for search_str in distinct], dtype=object)
+        return distinct_keys[codes], distinct, distinct_keys
 
-        if search_str in self.request_history_success:
-            logger.debug(
-                f"Skip re-request of successful request with search_str: {search_str} "
-                f"Returning previous values"
-            )
-            return self._populate_row_for_spotify_request(row, self.request_history_success[search_str], search_type)
+    @staticmethod
+    def _search_fields(search_str: str) -> Dict[str, str]:
+        """The fields of a search string, e.g. {"artist": "Queen", "track": "Innuendo"}"""
+        return {name: value.strip() for name, value in SEARCH_FIELD.findall(search_str)}
 
-        return (False,)
+    @classmethod
+    def _artist_names(cls, artists: Iterable[str]) -> set:
+        return {cls._normalize_title(artist) for artist in artists} - {""}
 
-    def _request_isrc_from_spotify(self, row: pd.Series) -> pd.Series:
+    def _score_candidate(
+        self, candidate: Dict, fields: Dict[str, str], search_type: str, total_tracks: Optional[int] = None
+    ) -> float:
         """
-        https://github.com/spotipy-dev/spotipy/issues/522
-        Fixed the issue where half of my requests were failing when set to ES!! Changed to GB!
-        Also set the track_id, artist_id and album_id
-
-        https://stackoverflow.com/questions/44729727/pandas-slice-large-dataframe-into-chunks
-        To review requesting in chunks
+        Score a search result against the search, 0 to 1: normalized title similarity, the share of the searched
+        artists credited, the same year and the album's track count, weighted by SCORED_WEIGHTS. Parts not known
+        for the search (no year, no track count) are left out of the weighting
         """
-        search_str = self._build_search_string_for_isrc_request(row=row)
-        search_type = 'track'
-
-        if any(self._is_historical_request(search_str, row, search_type)):
-            return row
-
-        counter = next(self.api_request_count)
-        if counter > 100:
-            sleep(2)
-            self.api_request_count = count()
+        album = candidate if search_type == "album" else candidate.get("album") or {}
+        title = self._normalize_title(fields.get("album" if search_type == "album" else "track"))
+        parts = {
+            "title": SequenceMatcher(None, title, self._normalize_title(candidate.get("name"))).ratio(),
+        }
+
+        searched = fields.get("artist", "")
+        searched_artists = self._artist_names(ARTIST_SEPARATOR.split(searched))
+        if searched_artists:
+            names = [artist.get("name") or "" for artist in candidate.get("artists") or []]
+            credited = self._artist_names(names)
+            if self._normalize_title(searched) in credited:
+                # One artist named with a separator, e.g. Earth, Wind & Fire
+                parts["artist"] = 1.0
+            else:
+                # Split as the search, Crosby, Stills, Nash & Young is searched as Crosby, Stills, Nash
+                credited |= self._artist_names(part for name in names for part in ARTIST_SEPARATOR.split(name))
+                parts["artist"] = len(searched_artists & credited) / len(searched_artists)
+
+        year = fields.get("year", "")[:4]
+        if year:
+            parts["year"] = float(str(album.get("release_date", ""))[:4] == year)
+
+        if total_tracks and album.get("total_tracks"):
+            spotify_tracks = album["total_tracks"]
+            parts["track_count"] = 1 - abs(spotify_tracks - total_tracks) / max(spotify_tracks, total_tracks)
+
+        weights = {part: config.SCORED_WEIGHTS[part] for part in parts}
+        return sum(parts[part] * weight for part, weight in weights.items()) / sum(weights.values())
+
+    @classmethod
+    def _relaxed_search_strs(cls, search_str: str) -> List[str]:
+        """The search string, then relaxed without the year, then brackets, then secondary artists"""
+        fields = cls._search_fields(search_str)
+        relaxed = [search_str]
+
+        def add(fields: Dict[str, str]):
+            relaxed_str = " ".join(f"{name}:{value}" for name, value in fields.items() if value)
+            if relaxed_str and relaxed_str != relaxed[-1]:
+                relaxed.append(relaxed_str)
+
+        fields = {name: value for name, value in fields.items() if name != "year"}
+        add(fields)
+        fields = {
+            name: TITLE_BRACKETS.sub("", value) if name in ("track", "album") else value
+            for name, value in fields.items()
+        }
+        add(fields)
+        if "artist" in fields:
+            fields["artist"] = ARTIST_SEPARATOR.split(fields["artist"], 1)[0]
+        add(fields)
+        return relaxed
+
+    def _search_scored(
+        self, search_str: str, search_type: str, total_tracks: Optional[int] = None
+    ) -> Union[Dict, Exception]:
+        """
+        Search for SCORED_CANDIDATES candidates and keep the best scoring, relaxing the search until one clears
+        SCORED_THRESHOLD. Returns the search result with the best candidate only, or no items. ISRC lookups are
+        exact and artists have no title to score, both keep the first result
+        """
+        if search_str.startswith("isrc:") or search_type == 'artist':
+            return self.executor._search(search_str, search_type)
+
+        fields = self._search_fields(search_str)
+        for relaxed_str in self._relaxed_search_strs(search_str):
+            result = self.executor.call(
+                self.spotify.search, relaxed_str, type=search_type, market="GB", offset=0,
+                limit=config.SCORED_CANDIDATES,
+            )
+            if isinstance(result, Exception):
+                return result
+
+            candidates = [item for item in result[f"{search_type}s"]["items"] if item]
+            scores = [self._score_candidate(item, fields, search_type, total_tracks) for item in candidates]
+            if scores and max(scores) >= config.SCORED_THRESHOLD:
+                best = candidates[scores.index(max(scores))]
+                logger.debug(f"Matched {search_str} with {relaxed_str}, score {max(scores):.2f}")
+                return {f"{search_type}s": {"items": [best]}}
+
+        return {f"{search_type}s": {"items": []}}
+
+    def _request(
+        self,
+        to_request: Dict[str, str],
+        search_type: str,
+        total_tracks: Optional[Dict[str, int]] = None,
+        raise_errors: bool = True,
+    ):
+        """
+        Search spotify concurrently for the search strings of to_request (by key), recording the results in the
+        history in the order given. Scored, with the library's track count of the album by key where known.
+        An album search error is raised after the history is committed, or logged when not raise_errors
+        """
+        if self.scored:
+            total_tracks = total_tracks or {}
+            results = self.executor.map(
+                lambda key: self._search_scored(to_request[key], search_type, total_tracks.get(key)), list(to_request)
+            )
+        else:
+            results = self.executor.search(list(to_request.values()), search_type)
+        error, errors = None, 0
 
         try:
-            result = self.spotify.search(
-                search_str, type=search_type, market="GB", offset=0, limit=1
-            )
-        except SpotifyException:
+            for searched, ((key, search_str), result) in enumerate(zip(to_request.items(), results), 1):
+                search_error = self._record(key, search_str, search_type, result)
+                error = error or search_error
+                errors += search_error is not None
+                if self.request_history.flush():
+                    logger.info(f"Flushed {searched} of {len(to_request)} {search_type} searches to the history")
+        finally:
+            # Keep the searches made when interrupted, the next run resumes from here
+            results.close()
+            self.request_history.commit()
+
+        if error is not None:
+            if raise_errors:
+                raise error
+            logger.warning(f"{errors} {search_type} searches failed, their rows are not linked: {error_reason(error)}")
+
+    def _record(self, key: str, search_str: str, search_type: str, result) -> Optional[Exception]:
+        """Record a search result in the request history, returns an album search error to be raised"""
+        if isinstance(result, Exception):
             logger.debug(f"Failed to get result for: {search_str}")
-            self.request_history_failures.add(search_str)
-            return row
+            transient = is_transient(result)
+            if transient:
+                # Still throttled or unavailable after the retries, retried after the transient TTL
+                logger.warning(f"Search not completed, will be retried on a later run: {search_str}")
+            self.request_history.add_failure(key, search_type, error_reason(result), transient)
+            # Album search errors are raised, as when sequential
+            return result if search_type == 'album' else None
 
         try:
-            self._populate_row_for_spotify_request(row, result, search_type)
-            self.request_history_success[search_str] = result
-            logger.debug(f"Found spotify ISRC for: {search_str}")
+            fields = self._populate_row_for_spotify_request({}, result, search_type)
+            self.request_history.add_success(key, search_type, fields)
+            logger.debug(f"Found spotify {search_type} for: {search_str}")
         except (IndexError, TypeError):
-            logger.debug(f"Failed to get spotify ISRC for: {search_str}")
-            self.request_history_failures.add(search_str)
-        return row
+            logger.debug(f"Failed to get spotify {search_type} for: {search_str}")
+            self.request_history.add_failure(key, search_type, NO_RESULT)
+        return None
 
-    def extract_all_isrc_with_na(self, df: pd.DataFrame) -> pd.DataFrame:
-        logger.info(f"Search spotify for all ISRC's which are currently na")
+    def _link(
+        self, df: pd.DataFrame, search_strs: List[str], search_type: str, raise_errors: bool = True
+    ) -> pd.DataFrame:
+        """
+        Return the result columns for the rows of df, one search string per row. The search strings are
+        collapsed to their canonical keys and the results of the keys in the request history read in one
+        query. Spotify is searched once for each key left, not a failure awaiting its retry, then the results
+        are fanned out to the rows with one join on the key
+        """
+        stats = SearchStats(search_type)
+        keys, distinct, distinct_keys = self._search_keys(search_strs, scored=self.scored and search_type != 'artist')
+        # Canonical key: the first search string with the key, sent to spotify
+        queries = {}
+        for key, search_str in zip(distinct_keys, distinct):
+            queries.setdefault(key, search_str)
+
+        results = self.request_history.results_frame(queries)
+        found = set(results.index)
+        misses = [key for key in queries if key not in found]
+        failed = self.request_history.failures_not_due(misses)
+        to_request = {key: queries[key] for key in misses if key not in failed}
+
+        stats.rows = len(keys)
+        stats.distinct = len(distinct)
+        stats.keys = len(queries)
+        stats.history = len(queries) - len(to_request)
+        stats.requested = len(to_request)
+        logger.info(
+            f"Search spotify for {stats.rows} {search_type} rows: {stats.distinct} distinct search strings, "
+            f"{stats.keys} keys, {stats.history} in the request history, {stats.requested} requested "
+            f"with {self.executor.workers} workers. {stats.saved} API calls saved"
+        )
+        self.search_stats.append(stats)
+
+        if to_request:
+            total_tracks = None
+            if self.scored and "library_total_tracks" in df.columns:
+                # The library's track count of an album, weighed when scoring its candidates
+                counts = pd.Series(df["library_total_tracks"].to_numpy(), index=keys)
+                total_tracks = counts[counts.notna()].groupby(level=0).first().astype(int).to_dict()
+            self._request(to_request, search_type, total_tracks, raise_errors)
+            results = pd.concat([results, self.request_history.results_frame(to_request)])
+
+        return (
+            pd.DataFrame({"search_key": keys}, index=df.index)
+            .join(results[self.result_columns[search_type]], on="search_key")
+            .drop(columns="search_key")
+        )
 
-        extracted = df[df["isrc"].isna()]
-        extracted = extracted.apply(self._request_isrc_from_spotify, axis=1)
+    def _link_tracks(
+        self, df: pd.DataFrame, mask: pd.Series, build_search_strs: Callable[[pd.DataFrame], List[str]]
+    ) -> pd.DataFrame:
+        """Search spotify for the tracks of the rows in mask, updating the track columns of df"""
+        df = utils.from_compact(df, columns=self.linked_columns)
+        extracted = df[mask]
 
-        df.update(extracted)
-        utils.to_pickle(self.request_history_failures, filename="request_history_failures")
-        utils.to_pickle(self.request_history_success, filename="request_history_success")
+        search_strs = build_search_strs(extracted)
+        df.update(self._link(extracted, search_strs, 'track'))
         return df
 
+    def _extract_isrc(self, df: pd.DataFrame, mask: pd.Series) -> pd.DataFrame:
+        """Search spotify for the ISRC of the rows in mask"""
+        return self._compact(self._link_tracks(df, mask, self._build_search_strings_for_isrc_requests))
+
+    @staticmethod
+    def _build_search_strings_for_isrc_lookups(df: pd.DataFrame) -> List[str]:
+        """An exact search by ISRC, its key is the ISRC so each recording is searched once"""
+        return [f"isrc:{isrc.strip()}" for isrc in df["isrc"]]
+
+    def extract_spotify_track_uri_by_isrc(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Link the rows which already carry an ISRC (from the Apple xid) with an exact isrc: search. Rows whose
+        ISRC is not found on spotify fall back to a search by artist and track
+        """
+        logger.info(f"Search spotify for the tracks of all rows with an ISRC")
+        mask = df["isrc"].notna() & df["spotify_track_uri"].isna()
+        df = self._link_tracks(df, mask, self._build_search_strings_for_isrc_lookups)
+
+        not_found = mask & df["spotify_track_uri"].isna()
+        logger.info(f"{mask.sum() - not_found.sum()} of {mask.sum()} rows linked by ISRC")
+        if not_found.any():
+            df = self._link_tracks(df, not_found, self._build_search_strings_for_isrc_requests)
+
+        return self._compact(df)
+
+    def extract_all_isrc_with_na(self, df: pd.DataFrame) -> pd.DataFrame:
+        logger.info(f"Search spotify for all ISRC's which are currently na")
+        return self._extract_isrc(df, df["isrc"].isna())
+
     def extract_isrc(
         self, df: pd.DataFrame, spotify_search_artist, spotify_search_track_name
     ) -> pd.DataFrame:
         logger.info(f"Search spotify for a single ISRC using the track & artist")
+        return self.fix_tracks(df, [(spotify_search_artist, spotify_search_track_name)])
 
-        extracted = df[
-            (
-                (df["spotify_search_artist"] == spotify_search_artist)
-                & (df["spotify_search_track_name"] == spotify_search_track_name)
-            )
-        ]
-        extracted = extracted.apply(self._request_isrc_from_spotify, axis=1)
-        utils.to_pickle(self.request_history_failures, filename="request_history_failures")
-        utils.to_pickle(self.request_history_success, filename="request_history_success")
+    @staticmethod
+    def _track_index(df: pd.DataFrame, artist_column: str) -> Dict[Tuple[str, str], np.ndarray]:
+        """The positions of the rows of each (artist_column, spotify_search_track_name), in one pass"""
+        return df.groupby([artist_column, "spotify_search_track_name"], observed=True, sort=False).indices
 
-        df.update(extracted)
-        return df
+    def fix_tracks(
+        self, df: pd.DataFrame, fixes: Iterable[Union[Tuple[str, str], config.SpotifyTrackName]]
+    ) -> pd.DataFrame:
+        """
+        Link the rows of many tracks again at once, each an (artist, track) of the search columns or a
+        SpotifyTrackName correction which also renames the track searched for. A correction is matched on the
+        original artist, as in DataCleaner._update_spotify_tracks. The rows are found in an index per artist
+        column built once, their track columns cleared and only these rows searched for, the request history
+        committed once at the end
+        """
+        renames = {}  # (artist column, artist, track): track searched for, None to keep the track
+        for fix in fixes:
+            if isinstance(fix, config.SpotifyTrackName):
+                renames[("artist", fix.artist, fix.from_spotify_search_track_name)] = fix.to_spotify_search_track_name
+            else:
+                renames.setdefault(("spotify_search_artist", *fix), None)
+
+        indexes = {column: self._track_index(df, column) for column in dict.fromkeys(fix[0] for fix in renames)}
+        found = [fix for fix in renames if fix[1:] in indexes[fix[0]]]
+        logger.info(f"Fix {len(renames)} tracks, {len(renames) - len(found)} not found")
+        if not found:
+            return df
+
+        mask = np.zeros(len(df), dtype=bool)
+        df = utils.from_compact(df, columns=[*self.linked_columns, "spotify_search_track_name"])
+        track_names = df.columns.get_loc("spotify_search_track_name")
+        for fix in found:
+            rows = indexes[fix[0]][fix[1:]]
+            mask[rows] = True
+            if renames[fix] is not None:
+                df.iloc[rows, track_names] = renames[fix]
+
+        # A track not found again is left unlinked rather than with the match being fixed, its total tracks 0 as
+        # when the spotify columns are created
+        df.loc[mask, list(self.linked_columns)] = np.nan
+        df.loc[mask, "spotify_total_tracks"] = 0
+        return self._extract_isrc(df, pd.Series(mask, index=df.index))
 
     @staticmethod
     def _over_75_percent_same_artist(total_tracks, num_artists) -> bool:
         return ((total_tracks - num_artists) / total_tracks) * 100 > 75
 
     def _build_search_string_for_album_request(self, row: pd.Series) -> str:
-        artist = row["spotify_search_artist"]
-        album = row["spotify_search_album"]
-
-        if self._over_75_percent_same_artist(row["library_total_tracks"], row["artist_count"]):
-            search_str = f"album:{album} artist:{artist}"
-        else:
-            search_str = f"album:{album}"
+        return self._build_search_strings_for_album_requests(row.to_frame().T)[0]
 
-        return search_str
-
-    def _get_album_uri_from_spotify(self, row: pd.Series) -> pd.Series:
-        """Retrieve an album uri from Spotify"""
-        search_str = self._build_search_string_for_album_request(row=row)
-        search_type = 'album'
-
-        if any(self._is_historical_request(search_str, row, search_type)):
-            return row
-
-        # Current throttle to prevent going over request limit
-        counter = next(self.api_request_count)
-        if counter > 100:
-            sleep(2)
-            self.api_request_count = count()
-
-        result = self.spotify.search(
-            search_str, type=search_type, market="GB", offset=0, limit=1
+    def _build_search_strings_for_album_requests(self, albums: pd.DataFrame) -> List[str]:
+        """album:<album>, with artist:<artist> where over 75 percent of the tracks are by the first artist"""
+        search_strs = "album:" + self._as_str(albums["spotify_search_album"])
+        with_artist = self._over_75_percent_same_artist(
+            albums["library_total_tracks"].astype(float), albums["artist_count"].astype(float)
         )
-        try:
-            self._populate_row_for_spotify_request(row, result, search_type)
-            self.request_history_success[search_str] = result
-            logger.info(f"Found spotify album for: {search_str}")
-        except IndexError:
-            logger.debug(f"Failed to get spotify album for: {search_str}")
-            row["spotify_album_uri"] = np.nan
-            self.request_history_failures.add(search_str)
-
-        return row
+        return search_strs.where(
+            ~with_artist, search_strs + " artist:" + self._as_str(albums["spotify_search_artist"])
+        ).tolist()
 
     @staticmethod
     def _get_albums_to_request(df: pd.DataFrame) -> pd.DataFrame:
         logger.info(f"Get albums to be requested from Spotify")
-        albums_mask = df["spotify_add_album"] == True
+        return DataLinker._group_albums(df, df["spotify_add_album"] == True)
 
+    @staticmethod
+    def _group_albums(df: pd.DataFrame, albums_mask: pd.Series) -> pd.DataFrame:
+        """A row for each album of the rows in albums_mask, its first artist, track and artist counts"""
         albums = (
             df[albums_mask]
-            .groupby("spotify_search_album")[
+            .groupby("spotify_search_album", observed=True)[
                 ["spotify_search_album", "spotify_search_artist", "library_total_tracks"]
             ]
             .nth(0)  # The top row has the first artist (we're assuming albums first artists usually album artist)
@@ -236,7 +593,7 @@ class DataLinker:
 
         # Get the number of unique artists to determine if we can request using the artist
         album_artist_count = (
-            df[albums_mask].groupby("spotify_search_album")[["spotify_search_artist"]]
+            df[albums_mask].groupby("spotify_search_album", observed=True)[["spotify_search_artist"]]
         ).nunique()
         album_artist_count = album_artist_count.rename(
             columns={
@@ -254,6 +611,291 @@ class DataLinker:
 
         return albums
 
+    @staticmethod
+    def _normalize_title(title) -> str:
+        return TITLE_NOISE.sub("", title.casefold()) if isinstance(title, str) else ""
+
+    @staticmethod
+    def _tracklist_entry(item: Dict) -> Dict:
+        """The fields kept of a track in an album's tracklist, see request_history.ALBUM_TRACK_FIELDS"""
+        return {
+            "disc_number": item.get("disc_number"),
+            "track_number": item.get("track_number"),
+            "name": item.get("name"),
+            "spotify_track_uri": item["uri"],
+            "spotify_artist_uri": item["artists"][0]["uri"] if item.get("artists") else None,
+        }
+
+    def _fetch_tracklist(self, album_uri: str) -> Union[List[Dict], Exception]:
+        """Return the tracks of an album, a page of SPOTIFY_PAGE_SIZE tracks per call"""
+        tracks = []
+        while True:
+            page = self.executor.call(
+                self.spotify.album_tracks, album_uri, limit=SPOTIFY_PAGE_SIZE, offset=len(tracks), market="GB"
+            )
+            if isinstance(page, Exception):
+                return page
+
+            tracks.extend(self._tracklist_entry(item) for item in page["items"])
+            if not page.get("next") or not page["items"]:
+                return tracks
+
+    def _match_tracklist(self, rows: pd.DataFrame, tracklist: List[Dict]) -> Dict:
+        """
+        Match the rows of an album to its tracklist by normalized title. A title on the album more than once
+        is matched by disc and track number, where the row has them. Returns the track uri by row index
+        """
+        by_title = {}
+        for track in tracklist:
+            by_title.setdefault(self._normalize_title(track["name"]), []).append(track)
+
+        discs = rows["disk"] if "disk" in rows.columns else pd.Series(pd.NA, index=rows.index)
+        matched = {}
+        for index, title, track_number, disc in zip(rows.index, rows["track_name"], rows["track_number"], discs):
+            candidates = by_title.get(self._normalize_title(title), [])
+            if len(candidates) > 1:
+                candidates = [
+                    track for track in candidates
+                    if (pd.isna(track_number) or track["track_number"] == track_number)
+                    and (pd.isna(disc) or track["disc_number"] == disc)
+                ]
+            if len(candidates) == 1:
+                matched[index] = candidates[0]["spotify_track_uri"]
+
+        return matched
+
+    def _fetch_tracks(self, track_uris: List[str]) -> int:
+        """Fetch the tracks not in the request history, SPOTIFY_PAGE_SIZE per call. Returns the calls made"""
+        known = self.request_history.known(track_uris)
+        batches = list(utils.chunked([uri for uri in track_uris if uri not in known], SPOTIFY_PAGE_SIZE))
+
+        results = self.executor.map(lambda uris: self.executor.call(self.spotify.tracks, uris, market="GB"), batches)
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to get {len(batch)} tracks by uri: {error_reason(result)}")
+                continue
+
+            for uri, track in zip(batch, result["tracks"]):
+                try:
+                    fields = self._populate_row_for_spotify_request({}, {"tracks": {"items": [track]}}, 'track')
+                except (KeyError, TypeError):
+                    continue
+                self.request_history.add_success(uri, 'track', fields)
+
+        self.request_history.commit()
+        return len(batches)
+
+    def extract_tracks_by_album(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Album first linking. The rows to link (no track uri or ISRC) of albums with at least
+        ALBUM_FIRST_MIN_TRACKS of them are matched to the album's tracklist: one album search (keyed as in
+        extract_spotify_album_uri so round 2 reuses it), one page of tracks and a share of a tracks call for
+        the ISRC's. Rows not matched are left to the search per track
+        """
+        if not self.album_first:
+            return df
+
+        logger.info(f"Link tracks album first, from the tracklist of their album")
+        df = utils.from_compact(df, columns=self.linked_columns)
+        to_link = df["spotify_track_uri"].isna() & df["isrc"].isna() & df["spotify_search_album"].notna()
+        to_link_count = to_link.groupby(df["spotify_search_album"], observed=True).sum()
+        album_names = set(to_link_count.index[to_link_count >= config.ALBUM_FIRST_MIN_TRACKS]) - config.albums_ignore
+        stats = AlbumLinkStats()
+        self.album_stats.append(stats)
+        if not album_names:
+            return self._compact(df)
+
+        # Albums grouped over all their rows as in round 2, so the search strings are the same
+        library_total_tracks = df.groupby("spotify_search_album", observed=True)["track_name"].transform("count")
+        albums = self._group_albums(
+            df.assign(library_total_tracks=library_total_tracks), df["spotify_search_album"].isin(album_names)
+        )
+        search_strs = self._build_search_strings_for_album_requests(albums)
+        # An album search failing leaves its rows to the search per track rather than stopping round 1
+        album_uris = {
+            album: uri
+            for album, uri in zip(
+                albums["spotify_search_album"],
+                self._link(albums, search_strs, 'album', raise_errors=False)["spotify_album_uri"],
+            )
+            if pd.notna(uri)
+        }
+        stats.calls += self.search_stats[-1].requested
+
+        tracklists = self.request_history.album_tracks(set(album_uris.values()))
+        to_fetch = [uri for uri in dict.fromkeys(album_uris.values()) if uri not in tracklists]
+        for album_uri, tracklist in zip(to_fetch, self.executor.map(self._fetch_tracklist, to_fetch)):
+            if isinstance(tracklist, Exception):
+                logger.warning(f"Failed to get the tracklist of {album_uri}: {error_reason(tracklist)}")
+                continue
+            stats.calls += max(1, ceil(len(tracklist) / SPOTIFY_PAGE_SIZE))
+            self.request_history.add_album_tracks(album_uri, tracklist)
+            tracklists[album_uri] = tracklist
+        self.request_history.commit()
+
+        matched = {}
+        rows = df[to_link & df["spotify_search_album"].isin(album_names)]
+        stats.albums = len(album_names)
+        stats.rows = len(rows)
+        for album, album_rows in rows.groupby("spotify_search_album", observed=True):
+            tracklist = tracklists.get(album_uris.get(album), [])
+            matched.update(self._match_tracklist(album_rows, tracklist))
+
+        stats.calls += self._fetch_tracks(list(dict.fromkeys(matched.values())))
+        self._update_tracks(df, matched, stats)
+
+        logger.info(
+            f"Linked {stats.linked} of {stats.rows} rows on {stats.albums} albums album first with {stats.calls} "
+            f"API calls. {stats.saved} API calls saved"
+        )
+        return self._compact(df)
+
+    def _fetch_artist_albums(self, artist_uri: str) -> Union[List[Dict], Exception]:
+        """Return the albums of an artist's catalog, a page of SPOTIFY_PAGE_SIZE albums per call"""
+        albums = []
+        while True:
+            page = self.executor.call(
+                self.spotify.artist_albums, artist_uri, album_type=ARTIST_ALBUM_TYPES, country="GB",
+                limit=SPOTIFY_PAGE_SIZE, offset=len(albums),
+            )
+            if isinstance(page, Exception):
+                return page
+
+            albums.extend({"album_uri": item["uri"], "album_name": item.get("name")} for item in page["items"])
+            if not page.get("next") or not page["items"]:
+                return albums
+
+    def _fetch_albums(self, album_uris: List[str]) -> int:
+        """
+        Fetch the tracklists of albums not in the request history, SPOTIFY_ALBUMS_PAGE_SIZE albums per call
+        with the first page of their tracks. Returns the calls made
+        """
+        tracklists = self.request_history.album_tracks(album_uris)
+        batches = list(utils.chunked([uri for uri in album_uris if uri not in tracklists], SPOTIFY_ALBUMS_PAGE_SIZE))
+        calls = len(batches)
+
+        results = self.executor.map(lambda uris: self.executor.call(self.spotify.albums, uris, market="GB"), batches)
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to get {len(batch)} albums: {error_reason(result)}")
+                continue
+
+            for album in filter(None, result["albums"]):
+                if album["tracks"].get("next"):
+                    # Over a page of tracks, fetched in full
+                    tracklist = self._fetch_tracklist(album["uri"])
+                    if isinstance(tracklist, Exception):
+                        continue
+                    calls += ceil(len(tracklist) / SPOTIFY_PAGE_SIZE)
+                else:
+                    tracklist = [self._tracklist_entry(item) for item in album["tracks"]["items"]]
+                self.request_history.add_album_tracks(album["uri"], tracklist)
+
+        self.request_history.commit()
+        return calls
+
+    def _match_catalog(self, rows: pd.DataFrame, catalog: List[Dict]) -> Dict:
+        """
+        Match the rows of an artist to the tracks of their catalog by normalized title. A title in the catalog
+        more than once (album, single, compilation) is matched to the row's album, then its track number
+        where it has one, then the first. Returns the track uri by row index
+        """
+        by_title = {}
+        for track in catalog:
+            by_title.setdefault(self._normalize_title(track["name"]), []).append(track)
+
+        matched = {}
+        for index, title, album, track_number in zip(
+            rows.index, rows["track_name"], rows["spotify_search_album"], rows["track_number"]
+        ):
+            candidates = by_title.get(self._normalize_title(title))
+            if not candidates:
+                continue
+
+            album = self._normalize_title(album)
+            on_album = [track for track in candidates if track["album_name"] == album] or candidates
+            numbered = on_album
+            if pd.notna(track_number):
+                numbered = [track for track in on_album if track["track_number"] == track_number] or on_album
+            matched[index] = numbered[0]["spotify_track_uri"]
+
+        return matched
+
+    def extract_tracks_by_artist(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Artist catalog linking. The rows to link (no track uri or ISRC) of artists with at least
+        ARTIST_CATALOG_MIN_TRACKS of them are matched in memory to the artist's catalog: one artist search,
+        a page of their albums per SPOTIFY_PAGE_SIZE, the tracklists SPOTIFY_ALBUMS_PAGE_SIZE albums per call
+        and the ISRC's of the matched tracks SPOTIFY_PAGE_SIZE per call. The catalogs are kept in the request
+        history. Rows not matched are left to the search per track
+        """
+        if not self.artist_catalog:
+            return df
+
+        logger.info(f"Link tracks of prolific artists from their catalog")
+        df = utils.from_compact(df, columns=self.linked_columns)
+        to_link = df["spotify_track_uri"].isna() & df["isrc"].isna() & df["spotify_search_artist"].notna()
+        to_link_count = to_link.groupby(df["spotify_search_artist"], observed=True).sum()
+        artist_names = list(to_link_count.index[to_link_count >= config.ARTIST_CATALOG_MIN_TRACKS])
+        stats = ArtistCatalogStats()
+        self.catalog_stats.append(stats)
+        if not artist_names:
+            return self._compact(df)
+
+        search_strs = [f"artist:{artist}" for artist in artist_names]
+        artist_uris = {
+            artist: uri
+            for artist, uri in zip(
+                artist_names,
+                self._link(pd.DataFrame(index=artist_names), search_strs, 'artist')["spotify_artist_uri"],
+            )
+            if pd.notna(uri)
+        }
+        stats.calls += self.search_stats[-1].requested
+
+        catalogs = self.request_history.artist_albums(set(artist_uris.values()))
+        to_fetch = [uri for uri in dict.fromkeys(artist_uris.values()) if uri not in catalogs]
+        for artist_uri, albums in zip(to_fetch, self.executor.map(self._fetch_artist_albums, to_fetch)):
+            if isinstance(albums, Exception):
+                logger.warning(f"Failed to get the albums of {artist_uri}: {error_reason(albums)}")
+                continue
+            stats.calls += max(1, ceil(len(albums) / SPOTIFY_PAGE_SIZE))
+            self.request_history.add_artist_albums(artist_uri, albums)
+            catalogs[artist_uri] = albums
+
+        album_uris = list(dict.fromkeys(album["album_uri"] for albums in catalogs.values() for album in albums))
+        stats.calls += self._fetch_albums(album_uris)
+        tracklists = self.request_history.album_tracks(album_uris)
+
+        matched = {}
+        rows = df[to_link & df["spotify_search_artist"].isin(artist_names)]
+        stats.artists = len(artist_names)
+        stats.albums = len(album_uris)
+        stats.rows = len(rows)
+        for artist, artist_rows in rows.groupby("spotify_search_artist", observed=True):
+            catalog = [
+                {**track, "album_name": self._normalize_title(album["album_name"])}
+                for album in catalogs.get(artist_uris.get(artist), [])
+                for track in tracklists.get(album["album_uri"], [])
+            ]
+            matched.update(self._match_catalog(artist_rows, catalog))
+
+        stats.calls += self._fetch_tracks(list(dict.fromkeys(matched.values())))
+        self._update_tracks(df, matched, stats)
+
+        logger.info(
+            f"Linked {stats.linked} of {stats.rows} rows of {stats.artists} artists ({stats.albums} albums) from "
+            f"their catalog with {stats.calls} API calls. {stats.saved} API calls saved"
+        )
+        return self._compact(df)
+
+    def _update_tracks(self, df: pd.DataFrame, matched: Dict, stats: AlbumLinkStats):
+        """Update the track columns of the rows matched to a track uri from the fetched tracks"""
+        results = self.request_history.results(set(matched.values()))
+        linked = {index: results[uri] for index, uri in matched.items() if uri in results}
+        stats.linked = len(linked)
+        df.update(pd.DataFrame.from_dict(linked, orient="index", columns=self.result_columns['track'], dtype=object))
+
     def extract_spotify_album_uri(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Return a dataframe with spotify_album_uri populated. Only retrieves the uri for albums
@@ -262,9 +904,8 @@ class DataLinker:
         logger.info(f"Search spotify for all album uri's. Search using the album")
 
         albums = self._get_albums_to_request(df)
-        albums = albums.apply(self._get_album_uri_from_spotify, axis=1)
-        utils.to_pickle(self.request_history_failures, filename="request_history_failures")
-        utils.to_pickle(self.request_history_success, filename="request_history_success")
+        search_strs = self._build_search_strings_for_album_requests(albums)
+        albums["spotify_album_uri"] = self._link(albums, search_strs, 'album')["spotify_album_uri"]
 
         albums = albums.drop(columns=["spotify_search_artist", "artist_count"])
 
@@ -280,4 +921,11 @@ class DataLinker:
                      errors="ignore")
         df = df.rename(columns={"spotify_album_uri_y": "spotify_album_uri"})
 
-        return df
+        return self._compact(df)
+
+    def _compact(self, df: pd.DataFrame) -> pd.DataFrame:
+        """In compact mode convert the text columns to categoricals sharing one dictionary"""
+        if not self.compact:
+            return df
+
+        return utils.to_compact([df])[0]
@@ -1,20 +1,22 @@
 import logging
-from time import sleep
 from typing import List
 
 import pandas as pd
 import spotipy
 
+from rate_control import RateController
 from utils import chunked
 
 logger = logging.getLogger(__name__)
 
 
 class DataLoader:
-    def __init__(self, spotify):
+    def __init__(self, spotify, rate_control: RateController = None):
         self.spotify = spotify
-        self.user_id = self.spotify.me()["id"]
-        self.user_name = self.spotify.me()["display_name"]
+        self.rate_control = rate_control or RateController()  # Shared with the DataLinker
+        me = self.rate_control.call(self.spotify.me)
+        self.user_id = me["id"]
+        self.user_name = me["display_name"]
 
     def add_tracks_to_spotify(self, df: pd.DataFrame, size=10):
         """Add the tracks in lists broken into chunks"""
@@ -27,7 +29,7 @@ class DataLoader:
 
         for chunk in chunks:
             logger.debug(f"Adding list of album to spotify with uri's: {chunk}")
-            self.spotify.current_user_saved_tracks_add(tracks=chunk)
+            self.rate_control.call(self.spotify.current_user_saved_tracks_add, tracks=chunk)
 
     def add_albums_to_spotify(self, df: pd.DataFrame, size=10):
         """Add the albums in lists broken into chunks"""
@@ -37,7 +39,7 @@ class DataLoader:
 
         for chunk in chunks:
             logger.debug(f"Adding list of album to spotify with uri's: {chunk}")
-            self.spotify.current_user_saved_albums_add(albums=chunk)
+            self.rate_control.call(self.spotify.current_user_saved_albums_add, albums=chunk)
 
     def remove_albums_from_spotify(self, df: pd.DataFrame, size=10):
         exclude_na = ~df["spotify_album_uri"].isna()
@@ -46,7 +48,7 @@ class DataLoader:
 
         for chunk in chunks:
             logger.debug(f"Deleting list of album to spotify with uri's: {chunk}")
-            self.spotify.current_user_saved_albums_delete(albums=chunk)
+            self.rate_control.call(self.spotify.current_user_saved_albums_delete, albums=chunk)
 
     def add_playlists(self, df: pd.DataFrame, size=5):
         """ Add Users playlists. Note: If re-run will add once again """
@@ -55,7 +57,9 @@ class DataLoader:
 
         for playlist in playlists:
             # Create the Playlist
-            response = self.spotify.user_playlist_create(self.user_id, playlist)
+            response = self.rate_control.call(
+                self.spotify.user_playlist_create, self.user_id, playlist, idempotent=False
+            )
 
             tracks_mask = (~df["spotify_track_uri"].isna()) & (
                 df["playlist_name"] == playlist
@@ -68,21 +72,19 @@ class DataLoader:
                 logger.info(
                     f"Adding tracks to playlist {playlist} to spotify with uri's: {chunk}"
                 )
-                self.spotify.playlist_add_items(response['id'], chunk)
-
-            sleep(2)
+                self.rate_control.call(self.spotify.playlist_add_items, response['id'], chunk, idempotent=False)
 
     def nuke_playlists(self):
         """Remove ALL users playlists"""
-        playlists = self.spotify.user_playlists(self.user_id)
+        playlists = self.rate_control.call(self.spotify.user_playlists, self.user_id)
 
         for playlist in playlists['items']:
             logger.info(f"Deleting playlist {playlist['name']} with id {playlist['id']}")
-            self.spotify.current_user_unfollow_playlist(playlist['id'])
+            self.rate_control.call(self.spotify.current_user_unfollow_playlist, playlist['id'])
 
     def nuke_albums(self):
         """Remove ALL current users albums"""
-        albums = self.spotify.current_user_saved_albums(limit=10)
+        albums = self.rate_control.call(self.spotify.current_user_saved_albums, limit=10)
 
         while albums:
             logger.debug(f"Deleting list of album to spotify with uri's: {albums}")
@@ -94,12 +96,12 @@ class DataLoader:
             if not album_uri:
                 return
 
-            self.spotify.current_user_saved_albums_delete(albums=album_uri)
-            albums = self.spotify.current_user_saved_albums(limit=10)
+            self.rate_control.call(self.spotify.current_user_saved_albums_delete, albums=album_uri)
+            albums = self.rate_control.call(self.spotify.current_user_saved_albums, limit=10)
 
     def nuke_tracks(self):
         """Remove ALL current users tracks"""
-        tracks = self.spotify.current_user_saved_tracks(limit=10)
+        tracks = self.rate_control.call(self.spotify.current_user_saved_tracks, limit=10)
 
         while tracks:
             logger.debug(f"Deleting list of tracks to spotify with uri's: {tracks}")
@@ -111,5 +113,5 @@ class DataLoader:
             if not track_uri:
                 return
 
-            self.spotify.current_user_saved_tracks_delete(tracks=track_uri)
-            tracks = self.spotify.current_user_saved_tracks(limit=10)
+            self.rate_control.call(self.spotify.current_user_saved_tracks_delete, tracks=track_uri)
+            tracks = self.rate_control.call(self.spotify.current_user_saved_tracks, limit=10)
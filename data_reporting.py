@@ -33,7 +33,7 @@ class DataReporter:
         logger.info(f"Albums not loaded written to {albums_failed}")
 
         albums_summary = HISTORY_PATH / "albums_failed_summary.csv"
-        df_summary = df_failed.groupby("spotify_search_album")[
+        df_summary = df_failed.groupby("spotify_search_album", observed=True)[
             "spotify_search_artist"
         ].count()
         df_summary.to_csv(albums_summary)
@@ -9,6 +9,7 @@ from data_linking import DataLinker
 from data_loading import DataLoader
 from data_reporting import DataReporter
 import log  # Do not remove
+from rate_control import RateController
 import utils
 
 logger = logging.getLogger(__name__)
@@ -33,34 +34,54 @@ def remove_albums(loader: DataLoader):
     loader.remove_albums_from_spotify(df)
 
 
-def round_2(cleaner: DataCleaner, linker: DataLinker):
+def round_2(cleaner: DataCleaner, linker: DataLinker, resume: bool = False):
     """
     - Unpickle
     - Clean (round 2)
+    - Pickle (2_linking), resumed from when linking is interrupted
     - Link with ISRC codes
     - Pickle
     """
     logging.info("Round 3")
-    df_combined = utils.read_pickle_df("1_cleaned")
-    df_combined = cleaner.clean_itunes_data_round_2(df_combined)
+    if resume and utils.checkpoint_exists("2_linking"):
+        logging.info("Resume linking from 2_linking")
+        df_combined = utils.read_pickle_df("2_linking")
+    else:
+        df_combined = utils.read_pickle_df("1_cleaned")
+        df_combined = cleaner.clean_itunes_data_round_2(df_combined)
+        utils.to_pickle_df(df_combined, "2_linking")
+
     df_combined = linker.extract_spotify_album_uri(df_combined)
 
     utils.to_pickle_df(df_combined, "2_cleaned")
+    utils.remove_checkpoint("2_linking")
 
 
-def round_1(cleaner: DataCleaner, linker: DataLinker):
+def round_1(cleaner: DataCleaner, linker: DataLinker, resume: bool = False):
     """
     - Unpickle
     - Clean (round 1)
-    - Link with ISRC codes
+    - Pickle (1_linking), resumed from when linking is interrupted
+    - Link rows with an ISRC by ISRC, by artist catalog and album first when enabled, the rest with a search for
+      their ISRC
     - Pickle
     """
     logging.info("Round 1")
-    df = utils.read_pickle_df("1_extracted")
-    df = cleaner.clean_itunes_data_round_1(df)
+    if resume and utils.checkpoint_exists("1_linking"):
+        logging.info("Resume linking from 1_linking")
+        df = utils.read_pickle_df("1_linking")
+    else:
+        df = utils.read_pickle_df("1_extracted")
+        df = cleaner.clean_itunes_data_round_1(df)
+        utils.to_pickle_df(df, "1_linking")
+
+    df = linker.extract_spotify_track_uri_by_isrc(df)
+    df = linker.extract_tracks_by_artist(df)
+    df = linker.extract_tracks_by_album(df)
     df = linker.extract_all_isrc_with_na(df)
 
     utils.to_pickle_df(df, "1_cleaned")
+    utils.remove_checkpoint("1_linking")
 
 
 def extract(extractor: DataExtractor, cleaner: DataCleaner):
@@ -73,14 +94,14 @@ def extract(extractor: DataExtractor, cleaner: DataCleaner):
 
 def extract_from_library_xml(extractor: DataExtractor):
     logging.info("Extract from Apple Library XML")
-    df = extractor.read_tracks_from_apple_library()
+    df, _ = extractor.read_apple_library()
 
     utils.to_pickle_df(df, "1_extracted")
 
 
 def extract_playlists(extractor: DataExtractor):
     logging.info("Extract playlists from Library.xml")
-    df = extractor.read_playlists_from_apple_library()
+    _, df = extractor.read_apple_library()
 
     utils.to_pickle_df(df, "playlist_extracted")
 
@@ -199,6 +220,13 @@ def get_parser():
         "--skip-verify", help="Skip user verification", action="store_true"
     )
 
+    parser.add_argument(
+        "--resume",
+        help="With --run or --clean, resume an interrupted run from the linking it stopped in. Searches already "
+        "in the request history are not repeated",
+        action="store_true",
+    )
+
     return parser
 
 
@@ -218,10 +246,14 @@ def command_line_runner(
     logging.info("See spotify.log for debug logging")
 
     if args.run:
-        # Extract and clean albums and tracks
-        extract_from_library_xml(data_extractor)
-        round_1(data_cleaner, data_linker)
-        round_2(data_cleaner, data_linker)
+        # Extract and clean albums and tracks, when resuming skip the stages before the interrupted linking
+        resume_round_2 = args.resume and utils.checkpoint_exists("2_linking")
+        resume_round_1 = args.resume and utils.checkpoint_exists("1_linking")
+        if not (resume_round_1 or resume_round_2):
+            extract_from_library_xml(data_extractor)
+        if not resume_round_2:
+            round_1(data_cleaner, data_linker, resume=resume_round_1)
+        round_2(data_cleaner, data_linker, resume=resume_round_2)
 
         # Extract and clean playlists
         extract_playlists(data_extractor)
@@ -249,8 +281,9 @@ def command_line_runner(
         return
 
     if args.clean:
-        round_1(data_cleaner, data_linker)
-        round_2(data_cleaner, data_linker)
+        if not (args.resume and utils.checkpoint_exists("2_linking")):
+            round_1(data_cleaner, data_linker, resume=args.resume)
+        round_2(data_cleaner, data_linker, resume=args.resume)
 
     if args.load_albums:
         load_albums(data_loader)
@@ -277,12 +310,17 @@ def command_line_runner(
 
 
 if __name__ == "__main__":
+    # Spotify rate limits apply to the app, searching and loading share one rate controller
+    rate_controller = RateController()
     data_cleaner = DataCleaner()
-    data_linker = DataLinker(spotify=spotify_get())
-    data_loader = DataLoader(spotify=spotify_post())
+    data_linker = DataLinker(spotify=spotify_get(), rate_control=rate_controller)
+    data_loader = DataLoader(spotify=spotify_post(), rate_control=rate_controller)
     data_extractor = DataExtractor(mode="PROD")
     data_reporter = DataReporter()
 
-    command_line_runner(
-        data_extractor, data_cleaner, data_linker, data_loader, data_reporter
-    )
+    try:
+        command_line_runner(
+            data_extractor, data_cleaner, data_linker, data_loader, data_reporter
+        )
+    finally:
+        rate_controller.write_decisions()
@@ -0,0 +1,204 @@
+"""
+Rate control for all calls to the Spotify API, shared by DataLinker and DataLoader (and their worker threads).
+
+A token bucket whose rate adapts, additive increase while calls succeed and multiplicative decrease on a
+429 response. A Retry-After header pauses every caller for that long, other transient errors (5xx, connection
+errors) of idempotent calls are retried after a jittered exponential backoff, and a run of consecutive errors opens a circuit
+breaker which pauses every caller together. Each change is recorded as a RateDecision to tune the settings.
+"""
+from collections import deque
+import csv
+from dataclasses import asdict, dataclass, fields
+import logging
+import random
+import threading
+from time import monotonic, sleep
+from typing import Callable, Deque, Optional
+
+import requests
+from spotipy.exceptions import SpotifyException
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttled(error: Exception) -> bool:
+    """Return True for a 429 Too Many Requests"""
+    return isinstance(error, SpotifyException) and error.http_status == 429
+
+
+def is_transient(error: Exception) -> bool:
+    """Return True if the call may succeed when retried, throttled, a server error or no connection"""
+    if isinstance(error, SpotifyException):
+        return error.http_status == 429 or error.http_status >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Return the seconds from the Retry-After header of a throttled response, if sent"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def error_reason(error: Exception) -> str:
+    """Short description of an error, http_<status> for a response or the exception name"""
+    status = getattr(error, "http_status", None)
+    return f"http_{status}" if status is not None else type(error).__name__
+
+
+@dataclass
+class RateDecision:
+    time: float
+    event: str  # increase, decrease, retry_after, backoff, breaker_open, breaker_close
+    rate: float
+    detail: str = ""
+
+
+class RateController:
+    """Adaptive token bucket with backoff and a circuit breaker, safe to share between threads"""
+
+    def __init__(
+        self,
+        rate: float = config.SPOTIFY_REQUESTS_PER_SECOND,
+        min_rate: float = config.RATE_MIN,
+        max_rate: float = config.RATE_MAX,
+        increase: float = config.RATE_INCREASE,
+        decrease: float = config.RATE_DECREASE,
+        burst: float = config.RATE_BURST,
+        max_retries: int = config.RATE_MAX_RETRIES,
+        backoff: float = config.RATE_BACKOFF,
+        max_backoff: float = config.RATE_MAX_BACKOFF,
+        breaker_errors: int = config.RATE_BREAKER_ERRORS,
+        breaker_pause: float = config.RATE_BREAKER_PAUSE,
+        clock: Callable[[], float] = monotonic,
+        sleep: Callable[[float], None] = sleep,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase  # Added to the rate per second of calls without a 429
+        self.decrease = decrease  # Rate multiplied by on a 429
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_errors = breaker_errors
+        self.breaker_pause = breaker_pause
+        self.clock = clock
+        self.sleep = sleep
+
+        self.decisions: Deque[RateDecision] = deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self._tokens = min(burst, 1)
+        self._updated = clock()
+        self._last_change = self._updated
+        self._paused_until = 0.0
+        self._errors = 0  # Consecutive calls failing with a transient error
+
+    def _decide(self, event: str, detail: str = ""):
+        """Record a decision, called holding the lock"""
+        decision = RateDecision(time=self.clock(), event=event, rate=round(self.rate, 3), detail=detail)
+        self.decisions.append(decision)
+        logger.debug(f"Rate control {event}, rate {decision.rate}/s {detail}")
+
+    def _pause(self, seconds: float, event: str, detail: str = ""):
+        """Pause every caller for seconds, called holding the lock"""
+        until = self.clock() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._decide(event, f"pause {seconds:.1f}s {detail}".strip())
+
+    def acquire(self):
+        """Block until the calling thread may make a call, the circuit is closed and a token is available"""
+        while True:
+            with self._lock:
+                now = self.clock()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    # Tolerance for the rounding of the refill, a token short by a rounding error is a token
+                    if self._tokens >= 1 - 1e-9:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+
+            self.sleep(wait)
+
+    def on_success(self):
+        """Additive increase, once per second of calls without a 429"""
+        with self._lock:
+            if self._errors >= self.breaker_errors:
+                self._decide("breaker_close")
+            self._errors = 0
+
+            now = self.clock()
+            if now - self._last_change >= 1 and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self._last_change = now
+                self._decide("increase")
+
+    def on_error(self, error: Exception) -> float:
+        """
+        Multiplicative decrease on a 429 and pause all callers for its Retry-After. Open the circuit breaker
+        after consecutive errors. Returns the jittered backoff for the calling thread
+        """
+        with self._lock:
+            self._errors += 1
+            detail = error_reason(error)
+
+            if is_throttled(error):
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_change = self.clock()
+                self._tokens = min(self._tokens, 0)
+                self._decide("decrease", detail)
+
+                seconds = retry_after(error)
+                if seconds is not None:
+                    self._pause(seconds, "retry_after")
+
+            if self._errors % self.breaker_errors == 0:
+                self._pause(self.breaker_pause, "breaker_open", f"after {self._errors} errors")
+
+            # Full jitter, a random wait up to the exponential backoff
+            backoff = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** min(self._errors, 16)))
+            self._decide("backoff", f"{detail} {backoff:.2f}s")
+            return backoff
+
+    def call(self, fn: Callable, *args, idempotent: bool = True, **kwargs):
+        """
+        Make a rate controlled call to fn, retrying transient errors up to max_retries. A call which is not
+        idempotent (e.g. creating a playlist) is only retried when throttled, after a 5xx or a lost connection
+        the server may already have acted on it
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except (SpotifyException, requests.ConnectionError, requests.Timeout) as e:
+                retry = is_transient(e) if idempotent else is_throttled(e)
+                if not retry or attempt == self.max_retries:
+                    raise
+                self.sleep(self.on_error(e))
+                continue
+
+            self.on_success()
+            return result
+
+    def write_decisions(self, filename: str = "rate_decisions.csv"):
+        """Write the decisions to a .csv file in the history folder"""
+        path = config.HISTORY_PATH / filename
+        with self._lock:
+            decisions = list(self.decisions)
+
+        with open(path, "w", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=[field.name for field in fields(RateDecision)])
+            writer.writeheader()
+            writer.writerows(asdict(decision) for decision in decisions)
+
+        logger.info(f"Rate control decisions written to {path}")
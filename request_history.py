@@ -0,0 +1,320 @@
+"""
+The spotify request history, an SQLite store keyed by canonical search key (see DataLinker._search_key).
+
+Successful searches keep only the fields read back from the search result and tracks fetched by uri are keyed
+by the uri. Album tracklists and the albums of artist catalogs (see DataLinker.extract_tracks_by_album and
+extract_tracks_by_artist) keep the fields matched against.
+Failed searches keep the reason, the number of attempts and when to retry: the retry spacing doubles with each
+attempt, from the failure TTL for a search with no result and the (shorter) transient TTL for an error. A search
+with no result is not retried after max_attempts and the least recently failed searches are evicted beyond
+max_failures. Writes are upserts, committed every flush_requests searches or flush_seconds (see flush) so an
+interrupted run keeps its searches. Lookups are made on demand, in batches, so the history is never loaded or
+rewritten in full.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import pandas as pd
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# The fields kept from a search result, named as the columns they populate
+RESULT_FIELDS = ("isrc", "spotify_track_uri", "spotify_artist_uri", "spotify_total_tracks", "spotify_album_uri")
+
+# The fields kept for each track of an album's tracklist
+ALBUM_TRACK_FIELDS = ("disc_number", "track_number", "name", "spotify_track_uri", "spotify_artist_uri")
+
+# Reason recorded for a search returning no items
+NO_RESULT = "no_result"
+
+
+def open_request_history(path: Optional[Path] = None) -> "RequestHistory":
+    """
+    The request history, shared between users and machines through Redis when REDIS_URL is set (in the
+    environment or .env, see shared_history.py), otherwise local
+    """
+    url = os.environ.get("REDIS_URL", config.REDIS_URL)
+    if not url:
+        return RequestHistory(path)
+
+    from shared_history import SharedRequestHistory
+
+    return SharedRequestHistory.from_url(url, path)
+
+
+def search_type_of(key: str) -> str:
+    """Search type from the search key, album searches start album:"""
+    return "album" if key.startswith("album:") else "track"
+
+
+class RequestHistory:
+    """Successful and failed spotify searches by search key"""
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        failure_ttl: float = config.HISTORY_FAILURE_TTL,
+        transient_ttl: float = config.HISTORY_TRANSIENT_TTL,
+        max_ttl: float = config.HISTORY_MAX_TTL,
+        max_attempts: int = config.HISTORY_MAX_ATTEMPTS,
+        max_failures: int = config.HISTORY_MAX_FAILURES,
+        flush_requests: int = config.HISTORY_FLUSH_REQUESTS,
+        flush_seconds: float = config.HISTORY_FLUSH_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = path or config.HISTORY_PATH / "request_history.sqlite3"
+        self.failure_ttl = failure_ttl
+        self.transient_ttl = transient_ttl
+        self.max_ttl = max_ttl
+        self.max_attempts = max_attempts
+        self.max_failures = max_failures
+        self.flush_requests = flush_requests
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self._pending = 0  # Searches recorded since the last commit
+        self._committed = clock()
+        self.connection = sqlite3.connect(self.path)
+        self._create_tables()
+        self._upgrade_failure_table()
+
+    def _create_tables(self):
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS success (
+                key TEXT PRIMARY KEY,
+                search_type TEXT NOT NULL,
+                isrc TEXT,
+                spotify_track_uri TEXT,
+                spotify_artist_uri TEXT,
+                spotify_total_tracks INTEGER,
+                spotify_album_uri TEXT
+            );
+            CREATE TABLE IF NOT EXISTS failure (
+                key TEXT PRIMARY KEY,
+                search_type TEXT NOT NULL,
+                reason TEXT,
+                transient INTEGER,
+                attempts INTEGER,
+                first_failed REAL,
+                last_failed REAL,
+                retry_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS album_track (
+                album_uri TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                disc_number INTEGER,
+                track_number INTEGER,
+                name TEXT,
+                spotify_track_uri TEXT,
+                spotify_artist_uri TEXT,
+                PRIMARY KEY (album_uri, position)
+            );
+            CREATE TABLE IF NOT EXISTS artist_album (
+                artist_uri TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                album_uri TEXT NOT NULL,
+                album_name TEXT,
+                PRIMARY KEY (artist_uri, position)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+
+    def _upgrade_failure_table(self):
+        """
+        Add the retry columns to a failure table holding only keys. Its failures are treated as a first
+        attempt with no result, failed now
+        """
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(failure)")}
+        if "retry_at" in columns:
+            self.connection.execute("CREATE INDEX IF NOT EXISTS failure_last_failed ON failure (last_failed)")
+            return
+
+        for column, column_type in (
+            ("reason", "TEXT"), ("transient", "INTEGER"), ("attempts", "INTEGER"),
+            ("first_failed", "REAL"), ("last_failed", "REAL"), ("retry_at", "REAL"),
+        ):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE failure ADD COLUMN {column} {column_type}")
+
+        now = self.clock()
+        self.connection.execute(
+            "UPDATE failure SET reason = ?, transient = 0, attempts = 1, first_failed = ?, last_failed = ?, "
+            "retry_at = ? WHERE retry_at IS NULL",
+            (NO_RESULT, now, now, now + min(self.failure_ttl, self.max_ttl)),
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS failure_last_failed ON failure (last_failed)")
+        self.commit()
+
+    @property
+    def migrated(self) -> bool:
+        """True once the pickled history has been migrated"""
+        return self.connection.execute("SELECT 1 FROM meta WHERE name = 'migrated'").fetchone() is not None
+
+    def set_migrated(self):
+        self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('migrated', '1')")
+        self.commit()
+
+    def add_success(self, key: str, search_type: str, fields: Dict):
+        """Record the fields of a successful search, replacing an earlier failure"""
+        self._pending += 1
+        self.connection.execute("DELETE FROM failure WHERE key = ?", (key,))
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO success (key, search_type, {', '.join(RESULT_FIELDS)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(RESULT_FIELDS))})",
+            (key, search_type, *(fields.get(field) for field in RESULT_FIELDS)),
+        )
+
+    def retry_at(self, attempts: int, transient: bool, now: float) -> Optional[float]:
+        """When to retry a search after its attempts failed, None if it is not retried"""
+        if not transient and attempts >= self.max_attempts:
+            return None
+        ttl = self.transient_ttl if transient else self.failure_ttl
+        return now + min(self.max_ttl, ttl * 2 ** (attempts - 1))
+
+    def add_failure(self, key: str, search_type: str, reason: str = NO_RESULT, transient: bool = False):
+        """Record a failed search, counting the attempt and setting when to retry it"""
+        self._pending += 1
+        now = self.clock()
+        previous = self.connection.execute(
+            "SELECT attempts, first_failed FROM failure WHERE key = ?", (key,)
+        ).fetchone()
+        attempts, first_failed = (previous[0] + 1, previous[1]) if previous else (1, now)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO failure "
+            "(key, search_type, reason, transient, attempts, first_failed, last_failed, retry_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, search_type, reason, int(transient), attempts, first_failed, now,
+             self.retry_at(attempts, transient, now)),
+        )
+
+    def _select(self, sql: str, keys: List[str]) -> List:
+        """Run sql for keys in one query, {} stands for the keys, passed as one JSON array parameter"""
+        return self.connection.execute(sql.format("SELECT value FROM json_each(?)"), (json.dumps(keys),)).fetchall()
+
+    def known(self, keys: Iterable[str]) -> Set[str]:
+        """Return the keys with a recorded success or a failure not yet due a retry"""
+        keys = list(keys)
+        return {key for key, *_ in self._results(keys)} | self.failures_not_due(keys)
+
+    def failures_not_due(self, keys: Iterable[str]) -> Set[str]:
+        """Return the keys with a recorded failure not yet due a retry"""
+        rows = self._select("SELECT key, retry_at FROM failure WHERE key IN ({})", list(keys))
+        now = self.clock()
+        return {key for key, retry_at in rows if retry_at is None or retry_at > now}
+
+    def failures(self, keys: Iterable[str]) -> Set[str]:
+        """Return the keys with a recorded failure"""
+        return {key for key, in self._select("SELECT key FROM failure WHERE key IN ({})", list(keys))}
+
+    def failure(self, key: str) -> Optional[Dict]:
+        """Return the recorded failure of key, its reason, attempts and times"""
+        columns = ("reason", "transient", "attempts", "first_failed", "last_failed", "retry_at")
+        row = self.connection.execute(f"SELECT {', '.join(columns)} FROM failure WHERE key = ?", (key,)).fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    def evict(self) -> int:
+        """Delete the least recently failed searches beyond max_failures, returns the number deleted"""
+        excess = self.connection.execute("SELECT COUNT(*) FROM failure").fetchone()[0] - self.max_failures
+        if excess <= 0:
+            return 0
+
+        self.connection.execute(
+            "DELETE FROM failure WHERE key IN (SELECT key FROM failure ORDER BY last_failed LIMIT ?)", (excess,)
+        )
+        logger.info(f"Evicted {excess} failed requests from the request history")
+        return excess
+
+    def _results(self, keys: Iterable[str]) -> List:
+        return self._select(f"SELECT key, {', '.join(RESULT_FIELDS)} FROM success WHERE key IN ({{}})", list(keys))
+
+    def results(self, keys: Iterable[str]) -> Dict[str, Dict]:
+        """Return the fields of the successful searches for keys, by key"""
+        return {key: dict(zip(RESULT_FIELDS, values)) for key, *values in self._results(keys)}
+
+    def results_frame(self, keys: Iterable[str]) -> pd.DataFrame:
+        """Return the fields of the successful searches for keys as a frame indexed by key, values as object"""
+        return pd.DataFrame.from_records(
+            self._results(keys), columns=("key", *RESULT_FIELDS), index="key", coerce_float=False
+        ).astype(object)
+
+    def add_album_tracks(self, album_uri: str, tracks: List[Dict]):
+        """Record the tracklist of an album, each track a dict of ALBUM_TRACK_FIELDS"""
+        self._pending += 1
+        self.connection.execute("DELETE FROM album_track WHERE album_uri = ?", (album_uri,))
+        self.connection.executemany(
+            f"INSERT INTO album_track (album_uri, position, {', '.join(ALBUM_TRACK_FIELDS)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(ALBUM_TRACK_FIELDS))})",
+            [
+                (album_uri, position, *(track.get(field) for field in ALBUM_TRACK_FIELDS))
+                for position, track in enumerate(tracks)
+            ],
+        )
+
+    def album_tracks(self, album_uris: Iterable[str]) -> Dict[str, List[Dict]]:
+        """Return the recorded tracklists of albums, by album uri"""
+        rows = self._select(
+            f"SELECT album_uri, {', '.join(ALBUM_TRACK_FIELDS)} FROM album_track WHERE album_uri IN ({{}}) "
+            f"ORDER BY album_uri, position",
+            list(album_uris),
+        )
+        tracklists = {}
+        for album_uri, *values in rows:
+            tracklists.setdefault(album_uri, []).append(dict(zip(ALBUM_TRACK_FIELDS, values)))
+        return tracklists
+
+    def add_artist_albums(self, artist_uri: str, albums: List[Dict]):
+        """Record the albums of an artist's catalog, each a dict of album_uri and album_name"""
+        self._pending += 1
+        self.connection.execute("DELETE FROM artist_album WHERE artist_uri = ?", (artist_uri,))
+        self.connection.executemany(
+            "INSERT INTO artist_album (artist_uri, position, album_uri, album_name) VALUES (?, ?, ?, ?)",
+            [(artist_uri, position, album["album_uri"], album["album_name"]) for position, album in enumerate(albums)],
+        )
+
+    def artist_albums(self, artist_uris: Iterable[str]) -> Dict[str, List[Dict]]:
+        """Return the recorded albums of artists' catalogs, by artist uri"""
+        rows = self._select(
+            "SELECT artist_uri, album_uri, album_name FROM artist_album WHERE artist_uri IN ({}) "
+            "ORDER BY artist_uri, position",
+            list(artist_uris),
+        )
+        catalogs = {}
+        for artist_uri, album_uri, album_name in rows:
+            catalogs.setdefault(artist_uri, []).append({"album_uri": album_uri, "album_name": album_name})
+        return catalogs
+
+    def __len__(self) -> int:
+        return sum(
+            self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("success", "failure")
+        )
+
+    def flush(self) -> bool:
+        """Commit once flush_requests searches are recorded or flush_seconds have passed, returns True if committed"""
+        if self._pending >= self.flush_requests or (
+            self._pending and self.clock() - self._committed >= self.flush_seconds
+        ):
+            self.commit()
+            return True
+        return False
+
+    def commit(self):
+        self.evict()
+        self.connection.commit()
+        self._pending = 0
+        self._committed = self.clock()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,149 @@
+"""
+The request history shared between users and machines through Redis, in front of the local request history.
+
+Lookups are made locally first, keys not found locally are read from Redis with pipelined GETs, a batch of
+REDIS_BATCH_SIZE keys per round trip, and copied to the local history. Searches recorded locally are queued
+and written to Redis with pipelined SETs on each commit, with a TTL: REDIS_TTL for results, tracklists and
+catalogs, the failure TTL for a search with no result. Errors (429, 5xx, no connection) are not shared.
+
+If Redis is unreachable, or fails during a run, a warning is logged and the run carries on with the local
+history only.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import redis
+
+import config
+from request_history import NO_RESULT, RESULT_FIELDS, RequestHistory
+import utils
+
+logger = logging.getLogger(__name__)
+
+
+class SharedRequestHistory(RequestHistory):
+    """The local request history with Redis as a shared second tier"""
+
+    def __init__(
+        self,
+        client,
+        path: Optional[Path] = None,
+        prefix: str = config.REDIS_PREFIX,
+        ttl: int = config.REDIS_TTL,
+        batch_size: int = config.REDIS_BATCH_SIZE,
+        **kwargs,
+    ):
+        self.client = client  # redis.Redis, None once unreachable
+        self.prefix = prefix
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self._queued: Dict[str, Tuple[str, int]] = {}  # Redis key: (value, ttl) to write on commit
+        self._shared_failures: Set[str] = set()  # Keys read from Redis as searches with no result
+        super().__init__(path, **kwargs)
+
+    @classmethod
+    def from_url(cls, url: str, path: Optional[Path] = None, **kwargs) -> "SharedRequestHistory":
+        client = redis.Redis.from_url(
+            url, socket_timeout=config.REDIS_TIMEOUT, socket_connect_timeout=config.REDIS_TIMEOUT
+        )
+        return cls(client, path, **kwargs)
+
+    def _unreachable(self, error: Exception):
+        logger.warning(f"Redis unreachable, using the local request history only: {error}")
+        self.client = None
+
+    def _get(self, namespace: str, keys: List[str]) -> Dict[str, object]:
+        """Read keys of a namespace from Redis, a pipeline of GETs per batch. Returns the values found by key"""
+        if self.client is None or not keys:
+            return {}
+
+        found = {}
+        try:
+            for batch in utils.chunked(keys, self.batch_size):
+                pipeline = self.client.pipeline(transaction=False)
+                for key in batch:
+                    pipeline.get(f"{self.prefix}{namespace}:{key}")
+                for key, value in zip(batch, pipeline.execute()):
+                    if value is not None:
+                        found[key] = json.loads(value)
+        except (redis.RedisError, OSError) as e:
+            self._unreachable(e)
+
+        return found
+
+    def _queue(self, namespace: str, key: str, value, ttl: int):
+        if self.client is not None:
+            self._queued[f"{self.prefix}{namespace}:{key}"] = (json.dumps(value), ttl)
+
+    def _write_queued(self):
+        """Write the queued entries to Redis, a pipeline of SETs per batch"""
+        queued, self._queued = self._queued, {}
+        if self.client is None or not queued:
+            return
+
+        try:
+            for batch in utils.chunked(list(queued.items()), self.batch_size):
+                pipeline = self.client.pipeline(transaction=False)
+                for key, (value, ttl) in batch:
+                    pipeline.set(key, value, ex=max(1, int(ttl)))
+                pipeline.execute()
+        except (redis.RedisError, OSError) as e:
+            self._unreachable(e)
+
+    def add_success(self, key: str, search_type: str, fields: Dict):
+        super().add_success(key, search_type, fields)
+        self._queue("search", key, {"search_type": search_type, "fields": fields}, self.ttl)
+
+    def add_failure(self, key: str, search_type: str, reason: str = NO_RESULT, transient: bool = False):
+        super().add_failure(key, search_type, reason, transient)
+        if not transient:
+            self._queue("search", key, {"search_type": search_type, "failure": reason}, self.failure_ttl)
+
+    def _results(self, keys: Iterable[str]) -> List:
+        keys = list(keys)
+        rows = super()._results(keys)
+        found = {key for key, *_ in rows}
+
+        for key, value in self._get("search", [key for key in keys if key not in found]).items():
+            if "failure" in value:
+                self._shared_failures.add(key)
+                continue
+            # Copied to the local history, not queued back to Redis
+            RequestHistory.add_success(self, key, value["search_type"], value["fields"])
+            rows.append((key, *(value["fields"].get(field) for field in RESULT_FIELDS)))
+
+        return rows
+
+    def failures_not_due(self, keys: Iterable[str]) -> Set[str]:
+        keys = list(keys)
+        return super().failures_not_due(keys) | self._shared_failures.intersection(keys)
+
+    def add_album_tracks(self, album_uri: str, tracks: List[Dict]):
+        super().add_album_tracks(album_uri, tracks)
+        self._queue("album_tracks", album_uri, tracks, self.ttl)
+
+    def album_tracks(self, album_uris: Iterable[str]) -> Dict[str, List[Dict]]:
+        album_uris = list(album_uris)
+        tracklists = super().album_tracks(album_uris)
+        shared = self._get("album_tracks", [uri for uri in album_uris if uri not in tracklists])
+        for album_uri, tracks in shared.items():
+            RequestHistory.add_album_tracks(self, album_uri, tracks)
+        return {**tracklists, **shared}
+
+    def add_artist_albums(self, artist_uri: str, albums: List[Dict]):
+        super().add_artist_albums(artist_uri, albums)
+        self._queue("artist_albums", artist_uri, albums, self.ttl)
+
+    def artist_albums(self, artist_uris: Iterable[str]) -> Dict[str, List[Dict]]:
+        artist_uris = list(artist_uris)
+        catalogs = super().artist_albums(artist_uris)
+        shared = self._get("artist_albums", [uri for uri in artist_uris if uri not in catalogs])
+        for artist_uri, albums in shared.items():
+            RequestHistory.add_artist_albums(self, artist_uri, albums)
+        return {**catalogs, **shared}
+
+    def commit(self):
+        super().commit()
+        self._write_queued()
@@ -0,0 +1,579 @@
+"""
+A local stand-in for the Spotify Web API, to benchmark and load test linking and loading without the network or
+the app's shared rate limit.
+
+Serves the endpoints the DataLinker and DataLoader call: search, albums, album tracks, tracks, artist albums,
+me, saved tracks and albums, playlist create, add items and unfollow. Responses are built from a seed catalog,
+the tracks of synthetic_library.generate_tracks so a synthetic library of the same size and seed links against
+it, or replayed from a recording. Latency, 429s with a Retry-After header and 5xx errors are injected at the
+given rates. The bearer token names the user, each user has their own saved tracks, albums and playlists.
+
+    python spotify_stub.py --tracks 10000 --port 8787 --latency 0.05 --rate-429 0.01 --rate-5xx 0.01
+    SPOTIFY_STUB_URL=http://127.0.0.1:8787/v1/ python main.py --run
+
+With --record the catalog endpoints are forwarded to the real API (with the app's client credentials from .env)
+and the responses appended to a json lines file, replayed with --replay.
+"""
+import argparse
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from synthetic_library import generate_tracks
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/v1/"
+# Search fields, artist:<artist> track:<track> year:<year>, album:<album>, isrc:<isrc>
+QUERY_FIELD = re.compile(r"(artist|track|album|year|isrc):(.*?)(?=\s+(?:artist|track|album|year|isrc):|$)")
+BRACKETS = re.compile(r"\([^)]*\)|\[[^]]*]")
+ARTIST_JOIN = re.compile(r"\s+(?:feat\.?|ft\.?|&|with)\s+.*$")
+NOT_WORD = re.compile(r"[^\w\s]")
+
+
+def normalize(text: Optional[str]) -> str:
+    """Text compared by the catalog's search, without case, brackets, punctuation or featured artists"""
+    if not text:
+        return ""
+    text = ARTIST_JOIN.sub("", BRACKETS.sub("", text.casefold()))
+    return " ".join(NOT_WORD.sub("", text).split())
+
+
+def parse_query(q: str) -> Dict[str, str]:
+    """The fields of a search query, e.g. {"artist": "queen", "track": "innuendo"}"""
+    return {name: value.strip() for name, value in QUERY_FIELD.findall(q)}
+
+
+def _id(kind: str, number: int) -> str:
+    """A spotify id, alphanumeric as spotipy checks"""
+    return f"syn{kind}{number:010d}"
+
+
+def paging(items: List, limit: int, offset: int, href: str = "") -> Dict:
+    total = len(items)
+    return {
+        "href": href,
+        "items": items[offset:offset + limit],
+        "limit": limit,
+        "offset": offset,
+        "total": total,
+        "next": f"{href}?offset={offset + limit}&limit={limit}" if offset + limit < total else None,
+        "previous": None,
+    }
+
+
+class Catalog:
+    """Tracks, albums and artists answering searches and lookups by id"""
+
+    def __init__(self, synthesize: bool = False):
+        self.synthesize = synthesize  # Answer searches not in the catalog with a track or album made from the query
+        self.tracks: Dict[str, Dict] = {}  # id: track
+        self.albums: Dict[str, Dict] = {}  # id: album, without its tracks
+        self.album_tracks: Dict[str, List[str]] = defaultdict(list)  # album id: track ids
+        self.artists: Dict[str, Dict] = {}  # id: artist
+        self.artist_albums: Dict[str, List[str]] = defaultdict(list)  # artist id: album ids
+        self._by_track: Dict[Tuple[str, str], List[str]] = defaultdict(list)  # (artist, track) normalized: ids
+        self._by_album: Dict[str, List[str]] = defaultdict(list)  # album normalized: ids
+        self._by_artist: Dict[str, str] = {}  # artist normalized: id
+        self._by_isrc: Dict[str, str] = {}
+        self._synthesized_tracks: Dict[str, Dict] = {}  # query: track
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_synthetic(cls, tracks: int, seed: int = 0, coverage: float = 1.0, synthesize: bool = False) -> "Catalog":
+        """
+        The catalog of a synthetic library (synthetic_library.generate_tracks), an album kept with the probability
+        coverage so the rest are searched with no result
+        """
+        rng = random.Random(seed)
+        catalog = cls(synthesize=synthesize)
+        albums = defaultdict(dict)
+        for track in generate_tracks(tracks, seed=seed):
+            if track.name is not None:
+                # A duplicated album is the same album on spotify
+                albums[(track.album_artist, track.album, track.year)].setdefault(track.track_number, track)
+
+        for (album_artist, album_name, year), album_tracks in albums.items():
+            if rng.random() >= coverage:
+                continue
+            album = catalog.add_album(album_name, album_artist, year)
+            for track in album_tracks.values():
+                catalog.add_track(album, track.name, track.track_number, track.disc_number, track.isrc)
+
+        return catalog
+
+    def add_artist(self, name: str) -> Dict:
+        key = normalize(name)
+        if key not in self._by_artist:
+            artist_id = _id("r", len(self.artists) + 1)
+            self.artists[artist_id] = {"id": artist_id, "uri": f"spotify:artist:{artist_id}", "name": name}
+            self._by_artist[key] = artist_id
+        return self.artists[self._by_artist[key]]
+
+    def add_album(self, name: str, artist: str, year: int) -> Dict:
+        album_id = _id("a", len(self.albums) + 1)
+        artist = self.add_artist(artist)
+        album = {
+            "id": album_id,
+            "uri": f"spotify:album:{album_id}",
+            "name": name,
+            "album_type": "album",
+            "artists": [artist],
+            "release_date": str(year),
+            "total_tracks": 0,
+        }
+        self.albums[album_id] = album
+        self._by_album[normalize(name)].append(album_id)
+        self.artist_albums[artist["id"]].append(album_id)
+        return album
+
+    def add_track(self, album: Dict, name: str, track_number: int, disc_number: int = 1, isrc: str = None) -> Dict:
+        track_id = _id("t", len(self.tracks) + 1)
+        track = {
+            "id": track_id,
+            "uri": f"spotify:track:{track_id}",
+            "name": name,
+            "track_number": track_number,
+            "disc_number": disc_number,
+            "artists": album["artists"],
+            "album_id": album["id"],
+            "external_ids": {"isrc": isrc or f"SYN{int(hashlib.sha1(track_id.encode()).hexdigest(), 16) % 10**9:09d}"},
+        }
+        self.tracks[track_id] = track
+        self.album_tracks[album["id"]].append(track_id)
+        album["total_tracks"] += 1
+        self._by_track[(normalize(album["artists"][0]["name"]), normalize(name))].append(track_id)
+        self._by_isrc[track["external_ids"]["isrc"]] = track_id
+        return track
+
+    def simplified_track(self, track_id: str) -> Dict:
+        track = self.tracks[track_id]
+        return {key: value for key, value in track.items() if key not in ("album_id", "external_ids")}
+
+    def track(self, track_id: str) -> Optional[Dict]:
+        """A track with its album, as returned by search and tracks"""
+        if track_id not in self.tracks:
+            return None
+        track = self.tracks[track_id]
+        return {
+            **self.simplified_track(track_id), "external_ids": track["external_ids"],
+            "album": self.albums[track["album_id"]],
+        }
+
+    def album(self, album_id: str) -> Optional[Dict]:
+        """An album with the first page of its tracks, as returned by albums"""
+        if album_id not in self.albums:
+            return None
+        tracks = [self.simplified_track(track_id) for track_id in self.album_tracks[album_id]]
+        return {**self.albums[album_id], "tracks": paging(tracks, 50, 0, f"albums/{album_id}/tracks")}
+
+    def _synthesized(self, q: str) -> Dict:
+        """An album and track made from the query, the same for the same query"""
+        fields = parse_query(q)
+        with self._lock:
+            if q not in self._synthesized_tracks:
+                album = self.add_album(fields.get("album") or q, fields.get("artist") or q, 2000)
+                self._synthesized_tracks[q] = self.add_track(album, fields.get("track") or q, 1)
+            return self._synthesized_tracks[q]
+
+    def search(self, q: str, search_type: str) -> List[Dict]:
+        """The items found for a query, tracks, albums or artists"""
+        fields = parse_query(q)
+        artist = normalize(fields.get("artist"))
+
+        if search_type == "track":
+            if "isrc" in fields:
+                ids = [self._by_isrc[fields["isrc"]]] if fields["isrc"] in self._by_isrc else []
+            else:
+                ids = list(self._by_track.get((artist, normalize(fields.get("track"))), []))
+            if not ids and self.synthesize and "isrc" not in fields:
+                ids = [self._synthesized(q)["id"]]
+            return [self.track(track_id) for track_id in ids]
+
+        if search_type == "album":
+            ids = [
+                album_id for album_id in self._by_album.get(normalize(fields.get("album")), [])
+                if not artist or normalize(self.albums[album_id]["artists"][0]["name"]) == artist
+            ]
+            if not ids and self.synthesize:
+                ids = [self._synthesized(q)["album_id"]]
+            return [self.albums[album_id] for album_id in ids]
+
+        if search_type == "artist":
+            artist_id = self._by_artist.get(normalize(fields.get("artist", q)))
+            return [self.artists[artist_id]] if artist_id else []
+
+        return []
+
+
+@dataclass
+class Faults:
+    """Faults injected into the responses, rates are the probability of each request"""
+
+    latency: float = 0.0  # Seconds added to every response
+    jitter: float = 0.0  # Up to this many seconds more, at random
+    rate_429: float = 0.0
+    retry_after: int = 1  # Retry-After of a 429, seconds
+    rate_5xx: float = 0.0
+    seed: int = 0
+    _rng: random.Random = field(init=False, repr=False)
+    _lock: threading.Lock = field(init=False, repr=False, default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def draw(self) -> Tuple[float, Optional[int]]:
+        """The delay of a response and the error status to answer with, if any"""
+        with self._lock:
+            delay = self.latency + self._rng.random() * self.jitter
+            draw = self._rng.random()
+        if draw < self.rate_429:
+            return delay, 429
+        if draw < self.rate_429 + self.rate_5xx:
+            return delay, 503
+        return delay, None
+
+
+class Recording:
+    """Responses by request, read from and appended to a json lines file"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._responses: Dict[str, List[Tuple[int, object]]] = defaultdict(list)
+        self._replayed = Counter()
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as fh:
+                for line in fh:
+                    entry = json.loads(line)
+                    self._responses[entry["request"]].append((entry["status"], entry["body"]))
+
+    def __len__(self) -> int:
+        return sum(len(responses) for responses in self._responses.values())
+
+    def get(self, request: str) -> Optional[Tuple[int, object]]:
+        """The next recorded response to the request, the last repeated once all have been replayed"""
+        with self._lock:
+            responses = self._responses.get(request)
+            if not responses:
+                return None
+            index = min(self._replayed[request], len(responses) - 1)
+            self._replayed[request] += 1
+            return responses[index]
+
+    def add(self, request: str, status: int, body):
+        with self._lock:
+            self._responses[request].append((status, body))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fh:
+                fh.write(json.dumps({"request": request, "status": status, "body": body}) + "\n")
+
+
+class Upstream:
+    """The API the catalog endpoints are forwarded to when recording, with a client credentials token"""
+
+    def __init__(self, prefix: str = "https://api.spotify.com/v1/", auth_manager=None):
+        if auth_manager is None:
+            from spotipy.oauth2 import SpotifyClientCredentials
+
+            auth_manager = SpotifyClientCredentials()
+        self.prefix = prefix
+        self.auth_manager = auth_manager
+        self.session = requests.Session()
+
+    def get(self, path: str, query: List[Tuple[str, str]]) -> Tuple[int, Dict, object]:
+        token = self.auth_manager.get_access_token(as_dict=False)
+        response = self.session.get(
+            self.prefix + path, params=query, headers={"Authorization": f"Bearer {token}"}, timeout=30
+        )
+        headers = {"Retry-After": response.headers["Retry-After"]} if "Retry-After" in response.headers else {}
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, headers, body
+
+
+@dataclass
+class UserLibrary:
+    """The saved tracks, albums and playlists of a user"""
+
+    saved_tracks: Dict[str, None] = field(default_factory=dict)  # uri, in the order saved
+    saved_albums: Dict[str, None] = field(default_factory=dict)
+    playlists: Dict[str, Dict] = field(default_factory=dict)  # id: playlist with its track uris
+
+
+def _error(status: int, message: str) -> Dict:
+    return {"error": {"status": status, "message": message}}
+
+
+def _ids(query: Dict[str, str]) -> List[str]:
+    return [uri.rsplit(":", 1)[-1] for uri in query.get("ids", "").split(",") if uri]
+
+
+class SpotifyStub:
+    """The stand-in server, started on a thread. handle answers a request without the HTTP server"""
+
+    # (method, path) routes to the handler method, catalog routes are recorded and replayed
+    routes = [
+        ("GET", re.compile(r"search"), "_search", True),
+        ("GET", re.compile(r"albums/(?P<album_id>\w+)/tracks"), "_album_tracks", True),
+        ("GET", re.compile(r"albums"), "_albums", True),
+        ("GET", re.compile(r"tracks"), "_tracks", True),
+        ("GET", re.compile(r"artists/(?P<artist_id>\w+)/albums"), "_artist_albums", True),
+        ("GET", re.compile(r"me"), "_me", False),
+        ("GET", re.compile(r"me/(?P<kind>tracks|albums)"), "_saved", False),
+        ("PUT", re.compile(r"me/(?P<kind>tracks|albums)"), "_save", False),
+        ("DELETE", re.compile(r"me/(?P<kind>tracks|albums)"), "_unsave", False),
+        ("GET", re.compile(r"users/(?P<user_id>[^/]+)/playlists"), "_playlists", False),
+        ("POST", re.compile(r"users/(?P<user_id>[^/]+)/playlists"), "_create_playlist", False),
+        ("POST", re.compile(r"playlists/(?P<playlist_id>\w+)/tracks"), "_add_items", False),
+        ("DELETE", re.compile(r"playlists/(?P<playlist_id>\w+)/followers"), "_unfollow", False),
+    ]
+
+    def __init__(
+        self,
+        catalog: Optional[Catalog] = None,
+        faults: Optional[Faults] = None,
+        recording: Optional[Recording] = None,
+        upstream: Optional[Upstream] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.catalog = catalog or Catalog()
+        self.faults = faults or Faults()
+        self.recording = recording  # Replayed, and appended to when recording
+        self.upstream = upstream  # Catalog requests not in the recording are forwarded and recorded
+        self.users: Dict[str, UserLibrary] = defaultdict(UserLibrary)
+        self.requests = Counter()  # Requests by route and injected fault
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """The prefix of the API, for spotipy.Spotify.prefix (see credentials.spotify_stub)"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    def start(self) -> "SpotifyStub":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="spotify-stub", daemon=True)
+        self._thread.start()
+        logger.info(f"Spotify stand-in serving {len(self.catalog.tracks)} tracks at {self.url}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "SpotifyStub":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.requests[name] += 1
+
+    def handle(self, method: str, target: str, body: bytes = b"", token: str = "") -> Tuple[int, Dict, object]:
+        """Answer a request, target the path below /v1/ with its query. Returns the status, headers and body"""
+        url = urlsplit(target)
+        path = url.path.strip("/")
+        query = parse_qsl(url.query)
+
+        delay, fault = self.faults.draw()
+        if delay:
+            time.sleep(delay)
+        if fault == 429:
+            self._count("429")
+            return 429, {"Retry-After": str(self.faults.retry_after)}, _error(429, "API rate limit exceeded")
+        if fault:
+            self._count(str(fault))
+            return fault, {}, _error(fault, "Service unavailable")
+
+        for route_method, pattern, handler, catalog_route in self.routes:
+            match = pattern.fullmatch(path)
+            if route_method != method or not match:
+                continue
+            self._count(handler.lstrip("_"))
+
+            request = f"{method} {path}?{urlencode(sorted(query))}"
+            if catalog_route and self.recording is not None:
+                recorded = self.recording.get(request)
+                if recorded is not None:
+                    return recorded[0], {}, recorded[1]
+                if self.upstream is not None:
+                    status, headers, response = self.upstream.get(path, query)
+                    if status == 200 or status == 404:
+                        self.recording.add(request, status, response)
+                    return status, headers, response
+
+            payload = json.loads(body) if body else None
+            return getattr(self, handler)(dict(query), payload, token or "stub", **match.groupdict())
+
+        self._count("not_found")
+        return 404, {}, _error(404, "Service not found")
+
+    def _search(self, query, payload, token):
+        search_type = query.get("type", "track")
+        items = self.catalog.search(query.get("q", ""), search_type)
+        limit, offset = int(query.get("limit", 10)), int(query.get("offset", 0))
+        return 200, {}, {f"{search_type}s": paging(items, limit, offset, "search")}
+
+    def _album_tracks(self, query, payload, token, album_id):
+        if album_id not in self.catalog.albums:
+            return 404, {}, _error(404, "Non existing id")
+        tracks = [self.catalog.simplified_track(track_id) for track_id in self.catalog.album_tracks[album_id]]
+        limit, offset = int(query.get("limit", 20)), int(query.get("offset", 0))
+        return 200, {}, paging(tracks, limit, offset, f"albums/{album_id}/tracks")
+
+    def _albums(self, query, payload, token):
+        return 200, {}, {"albums": [self.catalog.album(album_id) for album_id in _ids(query)]}
+
+    def _tracks(self, query, payload, token):
+        return 200, {}, {"tracks": [self.catalog.track(track_id) for track_id in _ids(query)]}
+
+    def _artist_albums(self, query, payload, token, artist_id):
+        albums = [self.catalog.albums[album_id] for album_id in self.catalog.artist_albums.get(artist_id, [])]
+        limit, offset = int(query.get("limit", 20)), int(query.get("offset", 0))
+        return 200, {}, paging(albums, limit, offset, f"artists/{artist_id}/albums")
+
+    def _me(self, query, payload, token):
+        return 200, {}, {"id": token, "display_name": token}
+
+    def _saved(self, query, payload, token, kind):
+        with self._lock:
+            saved = getattr(self.users[token], f"saved_{kind}")
+            items = [{kind[:-1]: {"uri": uri}} for uri in saved]
+        limit, offset = int(query.get("limit", 20)), int(query.get("offset", 0))
+        return 200, {}, paging(items, limit, offset, f"me/{kind}")
+
+    def _save(self, query, payload, token, kind):
+        with self._lock:
+            saved = getattr(self.users[token], f"saved_{kind}")
+            saved.update((f"spotify:{kind[:-1]}:{id_}", None) for id_ in _ids(query))
+        return 200, {}, None
+
+    def _unsave(self, query, payload, token, kind):
+        with self._lock:
+            saved = getattr(self.users[token], f"saved_{kind}")
+            for id_ in _ids(query):
+                saved.pop(f"spotify:{kind[:-1]}:{id_}", None)
+        return 200, {}, None
+
+    def _playlists(self, query, payload, token, user_id):
+        with self._lock:
+            playlists = [
+                {"id": playlist["id"], "name": playlist["name"]} for playlist in self.users[user_id].playlists.values()
+            ]
+        limit, offset = int(query.get("limit", 50)), int(query.get("offset", 0))
+        return 200, {}, paging(playlists, limit, offset, f"users/{user_id}/playlists")
+
+    def _create_playlist(self, query, payload, token, user_id):
+        with self._lock:
+            playlist_id = _id("p", sum(len(user.playlists) for user in self.users.values()) + 1)
+            playlist = {"id": playlist_id, "name": (payload or {}).get("name"), "owner": {"id": user_id}, "tracks": []}
+            self.users[user_id].playlists[playlist_id] = playlist
+        return 201, {}, {key: value for key, value in playlist.items() if key != "tracks"}
+
+    def _add_items(self, query, payload, token, playlist_id):
+        with self._lock:
+            for user in self.users.values():
+                if playlist_id in user.playlists:
+                    user.playlists[playlist_id]["tracks"].extend(payload or [])
+                    return 201, {}, {"snapshot_id": f"{playlist_id}{len(user.playlists[playlist_id]['tracks'])}"}
+        return 404, {}, _error(404, "Invalid playlist Id")
+
+    def _unfollow(self, query, payload, token, playlist_id):
+        with self._lock:
+            self.users[token].playlists.pop(playlist_id, None)
+        return 200, {}, None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as the pooled sessions of the clients
+    disable_nagle_algorithm = True  # Headers and body are written separately, without a delayed ACK between
+
+    def _respond(self):
+        if not self.path.startswith(API_PREFIX):
+            status, headers, body = 404, {}, _error(404, "Service not found")
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+            status, headers, body = self.server.stub.handle(
+                self.command, self.path[len(API_PREFIX):], self.rfile.read(length), token
+            )
+
+        content = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="A local stand-in for the Spotify Web API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--tracks", help="Tracks of the synthetic catalog", type=int, default=10000)
+    parser.add_argument("--seed", help="Seed of the synthetic catalog", type=int, default=0)
+    parser.add_argument("--coverage", help="Share of the synthetic albums in the catalog", type=float, default=1.0)
+    parser.add_argument(
+        "--synthesize", help="Answer searches not in the catalog with a track or album", action="store_true"
+    )
+    parser.add_argument("--latency", help="Seconds added to every response", type=float, default=0.0)
+    parser.add_argument("--jitter", help="Up to this many seconds more", type=float, default=0.0)
+    parser.add_argument("--rate-429", help="Share of requests answered 429", type=float, default=0.0)
+    parser.add_argument("--retry-after", help="Retry-After of a 429, seconds", type=int, default=1)
+    parser.add_argument("--rate-5xx", help="Share of requests answered 503", type=float, default=0.0)
+    parser.add_argument("--replay", help="Replay the responses recorded to this file", type=Path)
+    parser.add_argument(
+        "--record", help="Forward catalog requests to the Spotify API, recording the responses to this file", type=Path
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = get_parser().parse_args()
+    stub = SpotifyStub(
+        catalog=Catalog.from_synthetic(args.tracks, seed=args.seed, coverage=args.coverage, synthesize=args.synthesize),
+        faults=Faults(
+            latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after,
+            rate_5xx=args.rate_5xx, seed=args.seed,
+        ),
+        recording=Recording(args.record or args.replay) if args.record or args.replay else None,
+        upstream=Upstream() if args.record else None,
+        host=args.host,
+        port=args.port,
+    )
+    stub.start()
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"Requests {dict(stub.requests)}")
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,297 @@
+"""
+Generate a synthetic iTunes library for benchmarking and testing, without someone's real library.
+
+Writes a Library.xml and a media tree of tagged files, m4a files under "Apple Music" (with the xid and
+content id Apple Music adds) and mp3 files under "Music". Names carry the messiness the cleaning handles,
+brackets, "Feat." / "&" / "With" artists, apostrophes, missing names and duplicate albums.
+
+    python synthetic_library.py --tracks 10000 --path .data/synthetic
+"""
+import argparse
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import random
+import struct
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+from mutagen.id3 import ID3, TALB, TDRC, TIT2, TPE1, TPE2, TPOS
+from mutagen.mp4 import MP4
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "Love", "Night", "Blue", "Sail", "Away", "River", "Light", "Dream", "Fire", "Heart", "Rain", "Glory",
+    "Morning", "Summer", "Shadow", "Angel", "Stars", "Wonder", "Wall", "Road", "Ocean", "Silence", "Gold",
+)
+APOSTROPHES = ("Don't", "I`m", "It’s", "Rock ´n´ Roll", "Can't")
+TRACK_SUFFIXES = (" (Live)", " [Remastered 2011]", " (Radio Edit)", " [Bonus Track]", " (feat. Dido)")
+ALBUM_SUFFIXES = (" (Deluxe Edition)", " [Disc 1]", " (Remastered)")
+ARTIST_JOINS = (" Feat. ", " & ", " With ")
+SHARED_ALBUMS = ("Greatest Hits", "Live", "The Best Of", "Unplugged")
+PLAYLISTS = ("Chill", "Running", "Party", "Sunday Morning", "90s")
+
+
+@dataclass
+class SyntheticTrack:
+    track_id: int
+    name: Optional[str]
+    artist: Optional[str]
+    album_artist: str
+    album: str
+    year: int
+    track_number: int
+    track_count: int
+    disc_number: int
+    isrc: str
+    content_id: int
+
+
+def _words(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def _artist_name(rng: random.Random, index: int) -> str:
+    return f"{_words(rng, rng.randint(1, 2))} {index}"
+
+
+def generate_tracks(tracks: int, seed: int = 0) -> List[SyntheticTrack]:
+    """Build the tracks of a library, grouped into albums of 8 to 14 tracks"""
+    rng = random.Random(seed)
+    artists = [_artist_name(rng, index) for index in range(max(1, tracks // 40))]
+    generated = []
+
+    while len(generated) < tracks:
+        album_artist = rng.choice(artists)
+        if rng.random() < 0.05:
+            album = rng.choice(SHARED_ALBUMS)
+        else:
+            album = _words(rng, rng.randint(1, 3))
+            if rng.random() < 0.1:
+                album += rng.choice(ALBUM_SUFFIXES)
+
+        year = rng.randint(1965, 2023)
+        track_count = min(rng.randint(8, 14), tracks - len(generated))
+        album_tracks = []
+
+        for track_number in range(1, track_count + 1):
+            name = _words(rng, rng.randint(1, 4))
+            if rng.random() < 0.1:
+                name = f"{rng.choice(APOSTROPHES)} {name}"
+            if rng.random() < 0.15:
+                name += rng.choice(TRACK_SUFFIXES)
+            if rng.random() < 0.01:
+                name = None
+
+            artist = album_artist
+            if rng.random() < 0.1:
+                artist = f"{album_artist}{rng.choice(ARTIST_JOINS)}{rng.choice(artists)}"
+            if rng.random() < 0.01:
+                artist = None
+
+            track_id = len(generated) + len(album_tracks) + 1
+            album_tracks.append(
+                SyntheticTrack(
+                    track_id=track_id,
+                    name=name,
+                    artist=artist,
+                    album_artist=album_artist,
+                    album=album,
+                    year=year,
+                    track_number=track_number,
+                    track_count=track_count,
+                    disc_number=1,
+                    isrc=f"GBSYN{year % 100:02d}{track_id:05d}",
+                    content_id=1000000000 + track_id,
+                )
+            )
+
+        generated.extend(album_tracks)
+
+        # A few albums appear twice, e.g. the same album bought again as part of a box set
+        if rng.random() < 0.02 and len(generated) + len(album_tracks) <= tracks:
+            for track in album_tracks:
+                duplicate = SyntheticTrack(**{**track.__dict__, "track_id": len(generated) + 1})
+                generated.append(duplicate)
+
+    return generated
+
+
+def _xml_value(key: str, value) -> str:
+    if isinstance(value, bool):
+        return f"<key>{key}</key><{'true' if value else 'false'}/>"
+    if isinstance(value, int):
+        return f"<key>{key}</key><integer>{value}</integer>"
+    return f"<key>{key}</key><string>{escape(value)}</string>"
+
+
+def write_library_xml(path: Path, tracks: List[SyntheticTrack], seed: int = 0):
+    """Write tracks and playlists in the iTunes Library.xml plist format, the master Library playlist first"""
+    rng = random.Random(seed)
+    track_ids = [track.track_id for track in tracks]
+    playlists = {"Library": track_ids}
+
+    for playlist in PLAYLISTS:
+        playlists[playlist] = rng.sample(track_ids, min(len(track_ids), rng.randint(10, 200)))
+
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+            '<plist version="1.0">\n<dict>\n'
+            f"\t{_xml_value('Major Version', 1)}\n"
+            f"\t{_xml_value('Minor Version', 1)}\n"
+            f"\t{_xml_value('Application Version', '12.9.5.5')}\n"
+            "\t<key>Tracks</key>\n\t<dict>\n"
+        )
+
+        for track in tracks:
+            attributes = {
+                "Track ID": track.track_id,
+                "Name": track.name,
+                "Artist": track.artist,
+                "Album Artist": track.album_artist,
+                "Album": track.album,
+                "Genre": "Pop",
+                "Kind": "Apple Music AAC audio file",
+                "Disc Number": track.disc_number,
+                "Track Number": track.track_number,
+                "Track Count": track.track_count,
+                "Year": track.year,
+                "Date Added": "2020-01-01T00:00:00Z",
+                "Persistent ID": f"{track.track_id:016X}",
+                "Track Type": "File",
+                "Location": f"file:///Music/{track.track_id}.m4a",
+            }
+            fh.write(f"\t\t<key>{track.track_id}</key>\n\t\t<dict>\n")
+            for key, value in attributes.items():
+                if value is not None:
+                    fh.write(f"\t\t\t{_xml_value(key, value)}\n")
+            fh.write("\t\t</dict>\n")
+
+        fh.write("\t</dict>\n\t<key>Playlists</key>\n\t<array>\n")
+
+        for playlist_id, (name, items) in enumerate(playlists.items(), start=1):
+            fh.write(
+                f"\t\t<dict>\n\t\t\t{_xml_value('Name', name)}\n"
+                f"\t\t\t{_xml_value('Playlist ID', playlist_id)}\n"
+            )
+            if name == "Library":
+                fh.write(f"\t\t\t{_xml_value('Master', True)}\n")
+            fh.write("\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n")
+            for track_id in items:
+                fh.write(f"\t\t\t\t<dict>{_xml_value('Track ID', track_id)}</dict>\n")
+            fh.write("\t\t\t</array>\n\t\t</dict>\n")
+
+        fh.write("\t</array>\n</dict>\n</plist>\n")
+
+
+def _atom(name: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), name) + payload
+
+
+def write_m4a(path: Path, tags: Dict):
+    """Write a minimal mp4 with a sound track and no audio data, then tag it"""
+    hdlr = _atom(b"hdlr", b"\0" * 8 + b"soun" + b"\0" * 13)
+    mdhd = _atom(b"mdhd", b"\0" * 4 + struct.pack(">IIIIHH", 0, 0, 44100, 44100, 0, 0))
+    mvhd = _atom(b"mvhd", b"\0" * 4 + struct.pack(">IIII", 0, 0, 1000, 1000) + b"\0" * 80)
+    moov = _atom(b"moov", mvhd + _atom(b"trak", _atom(b"mdia", mdhd + hdlr)))
+    path.write_bytes(_atom(b"ftyp", b"M4A \0\0\0\0M4A mp42isom") + moov + _atom(b"mdat", b""))
+
+    audio = MP4(path)
+    audio.update(tags)
+    audio.save()
+
+
+def write_mp3(path: Path, frames: List):
+    """Write a few silent mpeg frames, then tag them"""
+    path.write_bytes((b"\xff\xfb\x90\x64" + b"\0" * 413) * 3)
+    tags = ID3()
+    for frame in frames:
+        tags.add(frame)
+    tags.save(path)
+
+
+def _file_name(text: Optional[str]) -> str:
+    return (text or "Unknown").replace("/", "_").replace(":", "_")[:60]
+
+
+def write_media(root: Path, tracks: List[SyntheticTrack], apple_share: float = 0.6):
+    """
+    Write one tagged file per track, the first share as Apple Music m4a files and the rest as mp3 files
+    under Music, in artist/album folders
+    """
+    apple_tracks = int(len(tracks) * apple_share)
+
+    for index, track in enumerate(tracks):
+        folder = "Apple Music" if index < apple_tracks else "Music"
+        suffix = ".m4a" if index < apple_tracks else ".mp3"
+        album_path = root / folder / _file_name(track.album_artist) / _file_name(track.album)
+        album_path.mkdir(parents=True, exist_ok=True)
+        path = album_path / f"{track.track_id:06d} {_file_name(track.name)}{suffix}"
+
+        if suffix == ".m4a":
+            tags = {
+                "aART": [track.album_artist],
+                "©alb": [track.album],
+                "©day": [f"{track.year}-01-01T08:00:00Z"],
+                "trkn": [(track.track_number, track.track_count)],
+                "cnID": [track.content_id],
+                "xid ": [f"Synthetic:isrc:{track.isrc}"],
+            }
+            if track.name is not None:
+                tags["©nam"] = [track.name]
+            if track.artist is not None:
+                tags["©ART"] = [track.artist]
+            write_m4a(path, tags)
+        else:
+            frames = [
+                TALB(encoding=3, text=track.album),
+                TDRC(encoding=3, text=str(track.year)),
+                TPE2(encoding=3, text=track.album_artist),
+                TPOS(encoding=3, text=f"{track.disc_number}/1"),
+            ]
+            if track.name is not None:
+                frames.append(TIT2(encoding=3, text=track.name))
+            if track.artist is not None:
+                frames.append(TPE1(encoding=3, text=track.artist))
+            write_mp3(path, frames)
+
+
+def generate_library(root: Path, tracks: int, files: Optional[int] = None, seed: int = 0) -> Path:
+    """
+    Generate a synthetic library under root with Library.xml and, for the first files tracks, a media
+    tree (all tracks when files is None). Returns the path to Library.xml
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    synthetic_tracks = generate_tracks(tracks, seed=seed)
+
+    library_xml = root / "Library.xml"
+    write_library_xml(library_xml, synthetic_tracks, seed=seed)
+    logger.info(f"Written {len(synthetic_tracks)} tracks to {library_xml}")
+
+    media_tracks = synthetic_tracks if files is None else synthetic_tracks[:files]
+    if media_tracks:
+        write_media(root, media_tracks)
+        logger.info(f"Written {len(media_tracks)} tagged files to {root}")
+
+    return library_xml
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Generate a synthetic iTunes library")
+    parser.add_argument("--path", help="Folder to write to", type=Path, default=Path(".data/synthetic"))
+    parser.add_argument("--tracks", help="Number of tracks in Library.xml", type=int, default=1000)
+    parser.add_argument(
+        "--files", help="Number of tagged media files (default all tracks)", type=int, default=None
+    )
+    parser.add_argument("--seed", help="Random seed", type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = get_parser().parse_args()
+    generate_library(args.path, tracks=args.tracks, files=args.files, seed=args.seed)
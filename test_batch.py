@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+
+from batch import BatchRunner, find_users
+import config
+from data_cleaning import DataCleaner
+from data_linking import DataLinker
+from rate_control import RateController
+from request_history import RequestHistory
+from synthetic_library import generate_tracks, write_library_xml
+
+
+class FakeSpotify:
+    """Counts the searches, answering each with a track or album made from the query"""
+
+    def __init__(self):
+        self.searches = []
+
+    def search(self, q: str, type: str, **kwargs):
+        self.searches.append(q)
+        if type == "album":
+            return {"albums": {"items": [{"uri": f"spotify:album:{q}"}]}}
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": q[-12:]},
+                    "uri": f"spotify:track:{q}",
+                    "artists": [{"uri": f"spotify:artist:{q}"}],
+                    "album": {"total_tracks": 10},
+                }]
+            }
+        }
+
+
+@pytest.fixture
+def users(tmp_path):
+    """Two users, bob's library the first half of alice's"""
+    tracks = generate_tracks(200)
+    for user, user_tracks in (("alice", tracks), ("bob", tracks[:100])):
+        (tmp_path / user).mkdir()
+        write_library_xml(tmp_path / user / "Library.xml", user_tracks)
+    (tmp_path / "no_library").mkdir()
+    return find_users(tmp_path)
+
+
+def link_users(users, path, monkeypatch):
+    path.mkdir(exist_ok=True)
+    monkeypatch.setattr(config, "HISTORY_PATH", path)
+    sp = FakeSpotify()
+    linker = DataLinker(
+        spotify=sp, request_history=RequestHistory(path / "history.sqlite3"),
+        rate_control=RateController(rate=1e9, max_rate=1e9, burst=1e9),
+    )
+    runner = BatchRunner(users, linker=linker, cleaner=DataCleaner(compact=False), workers=2)
+    return runner, runner.run(), sp
+
+
+def test_users_linked_with_each_search_once(users, tmp_path, monkeypatch):
+    runner, tracks, sp = link_users(users, tmp_path / "batch", monkeypatch)
+    *_, sp_alice = link_users({"alice": users["alice"]}, tmp_path / "alice", monkeypatch)
+    *_, sp_bob = link_users({"bob": users["bob"]}, tmp_path / "bob", monkeypatch)
+
+    assert list(users) == ["alice", "bob"]
+    assert len(sp.searches) == len(set(sp.searches))
+    assert len(sp.searches) < len(sp_alice.searches) + len(sp_bob.searches)
+    assert [runner.stats[user].tracks for user in users] == [len(tracks["alice"]), len(tracks["bob"])]
+    assert tracks["bob"]["spotify_track_uri"].notna().all()
+    assert "batch_user" not in tracks["alice"].columns
+
+
+def test_checkpoints_and_report_written(users, tmp_path, monkeypatch):
+    runner, tracks, _ = link_users(users, tmp_path / "batch", monkeypatch)
+    report = runner.report()
+
+    pd.testing.assert_frame_equal(pd.read_pickle(users["bob"] / "checkpoints" / "2_cleaned"), tracks["bob"])
+    assert (users["alice"] / "checkpoints" / "playlist_cleaned").is_file()
+    assert report["user"].tolist() == ["alice", "bob"]
+    assert (tmp_path / "batch" / "batch_report.csv").is_file()
@@ -8,7 +8,9 @@ from config import (
     SpotifyTrackNameByContentId,
     SpotifyAlbum,
 )
+import config
 from data_cleaning import DataCleaner
+import utils
 
 
 @pytest.fixture
@@ -24,6 +26,16 @@ def test_isrc_extracted_from_xid_where_populated(data_cleaner):
     assert cleaned_df["isrc"][0] == "SEYBD0800402"
 
 
+def test_isrc_from_xid_kept_when_spotify_columns_created(data_cleaner):
+    df = pd.DataFrame(
+        data=[["Universal:isrc:SEYBD0800402", "Track", "Artist", "Album", "2008"]],
+        columns=["xid", "track_name", "artist", "album", "release_date"],
+    )
+    df = data_cleaner._create_spotify_columns(data_cleaner._set_isrc(df))
+    assert df["isrc"][0] == "SEYBD0800402"
+    assert pd.isna(df["spotify_track_uri"][0])
+
+
 def test_single_quote_in_multiple_fields(data_cleaner):
     """Test function _remove_from_spotify_requests replaces single quotes in
     spotify_search_track_name and spotify_search_artist
@@ -189,13 +201,13 @@ def test_clean_brackets(data_cleaner):
     assert cleaned_df["spotify_search_track_name"][1] == "Pink"
 
 
-def test_clean_brackets_exits_where_all_isrc_populated(data_cleaner):
+def test_clean_brackets_where_isrc_populated(data_cleaner):
     df = pd.DataFrame(
-        data=[["Suede", "Suede [Disc 1]", "1234"], ["Pink [", "Pink ]", "567"]],
+        data=[["Suede (Live)", "Suede [Disc 1]", "1234"], ["Pink [", "Pink ]", "567"]],
         columns=["spotify_search_track_name", "spotify_search_album", "isrc"],
     )
     cleaned_df = data_cleaner._clean_brackets_from_spotify_search_fields(df)
-    assert cleaned_df["spotify_search_track_name"][0] == "Suede"
+    assert cleaned_df["spotify_search_track_name"].tolist() == ["Suede", "Pink ["]
 
 
 def test_clean_brackets_spotify_search_album(data_cleaner):
@@ -234,3 +246,134 @@ def test_album_not_added_when_library_tracks_equals_1(data_cleaner):
     )
     cleaned_df = data_cleaner._should_add_album(df)
     assert cleaned_df["spotify_add_album"][0] == False
+
+
+def test_normalize_spotify_search_columns_matches_separate_steps(data_cleaner):
+    data = [
+        ["Don't Stop (Live)", "Faithless Feat. Dido", "Reverence [Deluxe]", "2008-01-01T00:00:00Z", np.nan],
+        ["I`m In Love [Remix]", "Simon & Garfunkel", "Greatest ´Hits´", "1996", np.nan],
+        ["It’s (Not) Over", "Kylie With Jason", "Ten (2)", np.nan, "GBAHT8800088"],
+        [np.nan, np.nan, np.nan, "1999", np.nan],
+        ["Song '(x)", "Artist '& Friend", "Album", "2001", np.nan],
+    ]
+    columns = [
+        "spotify_search_track_name", "spotify_search_artist", "spotify_search_album", "release_date", "isrc",
+    ]
+    df = pd.DataFrame(data=data, columns=columns)
+    df["spotify_release_year"] = df["release_date"]
+
+    expected = data_cleaner._set_spotify_release_year(df.copy())
+    expected = data_cleaner._clean_brackets_from_spotify_search_fields(expected)
+    expected = data_cleaner._clean_brackets_from_spotify_search_album(expected)
+    expected = data_cleaner._remove_characters(expected)
+    expected = data_cleaner._split_artists_keep_first_only(expected)
+
+    normalized = data_cleaner._normalize_spotify_search_columns(df.copy())
+    pd.testing.assert_frame_equal(normalized, expected)
+    assert normalized["spotify_search_artist"].tolist()[:2] == ["Faithless", "Simon"]
+    assert normalized["spotify_search_track_name"][0] == "Dont Stop"
+    # Rows with an ISRC are cleaned as the rest
+    assert (normalized["spotify_search_track_name"][2], normalized["spotify_search_artist"][2]) == ("Its Over", "Kylie")
+
+
+def test_updating_spotify_artists_applies_rules_in_order(data_cleaner):
+    """Chained rules resolve to the final value and the first of two rules for the same artist wins"""
+    artist_updates = [
+        SpotifyArtist(from_spotify_search_artist="A", to_spotify_search_artist="B"),
+        SpotifyArtist(from_spotify_search_artist="B", to_spotify_search_artist="C"),
+        SpotifyArtist(from_spotify_search_artist="D", to_spotify_search_artist="E"),
+        SpotifyArtist(from_spotify_search_artist="D", to_spotify_search_artist="F"),
+    ]
+    df = pd.DataFrame(data=[["A"], ["B"], ["D"], ["G"], [np.nan]], columns=["spotify_search_artist"])
+
+    cleaned_df = data_cleaner._update_spotify_artists(df, artist_updates)
+    assert cleaned_df["spotify_search_artist"].tolist()[:4] == ["C", "C", "E", "G"]
+    assert pd.isna(cleaned_df["spotify_search_artist"][4])
+
+
+def test_updating_spotify_tracks_only_for_the_rules_artist(data_cleaner):
+    track_updates = [
+        SpotifyTrackName(artist="Faithless", from_spotify_search_track_name="Muhammed Ali",
+                         to_spotify_search_track_name="Muhammad Ali"),
+    ]
+    df = pd.DataFrame(
+        data=[["Faithless", "Muhammed Ali"], ["Other", "Muhammed Ali"], [np.nan, "Muhammed Ali"]],
+        columns=["artist", "spotify_search_track_name"],
+    )
+
+    cleaned_df = data_cleaner._update_spotify_tracks(df, track_updates)
+    assert cleaned_df["spotify_search_track_name"].tolist() == ["Muhammad Ali", "Muhammed Ali", "Muhammed Ali"]
+
+
+def test_album_updates_applied_in_round_1(data_cleaner, monkeypatch):
+    """Album first linking searches the albums before round 2, with their corrected names"""
+    monkeypatch.setattr(config, "album_updates", [SpotifyAlbum("Coco Part 1", "Coco, Pt. 1")])
+    df = pd.DataFrame(
+        data=[["Coco Part 1", "Morcheeba", "Part Of The Process", "1998"]],
+        columns=["album", "artist", "track_name", "release_date"],
+    )
+    df["album_artist"] = np.nan
+
+    cleaned_df = data_cleaner.clean_itunes_data_round_1(df)
+    assert cleaned_df["spotify_search_album"][0] == "Coco, Pt. 1"
+
+
+def test_corrections_loaded_from_data_file(tmp_path):
+    corrections = tmp_path / "corrections.json"
+    corrections.write_text(
+        '{"artist_updates": [{"from_spotify_search_artist": "Morcheeba", "to_spotify_search_artist": "Morch"}],'
+        ' "album_updates": [{"from_spotify_search_album": "Coco Part 1", "to_spotify_search_album": "Coco, Pt. 1"}]}'
+    )
+
+    loaded = config.load_corrections(corrections)
+    assert loaded["artist_updates"] == [SpotifyArtist("Morcheeba", "Morch")]
+    assert loaded["album_updates"] == [SpotifyAlbum("Coco Part 1", "Coco, Pt. 1")]
+    assert loaded["track_updates"] == []
+
+
+def test_compact_columns_share_one_dictionary(data_cleaner):
+    df = pd.DataFrame(
+        data=[["Coco Part 1", "Coco Part 1", "Parov Stelar"], ["Coco Part 1", "Coco Part 1", np.nan]],
+        columns=["album", "spotify_search_album", "spotify_search_artist"],
+    )
+
+    df = utils.to_compact([df])[0]
+    assert df["album"].dtype == "category"
+    assert utils.is_compact(df["spotify_search_artist"], df["album"].dtype)
+    assert list(df["album"].cat.categories) == ["Coco Part 1", "Parov Stelar"]
+    assert pd.isna(df["spotify_search_artist"][1])
+
+
+def test_updating_spotify_albums_compact(data_cleaner):
+    album_updates = [
+        SpotifyAlbum(from_spotify_search_album="Coco Part 2", to_spotify_search_album="Coco Part 1"),
+        SpotifyAlbum(from_spotify_search_album="Coco Part 1", to_spotify_search_album="Coco, Pt. 1"),
+    ]
+    df = pd.DataFrame(
+        data=[["Coco Part 2"], ["Coco Part 1"], [np.nan], ["Coco"]],
+        columns=["spotify_search_album"],
+    )
+    df = utils.to_compact([df])[0]
+
+    cleaned_df = data_cleaner._update_spotify_albums(df, album_updates)
+    assert cleaned_df["spotify_search_album"].dtype == "category"
+    assert cleaned_df["spotify_search_album"].tolist()[:2] == ["Coco, Pt. 1", "Coco, Pt. 1"]
+    assert pd.isna(cleaned_df["spotify_search_album"][2])
+    assert cleaned_df["spotify_search_album"][3] == "Coco"
+
+
+def test_playlist_merge_compact_matches_object():
+    df_playlist = pd.DataFrame(
+        data=[["Chill", "Watermark", "Enya", "Orinoco Flow"], ["Chill", "Reverence", "Faithless", "Salva Mea"]],
+        columns=["playlist_name", "album", "artist", "track_name"],
+    )
+    df_tracks = pd.DataFrame(
+        data=[["Watermark", "Enya", "Orinoco Flow", "spotify:track:1"], ["Watermark", "Enya", "Storms", np.nan]],
+        columns=["album", "artist", "track_name", "spotify_track_uri"],
+    )
+
+    expected = DataCleaner().clean_itunes_playlist(df_playlist, df_tracks)
+    compact = DataCleaner(compact=True).clean_itunes_playlist(df_playlist, utils.to_compact([df_tracks])[0])
+
+    assert compact["track_name"].dtype == "category"
+    pd.testing.assert_frame_equal(utils.from_compact(compact), expected)
@@ -0,0 +1,279 @@
+from pathlib import Path
+
+from mutagen.id3 import TALB, TDRC, TIT2, TPE1
+from mutagen.mp4 import MP4Cover
+
+import pandas as pd
+import pytest
+
+import config
+import data_extraction
+from data_extraction import ColumnarFrameBuilder, DataExtractor, ExtractionManifest
+from synthetic_library import generate_library, write_m4a, write_mp3
+
+
+@pytest.fixture
+def data_extractor():
+    """Returns a DataExtractor instance reading tags serially"""
+    return DataExtractor(mode="TEST", workers=1)
+
+
+LIBRARY_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+	<key>Major Version</key><integer>1</integer>
+	<key>Minor Version</key><integer>1</integer>
+	<key>Application Version</key><string>12.9.5.5</string>
+	<key>Tracks</key>
+	<dict>
+		<key>101</key>
+		<dict>
+			<key>Track ID</key><integer>101</integer>
+			<key>Name</key><string>Insomnia</string>
+			<key>Artist</key><string>Faithless</string>
+			<key>Album</key><string>Reverence</string>
+			<key>Year</key><integer>1996</integer>
+			<key>Track Number</key><integer>4</integer>
+			<key>Compilation</key><true/>
+		</dict>
+		<key>102</key>
+		<dict>
+			<key>Track ID</key><integer>102</integer>
+			<key>Name</key><string>Don&#39;t Leave</string>
+			<key>Artist</key><string>Faithless</string>
+			<key>Album</key><string>Reverence</string>
+		</dict>
+		<key>103</key>
+		<dict>
+			<key>Track ID</key><integer>103</integer>
+			<key>Name</key><string>Orinoco Flow (Sail Away)</string>
+			<key>Artist</key><string>Enya &amp; Friends</string>
+			<key>Year</key><integer>1988</integer>
+			<key>Track Type</key><string>Remote</string>
+		</dict>
+	</dict>
+	<key>Playlists</key>
+	<array>
+		<dict>
+			<key>Name</key><string>Library</string>
+			<key>Master</key><true/>
+			<key>Playlist ID</key><integer>1</integer>
+			<key>Playlist Items</key>
+			<array>
+				<dict><key>Track ID</key><integer>101</integer></dict>
+				<dict><key>Track ID</key><integer>102</integer></dict>
+				<dict><key>Track ID</key><integer>103</integer></dict>
+			</array>
+		</dict>
+		<dict>
+			<key>Name</key><string>Chill</string>
+			<key>Playlist ID</key><integer>2</integer>
+			<key>Playlist Items</key>
+			<array>
+				<dict><key>Track ID</key><integer>103</integer></dict>
+				<dict><key>Track ID</key><integer>999</integer></dict>
+				<dict><key>Track ID</key><integer>101</integer></dict>
+			</array>
+		</dict>
+		<dict>
+			<key>Name</key><string>Empty</string>
+			<key>Playlist ID</key><integer>3</integer>
+		</dict>
+	</array>
+</dict>
+</plist>
+"""
+
+
+@pytest.fixture
+def library_xml(tmp_path, monkeypatch):
+    """A small Library.xml in a temporary playlist folder"""
+    (tmp_path / "Library.xml").write_text(LIBRARY_XML, encoding="utf-8")
+    monkeypatch.setattr(config, "PLAYLIST_PATH", tmp_path)
+    monkeypatch.setattr(config, "CHECKPOINTS_PATH", tmp_path)
+    return tmp_path / "Library.xml"
+
+
+@pytest.fixture
+def music_folder(tmp_path):
+    """A media folder with music files and other files over a few levels"""
+    for folder in ("Artist A/Album 1", "Artist A/Album 2", "Artist B/Album 3"):
+        (tmp_path / folder).mkdir(parents=True)
+
+    for file in (
+        "Artist A/Album 1/01 Track.m4a",
+        "Artist A/Album 1/02 Track.m4p",
+        "Artist A/Album 1/cover.jpg",
+        "Artist A/Album 2/01 Track.mp3",
+        "Artist B/Album 3/01 Track.MP3",
+        "Artist B/Album 3/notes",
+        "top.m4a",
+    ):
+        (tmp_path / file).touch()
+
+    return tmp_path
+
+
+def test_scan_music_files_filters_on_suffix(data_extractor, music_folder):
+    files = [Path(file).name for file in data_extractor._scan_music_files(music_folder)]
+    assert sorted(files) == ["01 Track.MP3", "01 Track.m4a", "01 Track.mp3", "02 Track.m4p", "top.m4a"]
+
+
+def test_scan_music_files_matches_rglob_order(data_extractor, music_folder):
+    expected = [
+        str(item)
+        for item in music_folder.rglob("*.*")
+        if item.suffix in DataExtractor.music_suffixes
+    ]
+    assert list(data_extractor._scan_music_files(music_folder)) == expected
+
+
+def test_scan_music_files_missing_folder(data_extractor, tmp_path):
+    assert list(data_extractor._scan_music_files(tmp_path / "missing")) == []
+
+
+def test_manifest_only_reads_new_or_changed_files(data_extractor, music_folder, monkeypatch):
+    files_read = []
+
+    def mock_get_tags_from_files(files):
+        files_read.extend(Path(file).name for file in files)
+        return [{"track_name": Path(file).stem} for file in files]
+
+    monkeypatch.setattr(data_extraction, "_get_tags_from_files", mock_get_tags_from_files)
+
+    manifest = ExtractionManifest()
+    data_extractor._get_tags_from_music(music_folder, manifest)
+    assert len(files_read) == 5
+
+    (music_folder / "top.m4a").unlink()
+    (music_folder / "Artist A/Album 2/01 Track.mp3").write_bytes(b"changed")
+    (music_folder / "Artist B/Album 3/02 Track.mp3").touch()
+    files_read.clear()
+
+    manifest = ExtractionManifest(manifest.entries)
+    tracks = data_extractor._get_tags_from_music(music_folder, manifest)
+    assert sorted(files_read) == ["01 Track.mp3", "02 Track.mp3"]
+    assert len(tracks) == 5
+    assert manifest.reused == 3
+    assert manifest.removed == 1
+
+
+def test_apple_library_parsed_once_for_tracks_and_playlists(data_extractor, library_xml, monkeypatch):
+    parse_calls = []
+    parse = DataExtractor._stream_apple_library
+
+    def mock_parse(path):
+        parse_calls.append(path)
+        return parse(path)
+
+    monkeypatch.setattr(DataExtractor, "_stream_apple_library", staticmethod(mock_parse))
+
+    df_tracks = data_extractor.read_tracks_from_apple_library()
+    df_playlists = data_extractor.read_playlists_from_apple_library()
+    assert len(parse_calls) == 1
+    assert list(df_tracks["track_name"]) == ["Insomnia", "Don't Leave", "Orinoco Flow (Sail Away)"]
+    assert list(df_playlists["track_name"]) == ["Orinoco Flow (Sail Away)", "Insomnia"]
+
+
+def test_apple_library_cached_by_file_hash(library_xml, monkeypatch):
+    df_tracks, df_playlists = DataExtractor(mode="TEST").read_apple_library(cache=True)
+    monkeypatch.setattr(DataExtractor, "_stream_apple_library", None)
+
+    cached_tracks, cached_playlists = DataExtractor(mode="TEST").read_apple_library(cache=True)
+    pd.testing.assert_frame_equal(cached_tracks, df_tracks)
+    pd.testing.assert_frame_equal(cached_playlists, df_playlists)
+
+
+def test_streaming_parser_matches_itunes_library(data_extractor, library_xml):
+    df_tracks, df_playlists = data_extractor.read_apple_library(parser="itunesLibrary")
+    df_stream_tracks, df_stream_playlists = DataExtractor._stream_apple_library(library_xml)
+
+    pd.testing.assert_frame_equal(df_stream_tracks, df_tracks)
+    pd.testing.assert_frame_equal(df_stream_playlists, df_playlists)
+    assert list(df_stream_playlists.columns) == ["playlist_name", "album", "artist", "track_name"]
+
+
+def test_mp4_tags_match_pprint_reader(tmp_path):
+    track = tmp_path / "track.m4a"
+    write_m4a(track, {
+        "©nam": ["Orinoco Flow (Sail Away)"],
+        "©ART": ["Enya"],
+        "soar": ["Enya"],
+        "©alb": ["Watermark"],
+        "trkn": [(3, 12)],
+        "cnID": [1485137457],
+        "xid ": ["Universal:isrc:GBAHT8800088"],
+        "covr": [MP4Cover(b"\x89PNG" + b"\0" * 1000)],
+    })
+
+    track_details = DataExtractor._get_music_metadata(track)
+    assert track_details == DataExtractor._get_music_metadata_pprint(track)
+    assert track_details["track_number"] == "(3, 12)"
+    assert track_details["xid"] == "Universal:isrc:GBAHT8800088"
+
+
+def test_mp4_tags_keep_newlines(tmp_path):
+    track = tmp_path / "track.m4a"
+    write_m4a(track, {"©nam": ["Part 1\nPart 2"], "©lyr": ["la\n" * 100]})
+
+    assert DataExtractor._get_music_metadata(track) == {"track_name": "Part 1\nPart 2"}
+
+
+def test_id3_tags_match_pprint_reader(tmp_path):
+    track = tmp_path / "track.mp3"
+    write_mp3(track, [
+        TIT2(encoding=3, text="Insomnia"),
+        TPE1(encoding=3, text=["Faithless", "Rollo"]),
+        TALB(encoding=3, text="Reverence"),
+        TDRC(encoding=3, text="1996"),
+    ])
+
+    track_details = DataExtractor._get_music_metadata(track)
+    assert track_details == DataExtractor._get_music_metadata_pprint(track)
+    assert track_details["artist"] == "Faithless / Rollo"
+
+
+def test_columnar_frame_builder_types_columns():
+    df = ColumnarFrameBuilder.from_records([
+        {"artist": "Enya", "track_name": "Orinoco Flow", "track_number": "(3, 12)"},
+        {"artist": "Enya", "album": "Watermark", "track_number": 4},
+        {"track_name": "Caribbean Blue", "track_number": "1/2", "release_date": "1991"},
+    ])
+
+    assert list(df.columns) == ["artist", "track_name", "track_number", "album", "release_date"]
+    assert df["artist"].dtype == "category"
+    assert df["track_name"].dtype == "string"
+    assert df["track_number"].dtype == "Int64"
+    assert df["track_number"].tolist() == [3, 4, 1]
+    assert df["release_date"].isna().tolist() == [True, True, False]
+    assert df["album"].isna().tolist() == [True, False, True]
+
+
+def test_synthetic_library_extracts(data_extractor, tmp_path, monkeypatch):
+    library_xml = generate_library(tmp_path, tracks=40, files=20)
+    monkeypatch.setattr(config, "PLAYLIST_PATH", library_xml.parent)
+
+    df_tracks, df_playlists = data_extractor.read_apple_library()
+    apple_tracks = data_extractor._get_tags_from_music(tmp_path / "Apple Music")
+    local_tracks = data_extractor._get_tags_from_music(tmp_path / "Music")
+
+    assert len(df_tracks) == 40
+    assert len(df_playlists) > 0
+    assert len(apple_tracks) == 12
+    assert len(local_tracks) == 8
+    assert all(track["xid"].startswith("Synthetic:isrc:") for track in apple_tracks)
+
+
+def test_tags_read_on_a_process_pool_match_serial(tmp_path, monkeypatch):
+    generate_library(tmp_path, tracks=40, files=40)
+    monkeypatch.setattr(config, "EXTRACT_BATCH_SIZE", 8)
+    path = tmp_path / "Apple Music"
+
+    serial = DataExtractor(mode="TEST", workers=1)._get_tags_from_music(path)
+    parallel = DataExtractor(mode="TEST", workers=2)._get_tags_from_music(path)
+
+    assert len(serial) > config.EXTRACT_BATCH_SIZE
+    pd.testing.assert_frame_equal(
+        ColumnarFrameBuilder.from_records(parallel), ColumnarFrameBuilder.from_records(serial)
+    )
@@ -1,17 +1,27 @@
+import random
+import threading
+import time
 from types import MappingProxyType
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
 import pytest
 import spotipy
+from spotipy.exceptions import SpotifyException
 
+import config
 import utils
-from data_linking import DataLinker
+from data_cleaning import DataCleaner
+from data_linking import DataLinker, SearchExecutor
+from rate_control import RateController
+from request_history import RequestHistory
 
 
 @pytest.fixture
-def data_linker():
-    """Returns a DataCleaning instance for Music"""
+def data_linker(tmp_path, monkeypatch):
+    """Returns a DataCleaning instance for Music, with the request history in a temporary folder"""
+    monkeypatch.setattr(config, "HISTORY_PATH", tmp_path)
     sp = spotipy.Spotify(auth_manager=spotipy.SpotifyClientCredentials(client_id='ID', client_secret='SECRET'))
     return DataLinker(spotify=sp)
 
@@ -85,3 +95,632 @@ def test_get_albums_uri_returned(data_linker, monkeypatch):
         "spotify_add_album",
         "spotify_album_uri",
     ]
+
+
+def test_get_albums_uri_returned_compact(data_linker, monkeypatch):
+    def mock_search(*args, **kwargs):
+        return MappingProxyType(
+            {"albums": {"items": [{"uri": "spotify:album:63SYDOduS7UPFCbRo7g9cy"}]}}
+        )
+
+    df = pd.DataFrame(
+        data=[
+            ["Platinum Collection", "Queen", 2, True, np.nan],
+            ["Platinum Collection", "Queen", 2, True, np.nan],
+            ["Innuendo", "Queen", 1, False, np.nan],
+        ],
+        columns=[
+            "spotify_search_album",
+            "spotify_search_artist",
+            "library_total_tracks",
+            "spotify_add_album",
+            "spotify_album_uri",
+        ],
+    )
+    df = utils.to_compact([df])[0]
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    monkeypatch.setattr(utils, "to_pickle", patch_to_pickle)
+    monkeypatch.setattr(utils, "read_pickle", patch_read_pickle)
+
+    data_linker.compact = True
+    df = data_linker.extract_spotify_album_uri(df)
+    assert df["spotify_album_uri"].dtype == "category"
+    assert utils.is_compact(df["spotify_album_uri"], df["spotify_search_album"].dtype)
+    assert df["spotify_album_uri"].tolist()[:2] == ["spotify:album:63SYDOduS7UPFCbRo7g9cy"] * 2
+    assert pd.isna(df["spotify_album_uri"][2])
+
+
+def test_concurrent_searches_map_results_to_their_rows(data_linker, monkeypatch):
+    searched = []
+    lock = threading.Lock()
+
+    def mock_search(self, search_str, **kwargs):
+        with lock:
+            searched.append(search_str)
+        time.sleep(random.uniform(0, 0.01))
+        if "Unknown" in search_str:
+            return {"tracks": {"items": []}}
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": f"ISRC {search_str}"},
+                    "uri": f"spotify:track:{search_str}",
+                    "artists": [{"uri": "spotify:artist:1"}],
+                    "album": {"total_tracks": 10},
+                }]
+            }
+        }
+
+    tracks = [f"Track {number}" for number in range(40)] + ["Track 3", "Unknown"]
+    df = pd.DataFrame(
+        data=[["Queen", track, np.nan, np.nan, np.nan, np.nan, 0] for track in tracks],
+        columns=[
+            "spotify_search_artist", "spotify_search_track_name", "spotify_release_year", "isrc",
+            "spotify_track_uri", "spotify_artist_uri", "spotify_total_tracks",
+        ],
+    )
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    data_linker.executor = SearchExecutor(
+        data_linker.spotify, workers=4, rate_control=RateController(rate=1000, burst=100)
+    )
+
+    df = data_linker.extract_all_isrc_with_na(df)
+    assert sorted(searched) == sorted(set(f"artist:Queen track:{track}" for track in tracks))
+    assert df["isrc"].tolist()[:41] == [f"ISRC artist:Queen track:{track}" for track in tracks[:41]]
+    assert pd.isna(df["isrc"][41])
+    assert data_linker.request_history.failures(["artist:queen track:unknown"]) == {"artist:queen track:unknown"}
+    assert len(data_linker.request_history) == 41
+
+
+def test_search_strings_differing_in_case_and_whitespace_requested_once(data_linker, monkeypatch):
+    searched = []
+
+    def mock_search(self, search_str, **kwargs):
+        searched.append(search_str)
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": "GBAHT8800088"},
+                    "uri": "spotify:track:1",
+                    "artists": [{"uri": "spotify:artist:1"}],
+                    "album": {"total_tracks": 12},
+                }]
+            }
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Enya", "Orinoco Flow", np.nan],
+            ["ENYA", "Orinoco  Flow", np.nan],
+            ["enya", "orinoco flow ", np.nan],
+            ["Enya", "Storms In Africa", "1988"],
+        ],
+        columns=["spotify_search_artist", "spotify_search_track_name", "spotify_release_year"],
+    )
+    df[["isrc", "spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    data_linker.request_history.add_success(
+        "artist:enya track:storms in africa year:1988",
+        "track",
+        data_linker._populate_row_for_spotify_request({}, mock_search(None, ""), "track"),
+    )
+    searched.clear()
+
+    df = data_linker.extract_all_isrc_with_na(df)
+    assert searched == ["artist:Enya track:Orinoco Flow"]
+    assert df["isrc"].tolist() == ["GBAHT8800088"] * 4
+    assert df["spotify_total_tracks"].tolist() == [12] * 4
+
+    stats = data_linker.search_stats[-1]
+    assert (stats.rows, stats.distinct, stats.keys, stats.history, stats.requested) == (4, 4, 2, 1, 1)
+    assert stats.saved == 3
+
+
+def test_rows_with_isrc_linked_by_isrc_with_text_search_fallback(data_linker, monkeypatch):
+    searched = []
+
+    def mock_search(self, search_str, **kwargs):
+        searched.append(search_str)
+        if search_str == "isrc:GBUM00000000":
+            return {"tracks": {"items": []}}
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": "GBUM71029604"},
+                    "uri": f"spotify:track:{search_str}",
+                    "artists": [{"uri": "spotify:artist:1"}],
+                    "album": {"total_tracks": 12},
+                }]
+            }
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Queen", "Innuendo", np.nan, "GBUM71029604"],
+            ["Queen", "Innuendo", "1991", "GBUM71029604"],
+            ["Queen", "Headlong", np.nan, "GBUM00000000"],
+            ["Queen", "Flash", np.nan, np.nan],
+        ],
+        columns=["spotify_search_artist", "spotify_search_track_name", "spotify_release_year", "isrc"],
+    )
+    df[["spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    df = data_linker.extract_spotify_track_uri_by_isrc(df)
+
+    assert searched == ["isrc:GBUM71029604", "isrc:GBUM00000000", "artist:Queen track:Headlong"]
+    assert df["spotify_track_uri"].tolist()[:3] == [
+        "spotify:track:isrc:GBUM71029604",
+        "spotify:track:isrc:GBUM71029604",
+        "spotify:track:artist:Queen track:Headlong",
+    ]
+    assert df["spotify_total_tracks"].tolist()[:3] == [12] * 3
+    assert pd.isna(df["spotify_track_uri"][3])
+    assert data_linker.request_history.known(["isrc:gbum71029604"]) == {"isrc:gbum71029604"}
+
+
+def scored_track(uri: str, name: str, artists: List[str], year: str) -> Dict:
+    return {
+        "name": name,
+        "uri": uri,
+        "external_ids": {"isrc": uri[-12:]},
+        "artists": [{"name": artist, "uri": f"spotify:artist:{artist}"} for artist in artists],
+        "album": {"release_date": f"{year}-01-01", "total_tracks": 12},
+    }
+
+
+def test_scored_search_keeps_best_candidate_and_relaxes_the_search(data_linker, monkeypatch):
+    searched = []
+    candidates = {
+        "artist:Queen track:Innuendo year:1991": [
+            scored_track("spotify:track:KARAOKE00001", "Innuendo (Karaoke Version)", ["Sing King"], "2015"),
+            scored_track("spotify:track:GBUM71029604", "Innuendo - Remastered 2011", ["Queen"], "1991"),
+        ],
+        "artist:Queen & David Bowie track:Under Pressure (Live) year:1986": [
+            scored_track("spotify:track:COVER0000001", "Under Pressure", ["The Covers"], "1986"),
+        ],
+        "artist:Queen track:Under Pressure": [
+            scored_track("spotify:track:GBUM71029605", "Under Pressure", ["Queen", "David Bowie"], "1981"),
+        ],
+    }
+
+    def mock_search(self, search_str, limit, **kwargs):
+        searched.append((search_str, limit))
+        return {"tracks": {"items": candidates.get(search_str, [])}}
+
+    df = pd.DataFrame(
+        data=[["Queen", "Innuendo", "1991"], ["Queen & David Bowie", "Under Pressure (Live)", "1986"]],
+        columns=["spotify_search_artist", "spotify_search_track_name", "spotify_release_year"],
+    )
+    df[["isrc", "spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    data_linker.scored = True
+    df = data_linker.extract_all_isrc_with_na(df)
+
+    assert df["spotify_track_uri"].tolist() == ["spotify:track:GBUM71029604", "spotify:track:GBUM71029605"]
+    assert searched == [
+        ("artist:Queen track:Innuendo year:1991", config.SCORED_CANDIDATES),
+        ("artist:Queen & David Bowie track:Under Pressure (Live) year:1986", config.SCORED_CANDIDATES),
+        ("artist:Queen & David Bowie track:Under Pressure (Live)", config.SCORED_CANDIDATES),
+        ("artist:Queen & David Bowie track:Under Pressure", config.SCORED_CANDIDATES),
+        ("artist:Queen track:Under Pressure", config.SCORED_CANDIDATES),
+    ]
+    assert data_linker.request_history.known(["artist:queen track:innuendo year:1991"]) == set()
+
+
+def test_scored_album_search_weighs_the_track_count(data_linker, monkeypatch):
+    def mock_search(self, search_str, limit, **kwargs):
+        return {
+            "albums": {
+                "items": [
+                    {"name": "Greatest Hits", "uri": f"spotify:album:{tracks}", "total_tracks": tracks,
+                     "artists": [{"name": "Queen"}], "release_date": "1981"}
+                    for tracks in (34, 17)
+                ]
+            }
+        }
+
+    df = pd.DataFrame(
+        data=[["Greatest Hits", "Queen", 17, True, np.nan]] * 17,
+        columns=[
+            "spotify_search_album", "spotify_search_artist", "library_total_tracks", "spotify_add_album",
+            "spotify_album_uri",
+        ],
+    )
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    data_linker.scored = True
+    df = data_linker.extract_spotify_album_uri(df)
+
+    assert df["spotify_album_uri"].unique().tolist() == ["spotify:album:17"]
+
+
+@pytest.mark.parametrize(
+    "searched, credited",
+    [
+        ("Earth, Wind & Fire", ["Earth, Wind & Fire"]),
+        ("Simon and Garfunkel", ["Simon & Garfunkel"]),
+        ("Crosby, Stills, Nash", ["Crosby, Stills, Nash & Young"]),
+    ],
+)
+def test_scored_artist_named_with_a_separator_matched(data_linker, searched, credited):
+    candidate = scored_track("spotify:track:1", "Déjà Vu", credited, "1970")
+    fields = {"artist": searched, "track": "Déjà Vu", "year": "1970"}
+
+    assert data_linker._score_candidate(candidate, fields, "track") == 1.0
+
+
+def test_many_tracks_fixed_at_once_relinking_only_their_rows(data_linker, monkeypatch):
+    searched = []
+    commits = []
+
+    def mock_search(self, search_str, **kwargs):
+        searched.append(search_str)
+        if search_str == "artist:Enya track:Orinoco Flow":
+            return {"tracks": {"items": []}}
+        return {
+            "tracks": {
+                "items": [{
+                    "external_ids": {"isrc": "GBUM71029604"},
+                    "uri": f"spotify:track:{search_str}",
+                    "artists": [{"uri": "spotify:artist:1"}],
+                    "album": {"total_tracks": 12},
+                }]
+            }
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Queen", "Queen", "Inuendo", "spotify:track:wrong"],
+            ["Queen", "Queen", "Inuendo", "spotify:track:wrong"],
+            ["Queen Feat. Freddie", "Queen", "Inuendo", "spotify:track:live"],
+            ["Enya", "Enya", "Orinoco Flow", "spotify:track:wrong"],
+            ["Enya", "Enya", "Storms In Africa", "spotify:track:storms"],
+        ],
+        columns=["artist", "spotify_search_artist", "spotify_search_track_name", "spotify_track_uri"],
+    )
+    df[["isrc", "spotify_artist_uri", "spotify_release_year"]] = np.nan
+    df["spotify_total_tracks"] = 10
+    correction = config.SpotifyTrackName("Queen", "Inuendo", "Innuendo")
+    cleaned = DataCleaner._update_spotify_tracks(df.copy(), [correction])
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    monkeypatch.setattr(data_linker.request_history, "commit", lambda: commits.append(True))
+    df = data_linker.fix_tracks(df, [correction, ("Enya", "Orinoco Flow"), ("Enya", "Caribbean Blue")])
+
+    assert searched == ["artist:Queen track:Innuendo", "artist:Enya track:Orinoco Flow"]
+    assert len(commits) == 1
+    # A correction renames the rows of its original artist, as when cleaning
+    assert df["spotify_search_track_name"].tolist() == cleaned["spotify_search_track_name"].tolist()
+    assert df["spotify_search_track_name"].tolist()[:3] == ["Innuendo", "Innuendo", "Inuendo"]
+    assert df["spotify_track_uri"][[0, 1, 2, 4]].tolist() == [
+        "spotify:track:artist:Queen track:Innuendo",
+        "spotify:track:artist:Queen track:Innuendo",
+        "spotify:track:live",
+        "spotify:track:storms",
+    ]
+    assert pd.isna(df["spotify_track_uri"][3])
+    # Not found again, unlinked with the total tracks of an unlinked row
+    assert df["spotify_total_tracks"].tolist() == [12, 12, 10, 0, 10]
+
+
+def test_album_first_links_rows_from_the_album_tracklist(data_linker, monkeypatch):
+    calls = []
+    titles = ["Innuendo - Remastered 2011", "I'm Going Slightly Mad", "Headlong", "I Can't Live With You"]
+
+    def mock_search(self, search_str, **kwargs):
+        calls.append(("search", search_str))
+        return {"albums": {"items": [{"uri": "spotify:album:innuendo"}]}}
+
+    def mock_album_tracks(self, album_uri, **kwargs):
+        calls.append(("album_tracks", album_uri))
+        return {
+            "items": [
+                {"disc_number": 1, "track_number": number, "name": title, "uri": f"spotify:track:{number}",
+                 "artists": [{"uri": "spotify:artist:queen"}]}
+                for number, title in enumerate(titles, 1)
+            ],
+            "next": None,
+        }
+
+    def mock_tracks(self, uris, **kwargs):
+        calls.append(("tracks", tuple(uris)))
+        return {
+            "tracks": [
+                {"external_ids": {"isrc": f"ISRC {uri}"}, "uri": uri, "artists": [{"uri": "spotify:artist:queen"}],
+                 "album": {"total_tracks": 12}}
+                for uri in uris
+            ]
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Innuendo", "Queen", "Innuendo", 1],
+            ["Im Going Slightly Mad", "Queen", "Innuendo", 2],
+            ["Headlong (Single Version)", "Queen", "Innuendo", 3],
+            ["I Can't Live with You", "Queen", "Innuendo", 4],
+            ["Bonus Track", "Queen", "Innuendo", 13],
+            ["Flash", "Queen", "Flash Gordon", 1],
+        ],
+        columns=["track_name", "spotify_search_artist", "spotify_search_album", "track_number"],
+    )
+    df[["isrc", "spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    monkeypatch.setattr(spotipy.Spotify, "album_tracks", mock_album_tracks)
+    monkeypatch.setattr(spotipy.Spotify, "tracks", mock_tracks)
+    data_linker.album_first = True
+    linked = data_linker.extract_tracks_by_album(df.copy())
+
+    assert calls == [
+        ("search", "album:Innuendo artist:Queen"),
+        ("album_tracks", "spotify:album:innuendo"),
+        ("tracks", ("spotify:track:1", "spotify:track:2", "spotify:track:3", "spotify:track:4")),
+    ]
+    assert linked["spotify_track_uri"].tolist()[:4] == [f"spotify:track:{number}" for number in range(1, 5)]
+    assert linked["isrc"][0] == "ISRC spotify:track:1"
+    assert linked["spotify_total_tracks"][0] == 12
+    assert linked[["spotify_track_uri", "isrc"]].iloc[4:].isna().all().all()
+
+    stats = data_linker.album_stats[-1]
+    assert (stats.albums, stats.rows, stats.linked, stats.calls, stats.saved) == (1, 5, 4, 3, 1)
+
+    calls.clear()
+    data_linker.extract_tracks_by_album(df.copy())
+    assert calls == []
+    assert data_linker.album_stats[-1].saved == 4
+
+
+def test_album_first_search_error_leaves_rows_to_the_search_per_track(data_linker, monkeypatch):
+    titles = ["Innuendo", "Headlong", "Headlong", "Bijou"]
+
+    def mock_search(self, search_str, **kwargs):
+        if search_str.startswith("album:Flash Gordon"):
+            raise SpotifyException(404, -1, "Not found")
+        return {"albums": {"items": [{"uri": "spotify:album:innuendo"}]}}
+
+    def mock_album_tracks(self, album_uri, **kwargs):
+        return {
+            "items": [
+                {"disc_number": 1, "track_number": number, "name": title, "uri": f"spotify:track:{number}"}
+                for number, title in enumerate(titles, 1)
+            ],
+            "next": None,
+        }
+
+    def mock_tracks(self, uris, **kwargs):
+        return {
+            "tracks": [
+                {"external_ids": {"isrc": f"ISRC {uri}"}, "uri": uri, "artists": [{"uri": "spotify:artist:queen"}],
+                 "album": {"total_tracks": 4}}
+                for uri in uris
+            ]
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Innuendo", "Queen", "Innuendo"],
+            ["Headlong", "Queen", "Innuendo"],
+            ["Headlong", "Queen", "Innuendo"],
+            ["Bijou", "Queen", "Innuendo"],
+            *[[f"Flash {number}", "Queen", "Flash Gordon"] for number in range(4)],
+        ],
+        columns=["track_name", "spotify_search_artist", "spotify_search_album"],
+    )
+    # Tags without a track number are extracted as NA
+    df["track_number"] = pd.array([1, 2, pd.NA, 4, 1, 2, 3, 4], dtype="Int64")
+    df[["isrc", "spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    monkeypatch.setattr(spotipy.Spotify, "album_tracks", mock_album_tracks)
+    monkeypatch.setattr(spotipy.Spotify, "tracks", mock_tracks)
+    data_linker.album_first = True
+    linked = data_linker.extract_tracks_by_album(df)
+
+    assert linked["spotify_track_uri"][[0, 1, 3]].tolist() == ["spotify:track:1", "spotify:track:2", "spotify:track:4"]
+    assert linked["spotify_track_uri"].iloc[[2, 4, 5, 6, 7]].isna().all()
+    assert data_linker.album_stats[-1].linked == 3
+
+
+@pytest.mark.parametrize("scored", [False, True])
+def test_artist_catalog_links_rows_of_prolific_artists(data_linker, monkeypatch, scored):
+    calls = []
+    albums = {
+        "spotify:album:reverence": ("Reverence", ["Salva Mea", "Insomnia", "Don't Leave"]),
+        "spotify:album:forever": ("Forever Faithless - The Greatest Hits", ["Insomnia - Radio Edit", "God Is A DJ"]),
+    }
+
+    def mock_search(self, search_str, type, **kwargs):
+        calls.append(("search", search_str, type))
+        return {"artists": {"items": [{"uri": "spotify:artist:faithless"}]}}
+
+    def mock_artist_albums(self, artist_uri, **kwargs):
+        calls.append(("artist_albums", artist_uri, kwargs["album_type"]))
+        return {"items": [{"uri": uri, "name": name} for uri, (name, _) in albums.items()], "next": None}
+
+    def mock_albums(self, album_uris, **kwargs):
+        calls.append(("albums", tuple(album_uris)))
+        return {
+            "albums": [
+                {
+                    "uri": uri,
+                    "tracks": {
+                        "items": [
+                            {"disc_number": 1, "track_number": number, "name": title, "uri": f"{uri}:{number}",
+                             "artists": [{"uri": "spotify:artist:faithless"}]}
+                            for number, title in enumerate(albums[uri][1], 1)
+                        ],
+                        "next": None,
+                    },
+                }
+                for uri in album_uris
+            ]
+        }
+
+    def mock_tracks(self, uris, **kwargs):
+        calls.append(("tracks", len(uris)))
+        return {
+            "tracks": [
+                {"external_ids": {"isrc": f"ISRC {uri}"}, "uri": uri, "artists": [{"uri": "spotify:artist:faithless"}],
+                 "album": {"total_tracks": 10}}
+                for uri in uris
+            ]
+        }
+
+    df = pd.DataFrame(
+        data=[
+            ["Insomnia", "Faithless", "Reverence", 2],
+            ["Insomnia", "Faithless", "Forever Faithless - The Greatest Hits", 1],
+            ["God Is a DJ", "Faithless", "Sunday 8PM", 1],
+            ["Unreleased", "Faithless", "Reverence", 9],
+            ["Orinoco Flow", "Enya", "Watermark", 2],
+        ],
+        columns=["track_name", "spotify_search_artist", "spotify_search_album", "track_number"],
+    )
+    df[["isrc", "spotify_track_uri", "spotify_artist_uri"]] = np.nan
+    df["spotify_total_tracks"] = 0
+
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    monkeypatch.setattr(spotipy.Spotify, "artist_albums", mock_artist_albums)
+    monkeypatch.setattr(spotipy.Spotify, "albums", mock_albums)
+    monkeypatch.setattr(spotipy.Spotify, "tracks", mock_tracks)
+    monkeypatch.setattr(config, "ARTIST_CATALOG_MIN_TRACKS", 2)
+    data_linker.artist_catalog = True
+    # Artist searches are not scored, an artist has no title or credited artists
+    data_linker.scored = scored
+    linked = data_linker.extract_tracks_by_artist(df.copy())
+
+    assert calls == [
+        ("search", "artist:Faithless", "artist"),
+        ("artist_albums", "spotify:artist:faithless", "album,single,compilation"),
+        ("albums", ("spotify:album:reverence", "spotify:album:forever")),
+        ("tracks", 3),
+    ]
+    assert linked["spotify_track_uri"].tolist()[:3] == [
+        "spotify:album:reverence:2", "spotify:album:forever:1", "spotify:album:forever:2"
+    ]
+    assert linked["isrc"][0] == "ISRC spotify:album:reverence:2"
+    assert linked["spotify_track_uri"].iloc[3:].isna().all()
+
+    stats = data_linker.catalog_stats[-1]
+    assert (stats.artists, stats.albums, stats.rows, stats.linked, stats.calls) == (1, 2, 4, 3, 4)
+
+    calls.clear()
+    data_linker.extract_tracks_by_artist(df.copy())
+    assert calls == []
+
+
+def test_artist_catalog_matches_rows_without_a_track_number(data_linker):
+    catalog = [
+        {"name": "Insomnia", "album_name": "reverence", "track_number": 2, "spotify_track_uri": "spotify:track:2"},
+        {"name": "Insomnia", "album_name": "reverence", "track_number": 7, "spotify_track_uri": "spotify:track:7"},
+    ]
+    rows = pd.DataFrame({
+        "track_name": ["Insomnia", "Insomnia"],
+        "spotify_search_album": ["Reverence", "Reverence"],
+        "track_number": pd.array([pd.NA, 7], dtype="Int64"),
+    })
+
+    assert data_linker._match_catalog(rows, catalog) == {0: "spotify:track:2", 1: "spotify:track:7"}
+
+
+def test_transient_search_error_retried_on_a_later_run(tmp_path, monkeypatch):
+    now = [0.0]
+    errors = [SpotifyException(503, -1, "Unavailable")]
+    searched = []
+
+    def mock_search(self, search_str, **kwargs):
+        searched.append(search_str)
+        if errors:
+            raise errors.pop()
+        return {"albums": {"items": [{"uri": "spotify:album:1"}]}}
+
+    monkeypatch.setattr(config, "HISTORY_PATH", tmp_path)
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    sp = spotipy.Spotify(auth_manager=spotipy.SpotifyClientCredentials(client_id='ID', client_secret='SECRET'))
+    history = RequestHistory(tmp_path / "history.sqlite3", transient_ttl=60, clock=lambda: now[0])
+    data_linker = DataLinker(spotify=sp, request_history=history, rate_control=RateController(max_retries=0))
+
+    with pytest.raises(SpotifyException):
+        data_linker._link(pd.DataFrame(index=[0]), ["album:Innuendo"], "album")
+    assert history.failure("album:innuendo")["reason"] == "http_503"
+
+    data_linker._link(pd.DataFrame(index=[0]), ["album:Innuendo"], "album")
+    now[0] += 61
+    data_linker._link(pd.DataFrame(index=[0]), ["album:Innuendo"], "album")
+
+    assert searched == ["album:Innuendo"] * 2
+    assert history.results(["album:innuendo"])["album:innuendo"]["spotify_album_uri"] == "spotify:album:1"
+
+
+def test_interrupted_searches_flushed_and_not_repeated(tmp_path, monkeypatch):
+    searched = []
+
+    def mock_search(self, search_str, **kwargs):
+        if len(searched) == 7:
+            raise KeyboardInterrupt
+        searched.append(search_str)
+        return {"albums": {"items": [{"uri": f"spotify:{search_str}"}]}}
+
+    monkeypatch.setattr(config, "HISTORY_PATH", tmp_path)
+    monkeypatch.setattr(spotipy.Spotify, "search", mock_search)
+    sp = spotipy.Spotify(auth_manager=spotipy.SpotifyClientCredentials(client_id='ID', client_secret='SECRET'))
+    history = RequestHistory(tmp_path / "history.sqlite3", flush_requests=5)
+    data_linker = DataLinker(
+        spotify=sp, workers=1, request_history=history, rate_control=RateController(rate=1000, burst=100)
+    )
+    search_strs = [f"album:{number}" for number in range(10)]
+
+    with pytest.raises(KeyboardInterrupt):
+        data_linker._link(pd.DataFrame(index=range(10)), search_strs, "album")
+    assert len(RequestHistory(tmp_path / "history.sqlite3")) == 7
+
+    searched.clear()
+    data_linker._link(pd.DataFrame(index=range(10)), search_strs, "album")
+    assert searched == search_strs[7:]
+
+
+def test_pickled_request_history_migrated_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_PATH", tmp_path)
+    track = {
+        "tracks": {
+            "items": [{
+                "external_ids": {"isrc": "GBUM71029604"},
+                "uri": "spotify:track:1",
+                "artists": [{"uri": "spotify:artist:1"}],
+                "album": {"total_tracks": 12, "images": [{"url": "https://i.scdn.co/image/1"}]},
+            }]
+        }
+    }
+    utils.to_pickle({"artist:Queen  track:Innuendo": track, "album:Innuendo": {"albums": {"items": []}}},
+                    filename="request_history_success")
+    utils.to_pickle({"artist:nan track:Flash year:1980"}, filename="request_history_failures")
+
+    sp = spotipy.Spotify(auth_manager=spotipy.SpotifyClientCredentials(client_id='ID', client_secret='SECRET'))
+    history = RequestHistory(tmp_path / "history.sqlite3")
+    DataLinker(spotify=sp, request_history=history)
+    DataLinker(spotify=sp, request_history=history)
+
+    assert history.results(["artist:queen track:innuendo"]) == {
+        "artist:queen track:innuendo": {
+            "isrc": "GBUM71029604",
+            "spotify_track_uri": "spotify:track:1",
+            "spotify_artist_uri": "spotify:artist:1",
+            "spotify_total_tracks": 12,
+            "spotify_album_uri": None,
+        }
+    }
+    assert history.failures(["album:innuendo", "artist:nan track:flash year:1980"]) == {
+        "album:innuendo", "artist:nan track:flash year:1980"
+    }
+    assert len(history) == 3
+    assert (tmp_path / "request_history_success").exists()
@@ -0,0 +1,106 @@
+import pytest
+import requests
+from spotipy.exceptions import SpotifyException
+
+from rate_control import RateController
+
+
+class FakeClock:
+    """A clock advanced by sleeping"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def rate_control(clock):
+    return RateController(rate=10, burst=1, clock=clock, sleep=clock.sleep)
+
+
+def throttled(retry_after=None):
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+    return SpotifyException(429, -1, "Too many requests", headers=headers)
+
+
+def failing(*errors):
+    """Returns a function raising errors in turn, then returning ok"""
+    errors = list(errors)
+
+    def fn():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return fn
+
+
+def test_calls_spaced_at_the_rate(rate_control, clock):
+    for _ in range(11):
+        rate_control.call(lambda: None)
+
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_rate_increases_while_successful(rate_control, clock):
+    for _ in range(40):
+        rate_control.call(lambda: None)
+
+    assert rate_control.rate > 10
+    assert [decision.event for decision in rate_control.decisions][:1] == ["increase"]
+
+
+def test_throttled_call_decreases_rate_and_pauses_for_retry_after(rate_control, clock):
+    assert rate_control.call(failing(throttled(retry_after=7))) == "ok"
+
+    decisions = list(rate_control.decisions)
+    assert [decision.event for decision in decisions][:2] == ["decrease", "retry_after"]
+    assert decisions[0].rate == 5
+    assert clock.now >= 7
+
+
+def test_server_and_connection_errors_retried(rate_control):
+    fn = failing(SpotifyException(503, -1, "Unavailable"), requests.ConnectionError())
+    assert rate_control.call(fn) == "ok"
+    assert "decrease" not in [decision.event for decision in rate_control.decisions]
+
+
+def test_client_errors_not_retried(rate_control):
+    with pytest.raises(SpotifyException):
+        rate_control.call(failing(SpotifyException(404, -1, "Not found")))
+
+
+def test_calls_not_idempotent_retried_only_when_throttled(rate_control):
+    assert rate_control.call(failing(throttled()), idempotent=False) == "ok"
+    for error in (SpotifyException(503, -1, "Unavailable"), requests.ConnectionError()):
+        with pytest.raises(type(error)):
+            rate_control.call(failing(error), idempotent=False)
+
+
+def test_retries_exhausted_raised(clock):
+    rate_control = RateController(rate=10, max_retries=2, clock=clock, sleep=clock.sleep)
+    with pytest.raises(SpotifyException):
+        rate_control.call(failing(*[throttled()] * 3))
+
+
+def test_breaker_pauses_all_callers_after_consecutive_errors(clock):
+    rate_control = RateController(
+        rate=10, breaker_errors=3, breaker_pause=60, max_backoff=1, clock=clock, sleep=clock.sleep
+    )
+    assert rate_control.call(failing(*[SpotifyException(502, -1, "Bad gateway")] * 3)) == "ok"
+
+    events = [decision.event for decision in rate_control.decisions]
+    assert events.index("breaker_open") < events.index("breaker_close")
+    assert clock.now >= 60
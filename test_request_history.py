@@ -0,0 +1,116 @@
+import sqlite3
+
+import pytest
+
+from request_history import NO_RESULT, RequestHistory
+
+DAY = 24 * 60 * 60
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def history(tmp_path, clock):
+    return RequestHistory(
+        tmp_path / "history.sqlite3", failure_ttl=DAY, transient_ttl=60, max_ttl=10 * DAY, max_attempts=3,
+        max_failures=100, clock=clock,
+    )
+
+
+def test_failure_known_until_its_ttl_expires(history, clock):
+    history.add_failure("artist:queen track:unknown", "track")
+
+    assert history.known(["artist:queen track:unknown"]) == {"artist:queen track:unknown"}
+    clock.now += DAY + 1
+    assert history.known(["artist:queen track:unknown"]) == set()
+
+
+def test_retry_spacing_doubles_with_each_attempt(history, clock):
+    retries = []
+    for _ in range(2):
+        history.add_failure("artist:queen track:unknown", "track")
+        failure = history.failure("artist:queen track:unknown")
+        retries.append(failure["retry_at"] - failure["last_failed"])
+        clock.now = failure["retry_at"] + 1
+
+    assert retries == [DAY, 2 * DAY]
+    assert failure["attempts"] == 2
+    assert failure["reason"] == NO_RESULT
+
+
+def test_no_result_not_retried_after_max_attempts(history, clock):
+    for _ in range(3):
+        history.add_failure("artist:queen track:unknown", "track")
+
+    clock.now += 100 * DAY
+    assert history.failure("artist:queen track:unknown")["retry_at"] is None
+    assert history.known(["artist:queen track:unknown"]) == {"artist:queen track:unknown"}
+
+
+def test_transient_failure_retried_after_transient_ttl(history, clock):
+    for _ in range(5):
+        history.add_failure("album:innuendo", "album", "http_503", transient=True)
+
+    failure = history.failure("album:innuendo")
+    assert (failure["reason"], failure["transient"], failure["attempts"]) == ("http_503", 1, 5)
+    clock.now += 16 * 60 + 1
+    assert history.known(["album:innuendo"]) == set()
+
+
+def test_success_replaces_failure(history):
+    history.add_failure("album:innuendo", "album", "http_503", transient=True)
+    history.add_success("album:innuendo", "album", {"spotify_album_uri": "spotify:album:1"})
+
+    assert history.failure("album:innuendo") is None
+    assert history.known(["album:innuendo"]) == {"album:innuendo"}
+
+
+def test_least_recently_failed_evicted_beyond_max_failures(history, clock):
+    for number in range(105):
+        clock.now += 1
+        history.add_failure(f"album:{number}", "album")
+    history.commit()
+
+    assert len(history) == 100
+    assert history.failures(["album:0", "album:4", "album:5"]) == {"album:5"}
+
+
+def test_failure_table_of_keys_upgraded(tmp_path, clock):
+    path = tmp_path / "history.sqlite3"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE failure (key TEXT PRIMARY KEY, search_type TEXT NOT NULL)")
+    connection.execute("INSERT INTO failure VALUES ('album:innuendo', 'album')")
+    connection.commit()
+    connection.close()
+
+    history = RequestHistory(path, failure_ttl=DAY, clock=clock)
+
+    failure = history.failure("album:innuendo")
+    assert (failure["reason"], failure["attempts"], failure["retry_at"]) == (NO_RESULT, 1, clock.now + DAY)
+
+
+def test_flushed_every_flush_requests_or_flush_seconds(tmp_path, clock):
+    history = RequestHistory(tmp_path / "history.sqlite3", flush_requests=3, flush_seconds=30, clock=clock)
+    reader = RequestHistory(tmp_path / "history.sqlite3", clock=clock)
+
+    flushed = []
+    for number in range(4):
+        history.add_failure(f"album:{number}", "album")
+        flushed.append(history.flush())
+    assert flushed == [False, False, True, False]
+    assert len(reader) == 3
+
+    clock.now += 30
+    assert history.flush()
+    assert len(reader) == 4
@@ -0,0 +1,106 @@
+import redis
+
+from request_history import NO_RESULT
+from shared_history import SharedRequestHistory
+
+DAY = 24 * 60 * 60
+
+
+class FakePipeline:
+    def __init__(self, redis_):
+        self.redis = redis_
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append(("get", key, None, None))
+
+    def set(self, key, value, ex=None):
+        self.commands.append(("set", key, value, ex))
+
+    def execute(self):
+        if self.redis.down:
+            raise redis.exceptions.ConnectionError("Connection refused")
+        self.redis.round_trips += 1
+        results = []
+        for command, key, value, ex in self.commands:
+            if command == "get":
+                results.append(self.redis.store.get(key, (None,))[0])
+            else:
+                self.redis.store[key] = (value.encode(), ex)
+                results.append(True)
+        return results
+
+
+class FakeRedis:
+    """The pipelined GET and SET used by SharedRequestHistory, on a dict of key: (value, ttl)"""
+
+    def __init__(self, down: bool = False):
+        self.store = {}
+        self.round_trips = 0
+        self.down = down
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def test_search_recorded_by_one_user_found_by_another(tmp_path):
+    shared = FakeRedis()
+    alice = SharedRequestHistory(shared, tmp_path / "alice.sqlite3", prefix="test:", ttl=DAY)
+    bob = SharedRequestHistory(shared, tmp_path / "bob.sqlite3", prefix="test:", ttl=DAY)
+
+    alice.add_success("album:innuendo", "album", {"spotify_album_uri": "spotify:album:1"})
+    alice.commit()
+
+    assert shared.store["test:search:album:innuendo"][1] == DAY
+    assert bob.known(["album:innuendo", "album:jazz"]) == {"album:innuendo"}
+    assert bob.results(["album:innuendo"])["album:innuendo"]["spotify_album_uri"] == "spotify:album:1"
+
+
+def test_search_found_in_redis_copied_to_the_local_history(tmp_path):
+    shared = FakeRedis()
+    alice = SharedRequestHistory(shared, tmp_path / "alice.sqlite3")
+    alice.add_success("album:innuendo", "album", {"spotify_album_uri": "spotify:album:1"})
+    alice.commit()
+
+    bob = SharedRequestHistory(shared, tmp_path / "bob.sqlite3")
+    bob.known(["album:innuendo"])
+    round_trips = shared.round_trips
+    bob.commit()
+
+    assert bob.known(["album:innuendo"]) == {"album:innuendo"}
+    assert shared.round_trips == round_trips
+
+
+def test_no_result_shared_and_errors_not(tmp_path):
+    shared = FakeRedis()
+    alice = SharedRequestHistory(shared, tmp_path / "alice.sqlite3", failure_ttl=DAY)
+    bob = SharedRequestHistory(shared, tmp_path / "bob.sqlite3")
+
+    alice.add_failure("album:innuendo", "album", NO_RESULT)
+    alice.add_failure("album:jazz", "album", "http_503", transient=True)
+    alice.commit()
+
+    assert [ttl for _, ttl in shared.store.values()] == [DAY]
+    assert bob.known(["album:innuendo", "album:jazz"]) == {"album:innuendo"}
+
+
+def test_tracklists_shared(tmp_path):
+    shared = FakeRedis()
+    alice = SharedRequestHistory(shared, tmp_path / "alice.sqlite3")
+    bob = SharedRequestHistory(shared, tmp_path / "bob.sqlite3")
+    tracks = [{"disc_number": 1, "track_number": 1, "name": "Innuendo", "spotify_track_uri": "spotify:track:1"}]
+
+    alice.add_album_tracks("spotify:album:1", tracks)
+    alice.commit()
+
+    assert bob.album_tracks(["spotify:album:1", "spotify:album:2"]) == {"spotify:album:1": tracks}
+
+
+def test_unreachable_redis_falls_back_to_the_local_history(tmp_path):
+    history = SharedRequestHistory(FakeRedis(down=True), tmp_path / "history.sqlite3")
+
+    history.add_success("album:innuendo", "album", {"spotify_album_uri": "spotify:album:1"})
+    history.commit()
+
+    assert history.client is None
+    assert history.known(["album:innuendo", "album:jazz"]) == {"album:innuendo"}
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from credentials import spotify_stub
+from data_linking import DataLinker
+from data_loading import DataLoader
+from rate_control import RateController
+from request_history import RequestHistory
+from spotify_stub import Catalog, Faults, Recording, SpotifyStub, Upstream
+
+
+@pytest.fixture
+def catalog():
+    catalog = Catalog()
+    album = catalog.add_album("Innuendo", "Queen", 1991)
+    catalog.add_track(album, "Innuendo", 1, isrc="GBUM71029604")
+    catalog.add_track(album, "I'm Going Slightly Mad", 2)
+    return catalog
+
+
+@pytest.fixture
+def stub(catalog):
+    with SpotifyStub(catalog) as stub:
+        yield stub
+
+
+def linker_for(stub, tmp_path, **kwargs) -> DataLinker:
+    return DataLinker(
+        spotify=spotify_stub(stub.url),
+        request_history=RequestHistory(tmp_path / "history.sqlite3"),
+        rate_control=RateController(rate=1000, burst=100, **kwargs),
+    )
+
+
+def tracks_to_link() -> pd.DataFrame:
+    return pd.DataFrame({
+        "spotify_search_artist": ["Queen", "Queen", "Queen"],
+        "spotify_search_track_name": ["Innuendo", "Im Going Slightly Mad", "Bohemian Rhapsody"],
+        "spotify_release_year": [1991, np.nan, np.nan],
+        "isrc": [np.nan, np.nan, np.nan],
+        "spotify_track_uri": [np.nan, np.nan, np.nan],
+        "spotify_artist_uri": [np.nan, np.nan, np.nan],
+        "spotify_total_tracks": [np.nan, np.nan, np.nan],
+    })
+
+
+def test_tracks_linked_through_the_stub(stub, tmp_path):
+    df = linker_for(stub, tmp_path).extract_all_isrc_with_na(tracks_to_link())
+
+    assert df["spotify_track_uri"].tolist()[:2] == ["spotify:track:synt0000000001", "spotify:track:synt0000000002"]
+    assert pd.isna(df.loc[2, "spotify_track_uri"])
+    assert df.loc[0, "isrc"] == "GBUM71029604"
+    assert df.loc[0, "spotify_total_tracks"] == 2
+    assert stub.requests["search"] == 3
+
+
+def test_429s_and_5xxs_retried(catalog, tmp_path):
+    faults = Faults(rate_429=0.3, retry_after=0, rate_5xx=0.2, seed=1)
+    with SpotifyStub(catalog, faults=faults) as stub:
+        linker = linker_for(stub, tmp_path, max_retries=20, backoff=0.001, breaker_pause=0)
+        df = linker.extract_all_isrc_with_na(tracks_to_link())
+
+    assert df["spotify_track_uri"].notna().sum() == 2
+    assert stub.requests["429"] > 0 and stub.requests["503"] > 0
+
+
+def test_library_loaded_for_each_user(stub):
+    df = pd.DataFrame({
+        "spotify_track_uri": ["spotify:track:synt0000000001", "spotify:track:synt0000000002"],
+        "spotify_album_uri": ["spotify:album:syna0000000001", "spotify:album:syna0000000001"],
+        "spotify_add_album": [True, True],
+        "playlist_name": ["Queen", "Queen"],
+    })
+    loader = DataLoader(spotify_stub(stub.url, token="alice"), rate_control=RateController(rate=1000, burst=100))
+    loader.add_albums_to_spotify(df)
+    loader.add_playlists(df)
+    DataLoader(spotify_stub(stub.url, token="bob")).add_tracks_to_spotify(df.assign(spotify_add_album=False))
+
+    alice, bob = stub.users["alice"], stub.users["bob"]
+    assert loader.user_id == "alice"
+    assert list(alice.saved_albums) == ["spotify:album:syna0000000001"]
+    assert [playlist["tracks"] for playlist in alice.playlists.values()] == [df["spotify_track_uri"].tolist()]
+    assert list(bob.saved_tracks) == df["spotify_track_uri"].tolist() and not bob.saved_albums
+
+
+class StubAuth:
+    def get_access_token(self, as_dict=True):
+        return "recorder"
+
+
+def test_responses_recorded_then_replayed(stub, tmp_path):
+    path = tmp_path / "recording.jsonl"
+    with SpotifyStub(recording=Recording(path), upstream=Upstream(stub.url, auth_manager=StubAuth())) as recorder:
+        recorded = spotify_stub(recorder.url).search("artist:Queen track:Innuendo", type="track", limit=1)
+
+    with SpotifyStub(recording=Recording(path)) as replay:
+        sp = spotify_stub(replay.url)
+        assert sp.search("artist:Queen track:Innuendo", type="track", limit=1) == recorded
+        assert sp.search("artist:Queen track:Innuendo", type="track", limit=2)["tracks"]["items"] == []
+    assert len(Recording(path)) == 1
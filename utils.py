@@ -1,6 +1,10 @@
+from contextlib import contextmanager
+import os
 import pathlib
 import pickle
+from typing import Dict, Iterable, Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
 
 import config
@@ -21,12 +25,50 @@ def chunked(sequence, n):
         yield chunk
 
 
+@contextmanager
+def atomic_path(path: pathlib.Path) -> Iterator[pathlib.Path]:
+    """
+    Yield a temporary path next to path to write to, renamed over path once written. An interrupted write
+    leaves the previous file in place
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _dump(obj_to_pickle, path: pathlib.Path):
+    with atomic_path(path) as tmp_path, open(tmp_path, 'wb') as fh:
+        pickle.dump(obj_to_pickle, fh)
+
+
 def read_pickle_df(filename: str) -> pd.DataFrame:
     return pd.read_pickle(config.CHECKPOINTS_PATH / f'{filename}')
 
 
 def to_pickle_df(df: pd.DataFrame, filename: str):
-    df.to_pickle(config.CHECKPOINTS_PATH / f'{filename}')
+    with atomic_path(config.CHECKPOINTS_PATH / f'{filename}') as tmp_path:
+        df.to_pickle(tmp_path)
+
+
+def checkpoint_exists(filename: str) -> bool:
+    return (config.CHECKPOINTS_PATH / f'{filename}').exists()
+
+
+def remove_checkpoint(filename: str):
+    (config.CHECKPOINTS_PATH / f'{filename}').unlink(missing_ok=True)
+
+
+def read_checkpoint(filename: str):
+    with open(config.CHECKPOINTS_PATH / f'{filename}', 'rb') as fh:
+        return pickle.load(fh)
+
+
+def to_checkpoint(obj_to_pickle, filename: str):
+    _dump(obj_to_pickle, config.CHECKPOINTS_PATH / f'{filename}')
 
 
 def read_pickle(filename: str):
@@ -35,8 +77,94 @@ def read_pickle(filename: str):
 
 
 def to_pickle(obj_to_pickle, filename: str):
-    with open(config.HISTORY_PATH / f'{filename}', 'wb') as fh:
-        pickle.dump(obj_to_pickle, fh)
+    _dump(obj_to_pickle, config.HISTORY_PATH / f'{filename}')
+
+
+def as_object(s: pd.Series) -> pd.Series:
+    """Return s as object with NaN for missing values, e.g. a category or string column that is edited"""
+    return s.astype(object).where(s.notna(), np.nan)
+
+
+def to_compact(
+    frames: List[pd.DataFrame], columns: Optional[Iterable[str]] = None
+) -> List[pd.DataFrame]:
+    """
+    Convert the text columns of frames to categoricals sharing one dictionary (CategoricalDtype) of values.
+    Values repeated over rows and columns, e.g. track_name and spotify_search_track_name, are stored once and
+    the columns hold integer codes. As the dtype is shared, merges between the frames stay categorical
+    """
+    columns = config.COMPACT_COLUMNS if columns is None else columns
+    present = [[column for column in columns if column in df.columns] for df in frames]
+
+    # Categorical columns contribute their categories, once per dictionary, so frames already compact are not
+    # scanned again. Columns cast to the same dtype share its categories index
+    values, dtypes = [], []
+    for df, df_columns in zip(frames, present):
+        for column in df_columns:
+            dtype = df[column].dtype
+            if not isinstance(dtype, pd.CategoricalDtype):
+                values.append(pd.unique(df[column].to_numpy(dtype=object)))
+            elif not any(dtype.categories is seen.categories for seen in dtypes):
+                dtypes.append(dtype)
+                values.append(dtype.categories.to_numpy(dtype=object))
+
+    if not values:
+        return frames
+
+    categories = pd.unique(np.concatenate(values))
+    categories = categories[pd.notna(categories)]
+    if dtypes and len(categories) == len(dtypes[0].categories):
+        # Nothing to add to the existing dictionary, columns already holding it are left as they are
+        dtype = dtypes[0]
+    else:
+        dtype = pd.CategoricalDtype(categories)
+
+    compacted = []
+    for df, df_columns in zip(frames, present):
+        df = df.copy(deep=False)
+        for column in df_columns:
+            if not is_compact(df[column], dtype):
+                df[column] = df[column].astype(dtype)
+        compacted.append(df)
+
+    return compacted
+
+
+def is_compact(s: pd.Series, dtype: pd.CategoricalDtype) -> bool:
+    """Return True if s is categorical with the dictionary of dtype"""
+    return isinstance(s.dtype, pd.CategoricalDtype) and s.dtype.categories is dtype.categories
+
+
+def from_compact(df: pd.DataFrame, columns: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """Convert categorical columns back to object, before values not in the dictionary are written to them"""
+    columns = config.COMPACT_COLUMNS if columns is None else columns
+
+    for column in columns:
+        if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = as_object(df[column])
+
+    return df
+
+
+def map_categories(s: pd.Series, lookup: Dict) -> pd.Series:
+    """
+    Replace the values of a categorical series found in lookup by mapping its categories, the codes are
+    remapped without touching the values of each row. The series keeps its dictionary, which is only
+    extended when lookup maps to values not already in it
+    """
+    categories = s.cat.categories
+    if len(categories) == 0:
+        return s
+
+    mapped = pd.Index([lookup.get(value, value) for value in categories], dtype=object)
+    new_values = mapped.difference(categories)
+    dtype = s.dtype if len(new_values) == 0 else pd.CategoricalDtype(categories.append(new_values))
+
+    codes_map = dtype.categories.get_indexer(mapped)
+    codes = s.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, codes_map[codes], -1)
+
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=s.index, name=s.name)
 
 
 def create_folder_structure():